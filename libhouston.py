@@ -5,12 +5,345 @@ during __exit__(). If instantiated manually then this will also need to be done
 manually.  For security's sake using spacewalk as a context manager is best.
 '''
 
+import gc
 import os
 import re
 import sys
+import gzip
+import json
+import mmap
+import time
+import zlib
+import array
+import base64
+import bisect
+import struct
+import hashlib
+import datetime
+import functools
+import sqlite3
+import http.client
+import urllib.parse
 import xmlrpc.client
+import xml.sax.saxutils
+import xml.etree.ElementTree
+import itertools
+import weakref
+import threading
+import contextlib
 import configparser
 import collections
+import collections.abc
+import concurrent.futures
+
+# Maximum number of ids sent in a single list accepting api call. Spacewalk
+# copes with larger lists but the request times grow badly past this.
+_API_CHUNK_SIZE = 500
+
+# Maximum number of systems in a single schedule call. The server creates an
+# action for each system inside one transaction so these are kept smaller and
+# sent several at a time instead.
+_SCHEDULE_CHUNK_SIZE = 100
+
+# Maximum number of errata in a single async clone call. Each chunk becomes
+# one background job on the server, smaller jobs finish and show up sooner.
+_ERRATA_CHUNK_SIZE = 50
+
+
+def _chunks(seq, size=_API_CHUNK_SIZE):
+    '''Splits a sequence into lists of at most size items.
+
+    :param seq: sequence to split
+    :param int size: maximum length of each chunk
+    :returns: generator of lists
+
+    '''
+    seq = list(seq)
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+# api calls which only read, these can be answered by a replica.
+_READ_CALL = re.compile(r'(^|.*\.)(get|list|is|search|find|lookup|check|'
+                        r'applicable|bugzilla)[A-Z_]|.*\.search\.|'
+                        r'.*[a-z](_e|E)xists$')
+
+
+def _api_url(url):
+    '''Turns a server name or url into the url of its api.
+
+    :param str url: server name or url
+    :returns: str
+
+    '''
+    if not url.startswith('http'):
+        url = 'https://{}'.format(url)
+
+    if not url.endswith('/rpc/api'):
+        url = "/".join([url, 'rpc', 'api'])
+
+    return url
+
+
+def server_host(url):
+    '''Strips the scheme and api path from a spacewalk url.
+
+    :param str url: server url, as given on the command line or config
+    :returns: str
+
+    '''
+    return re.sub(r'^https?://|/rpc/api/?$', '', url or '').rstrip('/')
+
+
+def _xmlrpc_time(when=None):
+    '''Converts a datetime for an api call.
+
+    :param when: time to convert, defaults to now
+    :type when: :class:`datetime.datetime`
+    :returns: :class:`xmlrpc.client.DateTime`
+
+    '''
+    return xmlrpc.client.DateTime(when or datetime.datetime.now())
+
+
+# version and release segments as rpm sees them, anything else is a separator.
+_VERSION_SEGMENT = re.compile(r'[0-9]+|[A-Za-z]+|~|\^')
+
+# architectures rpm file names can end with, used to tell 'foo.x86_64' from
+# a package named 'foo.bar'.
+_RPM_ARCHES = (
+    'noarch', 'src', 'nosrc', 'i386', 'i486', 'i586', 'i686', 'athlon',
+    'x86_64', 'amd64', 'ia32e', 'ia64', 'ppc', 'ppc64', 'ppc64le', 'ppc64p7',
+    's390', 's390x', 'aarch64', 'armv7hl', 'armv7l', 'alpha', 'sparc',
+    'sparc64', 'sparcv9',
+)
+
+
+def _rpmvercmp(a, b):
+    '''Compares two version or release strings the same way as rpm.
+
+    Digits sort as numbers and newer than letters, separators are ignored,
+    '~' sorts before anything and '^' after the end of the string.
+
+    :param str a: version or release
+    :param str b: version or release
+    :returns: int 1 if a is newer, -1 if b is newer, 0 if identical
+
+    '''
+    if a == b:
+        return 0
+
+    one = _VERSION_SEGMENT.findall(a or '')
+    two = _VERSION_SEGMENT.findall(b or '')
+
+    for x, y in itertools.zip_longest(one, two):
+        if x == '~' or y == '~':
+            if x != '~':
+                return 1
+            if y != '~':
+                return -1
+            continue
+        if x == '^' or y == '^':
+            if x is None:
+                return -1
+            if y is None:
+                return 1
+            if x != '^':
+                return 1
+            if y != '^':
+                return -1
+            continue
+        if x is None:
+            return -1
+        if y is None:
+            return 1
+        if x.isdigit() != y.isdigit():
+            return 1 if x.isdigit() else -1
+        if x.isdigit():
+            x, y = int(x), int(y)
+        if x != y:
+            return 1 if x > y else -1
+
+    return 0
+
+
+def _evr_cmp(a, b):
+    '''Compares two (epoch, version, release) tuples.
+
+    An empty or None epoch counts as 0. If either release is None only the
+    epoch and version are compared, so '1.0' matches any release of 1.0.
+
+    :param tuple a: (epoch, version, release)
+    :param tuple b: (epoch, version, release)
+    :returns: int 1 if a is newer, -1 if b is newer, 0 if identical
+
+    '''
+    e_a = int(a[0] or 0)
+    e_b = int(b[0] or 0)
+    if e_a != e_b:
+        return 1 if e_a > e_b else -1
+
+    retval = _rpmvercmp(a[1], b[1])
+    if retval or a[2] is None or b[2] is None:
+        return retval
+
+    return _rpmvercmp(a[2], b[2])
+
+
+def _evr(pkg):
+    '''Returns the (epoch, version, release) tuple of a package dict.
+
+    :param dict pkg: package with epoch, version and release keys
+    :returns: tuple
+
+    '''
+    return (pkg.get('epoch') or '', pkg.get('version'), pkg.get('release'))
+
+
+def latest_packages(pkgs):
+    '''Picks the newest version of each package name and arch.
+
+    :param pkgs: package dicts with name, arch, epoch, version and release
+    :type pkgs: list of dicts
+    :returns: list of dicts
+
+    '''
+    newest = collections.OrderedDict()
+    for pkg in pkgs:
+        key = (pkg['name'], pkg.get('arch'))
+        if key not in newest or _evr_cmp(_evr(pkg), _evr(newest[key])) > 0:
+            newest[key] = pkg
+    return list(newest.values())
+
+
+def prune_packages(pkgs, keep):
+    '''Picks the versions of each package older than the newest few.
+
+    :param pkgs: package dicts with name, arch, epoch, version and release
+    :type pkgs: list of dicts
+    :param int keep: number of the newest versions of each name and arch to
+        keep
+    :returns: list of dicts, the versions beyond the newest keep
+
+    '''
+    groups = collections.OrderedDict()
+    for pkg in pkgs:
+        groups.setdefault((pkg['name'], pkg.get('arch')), []).append(pkg)
+
+    newest_first = functools.cmp_to_key(lambda a, b: _evr_cmp(_evr(b),
+                                                              _evr(a)))
+    pruned = []
+    for versions in groups.values():
+        pruned.extend(sorted(versions, key=newest_first)[keep:])
+    return pruned
+
+
+def _parse_nvrea(spec):
+    '''Splits a package specification into its parts.
+
+    Accepts 'name', 'name.arch', 'name-[epoch:]version',
+    'name-[epoch:]version-release' and 'name-[epoch:]version-release.arch'.
+    A trailing '.rpm' is ignored.
+
+    :param str spec: package specification
+    :returns: dict of name, epoch, version, release and arch. Any parts
+        missing from spec are None.
+
+    '''
+    spec = spec.strip()
+    if spec.endswith('.rpm'):
+        spec = spec[:-4]
+
+    parts = dict.fromkeys(['name', 'epoch', 'version', 'release', 'arch'])
+
+    base, _, arch = spec.rpartition('.')
+    if base and arch in _RPM_ARCHES:
+        spec, parts['arch'] = base, arch
+
+    fields = spec.split('-')
+    # version and release always start with a digit (or an epoch), names
+    # usually don't.
+    version = re.compile(r'^([0-9]+:)?[0-9]')
+    if len(fields) > 2 and version.match(fields[-2]):
+        parts['name'] = '-'.join(fields[:-2])
+        parts['version'], parts['release'] = fields[-2:]
+    elif len(fields) > 1 and version.match(fields[-1]):
+        parts['name'] = '-'.join(fields[:-1])
+        parts['version'] = fields[-1]
+
+    if not parts['name']:
+        parts['name'] = spec
+
+    if parts['version'] and ':' in parts['version']:
+        parts['epoch'], parts['version'] = parts['version'].split(':', 1)
+
+    return parts
+
+
+def _parse_evr(evr):
+    '''Splits an '[epoch:]version[-release]' string.
+
+    :param str evr: version string
+    :returns: tuple (epoch, version, release), release is None if missing
+
+    '''
+    epoch = ''
+    if ':' in evr:
+        epoch, evr = evr.split(':', 1)
+    version, _, release = evr.partition('-')
+    return (epoch, version, release or None)
+
+
+# comparison operators accepted in version constraints, mapped to the
+# results of _evr_cmp that satisfy them.
+_EVR_OPERATORS = collections.OrderedDict([
+    ('<=', (-1, 0)),
+    ('>=', (0, 1)),
+    ('!=', (-1, 1)),
+    ('==', (0,)),
+    ('<', (-1,)),
+    ('>', (1,)),
+    ('=', (0,)),
+])
+
+
+def _parse_evr_constraints(spec):
+    '''Parses a version constraint such as '<1.0.1e-16' or '>=1.0,<2'.
+
+    :param str spec: comma seperated constraints, each an optional operator
+        followed by '[epoch:]version[-release]'. No operator means '='.
+    :returns: list of tuples (accepted _evr_cmp results, (epoch, version,
+        release))
+
+    '''
+    constraints = []
+    for part in (spec or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        for op, accepted in _EVR_OPERATORS.items():
+            if part.startswith(op):
+                part = part[len(op):].strip()
+                break
+        else:
+            accepted = _EVR_OPERATORS['=']
+        if not part:
+            raise SpacewalkError("Missing version in constraint "
+                                 "{}".format(spec))
+        constraints.append((accepted, _parse_evr(part)))
+    return constraints
+
+
+def _evr_matches(evr, constraints):
+    '''Checks an (epoch, version, release) against parsed constraints.
+
+    :param tuple evr: (epoch, version, release)
+    :param constraints: as returned by :func:`_parse_evr_constraints`
+    :returns: Boolean
+
+    '''
+    return all(_evr_cmp(evr, target) in accepted
+               for accepted, target in constraints)
 
 
 def _convert_from_camel_case(name):
@@ -74,6 +407,816 @@ class SpacewalkPKGError(SpacewalkError):
     pass
 
 
+# faults answering lookups of things that don't exist, a healthy server gives
+# these and they say nothing about its load.
+_LOOKUP_FAULT = re.compile(r'no such|not found|does not exist|doesn\'t exist|'
+                           r'invalid', re.I)
+
+
+class Throttle(object):
+    '''Limits the rate and concurrency of api calls.
+
+    :param float rate: most calls started per second, None for no limit
+    :param int burst: calls that can be started at once before rate applies,
+        defaults to one second's worth
+    :param int limit: calls allowed in flight to begin with
+    :param int min_limit: fewest calls kept in flight
+    :param int max_limit: most calls allowed in flight
+    :param float tolerance: how many times slower than the fastest call of
+        the same method seen a call can be before the server is taken to be
+        struggling
+
+    Every call waits for a token from the bucket and a free slot before it is
+    made. The number of slots follows AIMD: it grows by one for every limit's
+    worth of calls that complete quickly and is cut when the server shows
+    strain. Each method is compared with its own fastest call, as listing a
+    big channel is always slower than looking up one package. Slow calls
+    cut it by a tenth, timeouts and connection or http
+    errors halve it, as do faults once they are more than a fifth of recent
+    calls. Faults saying something doesn't exist are answers to lookups and
+    aren't counted. Cuts happen at most once per typical call time so a
+    burst of failures from one overload only counts once.
+
+    :attr:`limit` and :attr:`queued` are kept up to date for instrumentation.
+
+    '''
+
+    def __init__(self, rate=None, burst=None, limit=4, min_limit=1,
+                 max_limit=32, tolerance=3.0):
+        '''init magic'''
+        self.rate = rate
+        self.burst = burst or max(1, int(rate or 1))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self._limit = float(min(max(limit, min_limit), max_limit))
+        self.active = 0
+        self.queued = 0
+        self.calls = 0
+        self.fault_rate = 0.0
+        self.fastest = {}
+        self.typical = None
+        self._tokens = float(self.burst)
+        self._filled = time.time()
+        self._last_cut = 0.0
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self):
+        '''Number of calls currently allowed in flight'''
+        return int(self._limit)
+
+    def acquire(self):
+        '''Waits until a call may be made.'''
+        with self._cond:
+            self.queued += 1
+            while self.active >= self.limit:
+                self._cond.wait()
+            self.queued -= 1
+            self.active += 1
+
+            wait = 0
+            if self.rate:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens +
+                                   (now - self._filled) * self.rate)
+                self._filled = now
+                # take the token now, going into debt if need be, so callers
+                # queue up in order instead of racing for the next token.
+                self._tokens -= 1
+                if self._tokens < 0:
+                    wait = -self._tokens / self.rate
+        if wait:
+            time.sleep(wait)
+
+    def release(self, latency, error=None, method=None):
+        '''Records the outcome of a call and frees its slot.
+
+        :param float latency: seconds the call took
+        :param error: exception the call raised, if any
+        :param str method: api method called, calls are only compared with
+            earlier calls of the same method
+
+        '''
+        with self._cond:
+            self.active -= 1
+            self.calls += 1
+
+            overloaded = isinstance(error, (OSError,
+                                            xmlrpc.client.ProtocolError))
+            faulted = isinstance(error, SpacewalkAPIError) and \
+                not _LOOKUP_FAULT.search(str(error))
+            self.fault_rate += 0.1 * (faulted - self.fault_rate)
+
+            fastest = self.fastest.get(method, latency)
+            if error is None:
+                self.fastest[method] = min(latency, fastest * 1.01)
+                self.typical = latency if self.typical is None else \
+                    self.typical + 0.1 * (latency - self.typical)
+
+            now = time.time()
+            can_cut = now - self._last_cut > (self.typical or 0)
+            if overloaded or faulted and self.fault_rate > 0.2:
+                if can_cut:
+                    self._cut(0.5, now)
+            elif error is None and latency > fastest * self.tolerance:
+                if can_cut:
+                    self._cut(0.9, now)
+            elif error is None:
+                self._limit = min(self.max_limit,
+                                  self._limit + 1.0 / self._limit)
+
+            self._cond.notify_all()
+
+    def _cut(self, factor, now):
+        '''Multiplicative decrease of the limit.'''
+        self._limit = max(self.min_limit, self._limit * factor)
+        self._last_cut = now
+
+
+def profiles(conf=os.path.expanduser('~/.spw_conf')):
+    '''Lists the named server profiles in a config file.
+
+    :param str conf: configuration file path
+    :returns: list of section names other than [auth]
+
+    '''
+    config = configparser.ConfigParser()
+    config.read(conf)
+    return [s for s in config.sections() if s != 'auth']
+
+
+def profile_settings(profile=None, conf=os.path.expanduser('~/.spw_conf')):
+    '''Reads the login details of a server profile from a config file.
+
+    :param str profile: section to read, anything missing from it is taken
+        from [auth] (opt)
+    :param str conf: configuration file path
+    :returns: dict of any server, user, password and replicas set
+
+    '''
+    config = configparser.ConfigParser()
+    config.read(conf)
+    settings = dict(config['auth']) if config.has_section('auth') else {}
+    if profile:
+        if not config.has_section(profile):
+            raise SpacewalkError("No profile {p} in {c}".format(
+                p=profile, c=conf))
+        settings.update(config[profile])
+    return settings
+
+
+def prompt_for_input(detail, user=None, profile=None):
+    '''Prompts the user for a login detail and returns what's given.
+
+    :param str detail: what to prompt for, password, user or server
+    :param str user: user the password is for (opt)
+    :param str profile: server profile the detail is for (opt)
+    :returns: str user input
+
+    '''
+    if not sys.stdout.isatty():
+        raise SpacewalkError("Password not supplied.")
+
+    prompt = {
+        'password':
+        "Please enter Password for {u}:".format(u=user),
+        'user':
+        "Please enter username:",
+        'server':
+        "Please enter spacewalk url",
+    }
+
+    if profile:
+        prompt[detail] = "[{p}] {m}".format(p=profile, m=prompt[detail])
+
+    import termios
+    fd = sys.stdin.fileno()
+    old = termios.tcgetattr(fd)
+    new = termios.tcgetattr(fd)
+    if detail == "password":
+        new[3] = new[3] & ~termios.ECHO
+    try:
+        termios.tcsetattr(fd, termios.TCSADRAIN, new)
+        retval = input(prompt[detail])
+        print("")
+    finally:
+        termios.tcsetattr(fd, termios.TCSADRAIN, old)
+
+    return retval
+
+
+class Journal(object):
+    '''Append only record of the content changes houston makes to channels.
+
+    :param str path: journal file to use
+
+    Each line of the journal is a json object with the keys:
+
+        * `float` - **time** when the change was made
+        * `str` - **server** spacewalk server url
+        * `str` - **channel** label of the channel changed, None for
+          packages deleted from the server
+        * `str` - **op** operation, e.g. add_packages, clone, delete,
+          delete_packages
+        * `list` - **pkgs_added** package ids added to the channel
+        * `list` - **pkgs_removed** package ids removed from the channel
+        * `list` - **errata_added** advisory names added to the channel
+        * `list` - **errata_removed** advisory names removed from the channel
+        * `dict` - **details** channel details, for create and delete only
+
+    '''
+
+    def __init__(self, path):
+        '''init magic'''
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, server, channel, op, pkgs_added=(), pkgs_removed=(),
+               errata_added=(), errata_removed=(), details=None):
+        '''Adds an entry to the journal.
+
+        :param str server: spacewalk server url
+        :param str channel: label of the channel changed, or None
+        :param str op: name of the operation
+        :param pkgs_added: package ids added to the channel
+        :param pkgs_removed: package ids removed from the channel
+        :param errata_added: advisory names added to the channel
+        :param errata_removed: advisory names removed from the channel
+        :param dict details: channel details for channels created or deleted
+
+        '''
+        entry = {
+            'time': time.time(),
+            'server': server,
+            'channel': channel,
+            'op': op,
+            'pkgs_added': list(pkgs_added),
+            'pkgs_removed': list(pkgs_removed),
+            'errata_added': list(errata_added),
+            'errata_removed': list(errata_removed),
+        }
+        if details is not None:
+            entry['details'] = details
+
+        line = json.dumps(entry, default=str, separators=(',', ':')) + '\n'
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path), mode=0o700,
+                        exist_ok=True)
+            with open(self.path, 'a') as fh:
+                fh.write(line)
+
+    def entries(self, server=None, since=None):
+        '''Reads entries from the journal, oldest first.
+
+        :param str server: only return entries for this server
+        :param float since: only return entries made after this time
+        :returns: generator of dicts
+
+        '''
+        try:
+            fh = open(self.path)
+        except FileNotFoundError:
+            return
+
+        with fh:
+            for line in fh:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a partly written line from a crash, nothing to undo
+                    continue
+                if server is not None and entry['server'] != server:
+                    continue
+                if since is not None and entry['time'] <= since:
+                    continue
+                yield entry
+
+    def changes_since(self, server, since):
+        '''Works out the net change to each channel since a point in time.
+
+        :param str server: spacewalk server url
+        :param float since: time to work from
+        :returns: dict of channel label to dict
+
+            * `bool` - **created** channel didn't exist at since
+            * `dict` - **deleted** details of the channel if it has since
+              been deleted, otherwise None
+            * `set` - **pkgs_added** package ids added since
+            * `set` - **pkgs_removed** package ids removed since
+            * `set` - **errata_added** advisory names added since
+            * `set` - **errata_removed** advisory names removed since
+
+        Changes which cancel each other out, e.g. a package added and then
+        removed again, are left out.
+
+        '''
+        changes = collections.OrderedDict()
+        for entry in self.entries(server, since):
+            if entry['channel'] is None:
+                continue
+            c = changes.setdefault(entry['channel'], {
+                'created': entry['op'] in ('create', 'clone'),
+                'deleted': None,
+                'pkgs_added': set(),
+                'pkgs_removed': set(),
+                'errata_added': set(),
+                'errata_removed': set(),
+            })
+            if entry['op'] == 'delete':
+                c['deleted'] = entry.get('details')
+            elif entry['op'] in ('create', 'clone'):
+                c['deleted'] = None
+
+            for kind in ['pkgs', 'errata']:
+                added = c['{}_added'.format(kind)]
+                removed = c['{}_removed'.format(kind)]
+                for i in entry['{}_added'.format(kind)]:
+                    if i in removed:
+                        removed.discard(i)
+                    else:
+                        added.add(i)
+                for i in entry['{}_removed'.format(kind)]:
+                    if i in added:
+                        added.discard(i)
+                    else:
+                        removed.add(i)
+
+        return changes
+
+    def deleted_packages(self, server, since):
+        '''Lists the packages deleted from the server since a point in time.
+
+        :param str server: spacewalk server url
+        :param float since: time to work from
+        :returns: set of package ids
+
+        '''
+        return {p for entry in self.entries(server, since)
+                if entry['op'] == 'delete_packages'
+                for p in entry['pkgs_removed']}
+
+
+# calls whose requests are never written to a cassette
+_SECRET_CALLS = ('auth.login',)
+
+_METHOD_NAME = re.compile(rb'<methodName>\s*([^<\s]+)\s*</methodName>')
+
+
+def _method_name(request):
+    '''Pulls the method name out of an xmlrpc request body.
+
+    :param bytes request: marshalled request
+    :returns: str
+
+    '''
+    match = _METHOD_NAME.search(request)
+    return match.group(1).decode('utf-8') if match else ''
+
+
+def _unmarshal(transport, data):
+    '''Decodes an xmlrpc response body with a transport's parser.
+
+    :param transport: :class:`xmlrpc.client.Transport` instance
+    :param bytes data: response body
+    :returns: tuple of the values returned, raises
+        :class:`xmlrpc.client.Fault` for a fault response
+
+    '''
+    parser, unmarshaller = transport.getparser()
+    parser.feed(data)
+    parser.close()
+    return unmarshaller.close()
+
+
+class _Recorder(object):
+    '''Transport mixin passing every request and response to a cassette.'''
+
+    cassette = None
+    url = None
+
+    def single_request(self, host, handler, request_body, verbose=False):
+        self._request = request_body
+        self._start = time.time()
+        return super().single_request(host, handler, request_body, verbose)
+
+    def parse_response(self, response):
+        data = response.read()
+        if response.getheader('Content-Encoding', '') == 'gzip':
+            data = gzip.decompress(data)
+        self.cassette.record(self._request, data, time.time() - self._start,
+                             self.url)
+        return _unmarshal(self, data)
+
+
+class _RecordingTransport(_Recorder, xmlrpc.client.Transport):
+    pass
+
+
+class _RecordingSafeTransport(_Recorder, xmlrpc.client.SafeTransport):
+    pass
+
+
+class _ReplayTransport(xmlrpc.client.Transport):
+    '''Transport answering requests from a cassette, nothing is sent.'''
+
+    cassette = None
+
+    def request(self, host, handler, request_body, verbose=False):
+        data, duration = self.cassette.play(request_body)
+        if duration > 0:
+            time.sleep(duration)
+        return _unmarshal(self, data)
+
+
+class Cassette(object):
+    '''Recording of the xmlrpc traffic of a session, for replaying offline.
+
+    :param str path: gzip compressed file of json lines
+    :param str mode: 'w' to record, 'r' to replay
+    :param float scale: how long replayed calls take as a multiple of how
+        long they took when recorded. 0 answers straight away
+
+    Pass a cassette as the `transport` of :class:`Spacewalk`. When recording
+    each line holds:
+
+        * `str` - **method** api method called
+        * `str` - **request** xmlrpc request body, left out for
+          `auth.login` so the password isn't kept
+        * `str` - **response** xmlrpc response body
+        * `float` - **time** seconds the call took, including the transfer
+        * `str` - **url**, **user** server and user, `auth.login` only
+
+    When replaying nothing is sent to the server. The responses are decoded
+    by the same unmarshaller so replays show the client side cost of a
+    workload without a satellite. Each request gets the response recorded
+    for an identical request, or failing that the next unused response of
+    the same method, as calls made from several threads or carrying the
+    current time won't repeat exactly. A request with neither raises
+    :class:`SpacewalkError`.
+
+    '''
+
+    def __init__(self, path, mode='r', scale=1.0):
+        '''init magic'''
+        if mode not in ('r', 'w'):
+            raise ValueError("mode must be 'r' or 'w'")
+        self.path = path
+        self.mode = mode
+        self.scale = scale
+        self.server = None
+        self.user = None
+        self._lock = threading.Lock()
+
+        if mode == 'w':
+            dirname = os.path.dirname(path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            self._fh = gzip.open(path, 'wb')
+            return
+
+        self._fh = None
+        self._entries = []
+        self._exact = collections.defaultdict(collections.deque)
+        self._by_method = collections.defaultdict(collections.deque)
+        with gzip.open(path, 'rt', encoding='utf-8') as fh:
+            for line in fh:
+                entry = json.loads(line)
+                i = len(self._entries)
+                self._entries.append(entry)
+                self._by_method[entry['method']].append(i)
+                if entry.get('request') is not None:
+                    self._exact[entry['request']].append(i)
+                if entry['method'] == 'auth.login' and self.server is None:
+                    self.server = entry.get('url')
+                    self.user = entry.get('user')
+        self._played = [False] * len(self._entries)
+
+    def __call__(self, url):
+        '''Makes a transport for a connection to url.
+
+        :param str url: api url
+        :returns: :class:`xmlrpc.client.Transport`
+
+        '''
+        if self.mode == 'r':
+            transport = _ReplayTransport()
+        elif url.startswith('https:'):
+            transport = _RecordingSafeTransport()
+        else:
+            transport = _RecordingTransport()
+        transport.cassette = self
+        transport.url = url
+        return transport
+
+    def record(self, request, response, duration, url=None):
+        '''Writes a call to the cassette.
+
+        :param bytes request: request body
+        :param bytes response: response body
+        :param float duration: seconds the call took
+        :param str url: api url the call was sent to (opt)
+
+        '''
+        method = _method_name(request)
+        entry = {'method': method, 'time': round(duration, 6),
+                 'response': response.decode('utf-8')}
+        if method in _SECRET_CALLS:
+            entry['url'] = url
+            try:
+                entry['user'] = xmlrpc.client.loads(request)[0][0]
+            except (xmlrpc.client.Error, IndexError, ValueError):
+                pass
+        else:
+            entry['request'] = request.decode('utf-8')
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+        with self._lock:
+            self._fh.write(line.encode('utf-8'))
+
+    def play(self, request):
+        '''Finds the recorded response to a request.
+
+        :param bytes request: request body
+        :returns: tuple of the response body and seconds to wait
+
+        '''
+        method = _method_name(request)
+        body = request.decode('utf-8')
+        with self._lock:
+            for queue in (self._exact.get(body), self._by_method.get(method)):
+                while queue:
+                    i = queue.popleft()
+                    if not self._played[i]:
+                        self._played[i] = True
+                        entry = self._entries[i]
+                        return (entry['response'].encode('utf-8'),
+                                entry['time'] * self.scale)
+        raise SpacewalkError("No recorded response for {m} in "
+                             "{p}".format(m=method, p=self.path))
+
+    def unplayed(self):
+        '''Counts the recorded calls not replayed yet.
+
+        :returns: int
+
+        '''
+        return self._played.count(False) if self.mode == 'r' else 0
+
+    def close(self):
+        '''Finishes the recording.'''
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+
+# struct fields wanted by the api call running on each thread, see
+# Spacewalk.api_call
+_CALL_FIELDS = threading.local()
+
+_XMLRPC_INTS = frozenset(['int', 'i4', 'i8', 'i1', 'i2', 'biginteger'])
+
+_gc_lock = threading.Lock()
+_gc_pauses = [0, False]
+
+
+@contextlib.contextmanager
+def _gc_paused():
+    '''Holds off the garbage collector while a response is decoded.
+
+    Decoding a large response makes millions of objects without a single
+    reference cycle, which would otherwise set off full collections over and
+    over. Pauses from several threads overlap, the collector is turned back
+    on once the last one ends if it was on before the first.
+
+    '''
+    with _gc_lock:
+        if not _gc_pauses[0]:
+            _gc_pauses[1] = gc.isenabled()
+            gc.disable()
+        _gc_pauses[0] += 1
+    try:
+        yield
+    finally:
+        with _gc_lock:
+            _gc_pauses[0] -= 1
+            if not _gc_pauses[0] and _gc_pauses[1]:
+                gc.enable()
+
+
+def _fast_value(elem, fields=None):
+    '''Decodes an xmlrpc <value> element.
+
+    :param elem: :class:`xml.etree.ElementTree.Element`
+    :param fields: names of the struct members to keep, in this value or
+        the items of this array. None keeps them all
+    :type fields: frozenset
+    :returns: the value as the stock unmarshaller would return it, raises
+        ValueError for anything it doesn't handle
+
+    '''
+    if elem.tag != 'value':
+        raise ValueError("expected value, found {}".format(elem.tag))
+    if not len(elem):
+        return elem.text or ''
+    node = elem[0]
+    tag = node.tag
+    if tag == 'string':
+        return node.text or ''
+    elif tag in _XMLRPC_INTS:
+        return int(node.text)
+    elif tag == 'struct':
+        rv = {}
+        for member in node:
+            name = member[0]
+            if member.tag != 'member' or name.tag != 'name':
+                raise ValueError("malformed struct member")
+            if fields is None or name.text in fields:
+                rv[name.text or ''] = _fast_value(member[1])
+        return rv
+    elif tag == 'array':
+        return [_fast_value(v, fields) for v in node[0]]
+    elif tag == 'boolean':
+        if node.text not in ('0', '1'):
+            raise ValueError("bad boolean value")
+        return node.text == '1'
+    elif tag == 'double':
+        return float(node.text)
+    elif tag == 'dateTime.iso8601':
+        return xmlrpc.client.DateTime(node.text or '')
+    elif tag == 'base64':
+        rv = xmlrpc.client.Binary()
+        rv.decode((node.text or '').encode('ascii'))
+        return rv
+    elif tag == 'nil':
+        return None
+    raise ValueError("unsupported type {}".format(tag))
+
+
+def _fast_unmarshal(data, fields=None):
+    '''Decodes an xmlrpc response body with :mod:`xml.etree.ElementTree`.
+
+    :param bytes data: response body
+    :param fields: struct members to keep, see :func:`_fast_value`
+    :returns: tuple of the values returned, raises
+        :class:`xmlrpc.client.Fault` for a fault response and ValueError or
+        :class:`xml.etree.ElementTree.ParseError` for anything unexpected
+
+    '''
+    root = xml.etree.ElementTree.fromstring(data)
+    if root.tag != 'methodResponse' or len(root) != 1:
+        raise ValueError("not an xmlrpc response")
+    body = root[0]
+    if body.tag == 'fault':
+        fault = _fast_value(body[0])
+        raise xmlrpc.client.Fault(fault['faultCode'], fault['faultString'])
+    elif body.tag != 'params':
+        raise ValueError("not an xmlrpc response")
+    return tuple(_fast_value(param[0], fields) for param in body)
+
+
+class FastTransport(xmlrpc.client.Transport):
+    '''Thread safe transport with pooled connections and a faster parser.
+
+    :param int compress: gzip request bodies bigger than this many bytes.
+        None, the default, never does as not every server accepts compressed
+        requests
+    :param float timeout: socket timeout in seconds
+    :param context: :class:`ssl.SSLContext` for https connections (opt)
+
+    Pass an instance as the `transport` of :class:`Spacewalk`. The stock
+    transport holds a single connection so a new one, and a new TLS
+    handshake, is needed for every thread, including the short lived threads
+    of each :meth:`Spacewalk.pmap`. One FastTransport is shared by every
+    thread of a session instead. Connections are kept alive once a call
+    finishes and handed to whichever thread makes the next call to that
+    server.
+
+    Responses are decoded with :mod:`xml.etree.ElementTree`, which builds
+    the document in C, with the garbage collector paused. Struct members
+    left out of the `fields` given to :meth:`Spacewalk.api_call` are skipped
+    without being decoded. Anything this parser doesn't handle goes to the
+    stock unmarshaller, which gives the same results.
+
+    '''
+
+    def __init__(self, compress=None, timeout=300, context=None):
+        '''init magic'''
+        super().__init__()
+        self.compress = compress
+        self.timeout = timeout
+        self.context = context
+        self._schemes = {}
+        self._idle = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def __call__(self, url):
+        '''Returns the transport for a connection to url.
+
+        :param str url: api url
+        :returns: this :class:`FastTransport`
+
+        '''
+        parts = urllib.parse.urlsplit(url)
+        with self._lock:
+            self._schemes[parts.netloc] = parts.scheme
+        return self
+
+    def _checkout(self, host):
+        '''Takes an idle connection to host, or makes a new one.
+
+        :param str host: host and port
+        :returns: tuple of the :class:`http.client.HTTPConnection` and
+            whether it has been used before
+
+        '''
+        with self._lock:
+            if self._idle[host]:
+                return self._idle[host].pop(), True
+            scheme = self._schemes.get(host)
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, timeout=self.timeout,
+                                               context=self.context), False
+        return http.client.HTTPConnection(host, timeout=self.timeout), False
+
+    def request(self, host, handler, request_body, verbose=False):
+        '''Sends a request and decodes the response.
+
+        :param str host: host and port
+        :param str handler: path of the api
+        :param bytes request_body: marshalled request
+        :param bool verbose: print the http traffic
+        :returns: tuple of the values returned
+
+        '''
+        headers = {'Content-Type': 'text/xml', 'User-Agent': self.user_agent,
+                   'Accept-Encoding': 'gzip'}
+        if self.compress is not None and len(request_body) > self.compress:
+            request_body = gzip.compress(request_body)
+            headers['Content-Encoding'] = 'gzip'
+
+        for attempt in range(2):
+            conn, reused = self._checkout(host)
+            conn.set_debuglevel(1 if verbose else 0)
+            try:
+                conn.request('POST', handler, request_body, headers)
+                resp = conn.getresponse()
+                data = resp.read()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError,
+                    ConnectionAbortedError, BrokenPipeError):
+                # the server closed a connection while it sat idle, any
+                # others left idle as long are likely closed too
+                conn.close()
+                if attempt or not reused:
+                    raise
+                with self._lock:
+                    stale = self._idle.pop(host, [])
+                for c in stale:
+                    c.close()
+            except BaseException:
+                conn.close()
+                raise
+
+        if resp.status != 200:
+            conn.close()
+            raise xmlrpc.client.ProtocolError(host + handler, resp.status,
+                                              resp.reason,
+                                              dict(resp.getheaders()))
+        if resp.will_close:
+            conn.close()
+        else:
+            with self._lock:
+                self._idle[host].append(conn)
+
+        if resp.getheader('Content-Encoding', '') == 'gzip':
+            data = gzip.decompress(data)
+        return self.parse_body(data)
+
+    def parse_body(self, data):
+        '''Decodes a response body, falling back to the stock unmarshaller.
+
+        :param bytes data: response body
+        :returns: tuple of the values returned
+
+        '''
+        with _gc_paused():
+            try:
+                return _fast_unmarshal(data,
+                                       getattr(_CALL_FIELDS, 'fields', None))
+            except (ValueError, TypeError, IndexError, KeyError,
+                    xml.etree.ElementTree.ParseError):
+                return _unmarshal(self, data)
+
+    def close(self):
+        '''Closes the idle connections.'''
+        with self._lock:
+            idle = [c for conns in self._idle.values() for c in conns]
+            self._idle.clear()
+        for conn in idle:
+            conn.close()
+
+
 class Spacewalk(object):
     '''parent Class for interacting with Spacewalk
 
@@ -81,6 +1224,11 @@ class Spacewalk(object):
     :param str user: username to login with
     :param str password: password to use to log in with.
     :param bool verbose: whether to use verbose xmlrpc connection.
+    :param int workers: maximum number of api calls to run concurrently.
+    :param bool persistent: keep the password so the session can be renewed
+        when it expires. Intended for long running processes such as houstond.
+    :param str journal: file to record channel content changes in, see
+        :class:`Journal`. None disables the journal.
 
     The :class:`Spacewalk` Object opens a connection to the spacewalk server,
     using `auth`_ method with the connection details provided. If it has access
@@ -99,30 +1247,78 @@ class Spacewalk(object):
     '''
 
     def __init__(self, server=None, user=None, password=None, verbose=False,
-                 conf=os.path.expanduser('~/.spw_conf')):
+                 conf=os.path.expanduser('~/.spw_conf'), workers=32,
+                 persistent=False,
+                 journal=os.path.expanduser('~/.houston/journal'),
+                 profile=None, replicas=None, rate=None, transport=None):
         '''initialises variables and connection to spacewalk.
 
+        :param str profile: section of the config file to read the server,
+            user and password from instead of [auth] (opt)
+        :param replicas: urls of read only copies of the server, such as
+            Inter-Satellite Sync slaves, to send read calls to. True uses the
+            comma seperated `replicas` from the config file (opt)
+        :type replicas: list of strings or bool
+        :param float rate: most api calls to start per second (opt)
+        :param transport: called with an api url to make the
+            :class:`xmlrpc.client.Transport` for each connection, such as a
+            :class:`Cassette`. If it has a close method that is called once
+            the session is logged out of. Defaults to the stock transport
+
+        Read calls, those that get, list, check or search, are spread across
+        the replicas and go to the server itself if a replica fails. Once
+        anything has been changed every call goes to the server so the
+        changes are always seen. Sessions with replicas=True are for commands
+        that only read, so their reads keep going to the replicas whatever
+        else is called.
+
+        Every call goes through :attr:`throttle`, a :class:`Throttle` which
+        keeps the calls in flight, from all threads, to what the server copes
+        with and to at most workers.
+
         '''
         self.verbose = verbose
+        self.journal = Journal(journal) if journal else None
+        self.workers = workers
+        self.persistent = persistent
+        self._local = threading.local()
+        self._login_lock = threading.Lock()
         self.server = ""
         self.user = ""
         self.password = ""
-
-        if not self._collect_spw_details(server, user, password, conf):
+        self.replicas = []
+        self._replica_keys = {}
+        self._next_replica = itertools.cycle([None])
+        self._wrote = False
+        self._read_only = replicas is True
+        self.throttle = Throttle(rate=rate, max_limit=workers)
+        self.transport = transport
+        self._channels = weakref.WeakValueDictionary()
+        self._channels_lock = threading.Lock()
+
+        self.profile = profile
+
+        if not self._collect_spw_details(server, user, password, conf,
+                                         profile):
             raise SpacewalkInvalidCredentials("")
 
-        if not self.server.startswith('http'):
-            self.server = 'https://{}'.format(self.server)
-
-        if not re.match('^https://', self.server):
-            re.sub('http://', 'https://', self.server)
+        self.server = _api_url(self.server)
 
-        if not self.server.endswith('/rpc/api'):
-            self.server = "/".join([self.server, 'rpc', 'api'])
+        self._login()
 
-        self._client = xmlrpc.client.Server(self.server,
-                                            verbose=self.verbose)
-        self._key = self._client.auth.login(self.user, self.password)
+        if replicas is True:
+            replicas = self._config_replicas
+        for url in replicas or []:
+            url = _api_url(url)
+            try:
+                self._replica_login(url)
+            except (xmlrpc.client.Error, OSError) as e:
+                if self.verbose:
+                    print("Not using replica {u}: {e}".format(u=url, e=e),
+                          file=sys.stderr)
+                continue
+            self.replicas.append(url)
+        self._next_replica = itertools.cycle(self.replicas or [None])
 
         calls = [c.split('_', 1)[0] for y in
                  self._client.api.get_api_call_list(self._key).values()
@@ -132,10 +1328,201 @@ class Spacewalk(object):
         # this call list allows check valid calls so no invalid callsl can
         # be made
         self._api_calllist = tuple(calls) + tuple(calls_alt)
-        # don't  need password now so lets get rid of it.
-        del(self.password)
+        if not self.persistent:
+            # the server and replicas are logged into by now, and are only
+            # logged into again if persistent, so lets get rid of it.
+            del(self.password)
+
+    def _login(self, expired_key=None):
+        '''Logs into the spacewalk server and stores the session key.
+
+        :param expired_key: session key found to have expired. If another
+            thread has already replaced it no new session is created.
+
+        '''
+        with self._login_lock:
+            if expired_key is None or expired_key == self._key:
+                self._key = self._client.auth.login(self.user, self.password)
+
+    def _replica_login(self, url, expired_key=None):
+        '''Logs into a replica and stores its session key.
+
+        :param str url: api url of the replica
+        :param expired_key: session key found to have expired (opt)
+
+        '''
+        with self._login_lock:
+            if expired_key is None or \
+                    expired_key == self._replica_keys.get(url):
+                self._replica_keys[url] = self._connection(url).auth.login(
+                    self.user, self.password)
+
+    def _connection(self, url):
+        '''xmlrpc connection to a replica for the calling thread.
+
+        :param str url: api url of the replica
+        :returns: :class:`xmlrpc.client.ServerProxy`
+
+        '''
+        try:
+            conns = self._local.replicas
+        except AttributeError:
+            conns = self._local.replicas = {}
+        if url not in conns:
+            conns[url] = self._server_proxy(url)
+        return conns[url]
+
+    def _server_proxy(self, url):
+        '''Makes an xmlrpc connection using the session's transport.
+
+        :param str url: api url
+        :returns: :class:`xmlrpc.client.ServerProxy`
+
+        '''
+        transport = self.transport(url) if self.transport else None
+        return xmlrpc.client.Server(url, transport=transport,
+                                    verbose=self.verbose)
 
-    def _collect_spw_details(self, server, user, password, conf):
+    @property
+    def _client(self):
+        '''xmlrpc connection for the calling thread.
+
+        A :class:`xmlrpc.client.ServerProxy` holds a single http connection
+        and can't be shared between threads, so each thread gets its own.
+
+        '''
+        try:
+            return self._local.client
+        except AttributeError:
+            self._local.client = self._server_proxy(self.server)
+            return self._local.client
+
+    def _cache_file(self, name):
+        '''Path of a local cache file belonging to this server.
+
+        :param str name: name of the cache
+        :returns: str ~/.houston/<server host>/<name>
+
+        '''
+        host = server_host(self.server)
+        return os.path.join(os.path.expanduser('~/.houston'),
+                            re.sub(r'[^A-Za-z0-9.-]', '_', host), name)
+
+    def pmap(self, func, iterable, workers=None):
+        '''Calls func on every item of iterable concurrently.
+
+        :param func: callable taking a single item
+        :param iterable: items to call func with
+        :param int workers: number of threads to use, defaults to
+            :attr:`workers`
+        :returns: list of results in the same order as iterable
+
+        Any exception raised by func is raised again here.
+
+        '''
+        items = list(iterable)
+        workers = workers or self.workers
+        if len(items) < 2 or workers < 2:
+            return [func(i) for i in items]
+
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            return list(pool.map(func, items))
+
+    def imap(self, func, iterable, workers=None, window=None):
+        '''Lazily calls func on every item of iterable concurrently.
+
+        :param func: callable taking a single item
+        :param iterable: items to call func with, read as they are needed
+        :param int workers: number of threads to use, defaults to
+            :attr:`workers`
+        :param int window: most calls submitted but not yet yielded,
+            defaults to twice workers
+        :returns: generator of results in the same order as iterable
+
+        Unlike :meth:`pmap` only window items are held at once, however long
+        iterable is. Stopping early cancels the calls that haven't started.
+
+        '''
+        workers = workers or self.workers
+        window = window or workers * 2
+        pending = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            try:
+                for item in iterable:
+                    pending.append(pool.submit(func, item))
+                    if len(pending) >= window:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def _iter_records(self, records, details=None):
+        '''Yields api records, optionally merged with their details.
+
+        :param records: list of dicts as returned by a list call
+        :param details: callable returning a dict of details for a record,
+            called concurrently through :meth:`imap` (opt)
+        :returns: generator of dicts
+
+        '''
+        if details is None:
+            yield from records
+        else:
+            for record, extra in self.imap(lambda r: (r, details(r)),
+                                           records):
+                yield dict(record, **extra)
+
+    def iter_systems(self, details=False):
+        '''Iterates over the systems registered with the server.
+
+        :param bool details: merge in `system.get_details` for each system,
+            fetched a few at a time as the generator is consumed
+        :returns: generator of dicts as returned by `system.list_systems`
+
+        The api has no server side paging, so the system list itself comes
+        back in one call. Only the per system calls are made lazily.
+
+        '''
+        return self._iter_records(
+            self.api_call('system', 'list_systems'),
+            (lambda s: self.api_call('system', 'get_details', s['id']))
+            if details else None)
+
+    def iter_channels(self, details=False):
+        '''Iterates over the software channels on the server.
+
+        :param bool details: merge in `channel.software.get_details` for each
+            channel, fetched a few at a time as the generator is consumed
+        :returns: generator of dicts as returned by
+            `channel.list_software_channels`
+
+        '''
+        return self._iter_records(
+            self.api_call('channel', 'list_software_channels'),
+            (lambda c: self.api_call('channel.software', 'get_details',
+                                     c['label']))
+            if details else None)
+
+    def iter_channel_packages(self, channel, latest=False, details=False):
+        '''Iterates over the packages in a channel.
+
+        :param str channel: channel label
+        :param bool latest: only the latest version of each package
+        :param bool details: merge in `packages.get_details` for each
+            package, fetched a few at a time as the generator is consumed
+        :returns: generator of package dicts
+
+        '''
+        method = 'list_latest_packages' if latest else 'list_all_packages'
+        return self._iter_records(
+            self.api_call('channel.software', method, channel),
+            (lambda p: self.api_call('packages', 'get_details', p['id']))
+            if details else None)
+
+    def _collect_spw_details(self, server, user, password, conf,
+                             profile=None):
         '''sets login details for the spacewalk server from config or
         initiates the prompt functions.
 
@@ -143,31 +1530,37 @@ class Spacewalk(object):
         :param user: user to login as
         :param password: password to use
         :param conf: Configuration file path
+        :param profile: config section to use, anything missing from it is
+            taken from [auth]
         :returns: Boolean
 
         '''
-        config = configparser.ConfigParser()
-        config.read(conf)
-        if not server and not config['auth']['server']:
+        settings = profile_settings(profile, conf)
+
+        if not server and not settings.get('server'):
             self.server = self._get_server()
         elif server:
             self.server = server
         else:
-            self.server = config['auth']['server']
+            self.server = settings['server']
 
-        if not user and not config['auth']['user']:
+        if not user and not settings.get('user'):
             self.user = self._get_user()
         elif user:
             self.user = user
         else:
-            self.user = config['auth']['user']
+            self.user = settings['user']
 
-        if not password and not config['auth']['password']:
+        if not password and not settings.get('password'):
             self.password = self._get_password()
         elif password:
             self.password = password
         else:
-            self.password = config['auth']['password']
+            self.password = settings['password']
+
+        self._config_replicas = [r.strip() for r in
+                                 settings.get('replicas', '').split(',')
+                                 if r.strip()]
 
         if not self.password and not self.server and not self.user:
             return False
@@ -181,32 +1574,7 @@ class Spacewalk(object):
         :returns: user input
 
         '''
-        if not sys.stdout.isatty():
-            raise SpacewalkError("Password not supplied.")
-
-        prompt = {
-            'password':
-            "Please enter Password for {u}:".format(u=self.user),
-            'user':
-            "Please enter username:",
-            'server':
-            "Please enter spacewalk url",
-        }
-
-        import termios
-        fd = sys.stdin.fileno()
-        old = termios.tcgetattr(fd)
-        new = termios.tcgetattr(fd)
-        if detail == "password":
-            new[3] = new[3] & ~termios.ECHO
-        try:
-            termios.tcsetattr(fd, termios.TCSADRAIN, new)
-            retval = input(prompt[detail])
-            print("")
-        finally:
-            termios.tcsetattr(fd, termios.TCSADRAIN, old)
-
-        return retval
+        return prompt_for_input(detail, self.user, self.profile)
 
     def __enter__(self):
         '''Connects to and logs into a session on the spacewalk server
@@ -226,7 +1594,16 @@ class Spacewalk(object):
         if exc_type is not None:
             pass
 
-        self.api_call('auth', 'logout')
+        for url, key in self._replica_keys.items():
+            try:
+                self._connection(url).auth.logout(key)
+            except (xmlrpc.client.Error, OSError):
+                pass
+        try:
+            self.api_call('auth', 'logout')
+        finally:
+            if hasattr(self.transport, 'close'):
+                self.transport.close()
 
     def _get_password(self):
         '''Uses _prompt_for_input to prompt for password
@@ -249,7 +1626,7 @@ class Spacewalk(object):
         '''
         return self._prompt_for_input('user')
 
-    def api_call(self, namespace, method, *args):
+    def api_call(self, namespace, method, *args, fields=None):
         '''Makes RPC call to the server.
 
         The session key will be automatically added, any other arguments must
@@ -260,6 +1637,10 @@ class Spacewalk(object):
         :param method: Method to call
         :type method: string
         :param \*args: any arguments to pass to api call
+        :param fields: names of the struct members the caller uses (opt).
+            Transports such as :class:`FastTransport` skip decoding the
+            others, but they may still be returned
+        :type fields: list of str
 
         :returns: result of api call
 
@@ -270,12 +1651,65 @@ class Spacewalk(object):
         if api not in self._api_calllist:
             raise SpacewalkAPIError("No such Api Method: {}".format(api))
 
+        self.throttle.acquire()
+        start = time.time()
+        error = None
+        _CALL_FIELDS.fields = frozenset(fields) if fields is not None \
+            else None
         try:
-            return eval('self._client.{api}'.format(api=api))(self._key, *args)
-        except xmlrpc.client.Fault as e:
-            raise SpacewalkAPIError("RPC Fault while calling {call}{args}\n"
-                                    "{err}".format(call=api, args=args,
-                                                   err=e))
+            return self._dispatch(namespace, api, args)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            _CALL_FIELDS.fields = None
+            self.throttle.release(time.time() - start, error, api)
+
+    def _dispatch(self, namespace, api, args):
+        '''Sends an api call to a replica or the server.
+
+        :param str namespace: namespace of the method to call
+        :param str api: full name of the method to call
+        :param tuple args: arguments following the session key
+        :returns: result of api call
+
+        '''
+        if namespace != 'auth' and not _READ_CALL.match(api):
+            if not self._read_only:
+                self._wrote = True
+        elif namespace != 'auth' and not self._wrote:
+            url = next(self._next_replica)
+            if url is not None:
+                for attempt in range(2):
+                    key = self._replica_keys[url]
+                    try:
+                        return getattr(self._connection(url), api)(key, *args)
+                    except xmlrpc.client.Fault as e:
+                        if attempt == 0 and self.persistent and \
+                                'session' in e.faultString.lower():
+                            try:
+                                self._replica_login(url, key)
+                                continue
+                            except (xmlrpc.client.Error, OSError):
+                                pass
+                        break
+                    except (xmlrpc.client.ProtocolError, OSError):
+                        break
+                # the replica couldn't answer, ask the server itself
+
+        for attempt in range(2):
+            key = self._key
+            try:
+                return eval('self._client.{api}'.format(api=api))(key, *args)
+            except xmlrpc.client.Fault as e:
+                if attempt == 0 and self.persistent and \
+                        'session' in e.faultString.lower():
+                    # session has timed out, log back in and try once more.
+                    self._login(key)
+                    continue
+                raise SpacewalkAPIError("RPC Fault while calling {call}{args}\n"
+                                        "{err}".format(call=api, args=args,
+                                                       err=e))
 
     def channel_exists(self, channel):
         '''checks to see if channel exists.
@@ -283,6 +1717,9 @@ class Spacewalk(object):
         :param str channel: channel label to check
         :returns: Boolean
 
+        Always asks the server, a :class:`Channel` still in use may have been
+        deleted since it was loaded.
+
         '''
         try:
             self.api_call('channel.software', 'get_details', channel)
@@ -317,15 +1754,168 @@ class Spacewalk(object):
             raise SpacewalkAPIError('System cannot be subscribed to '
                                     '{}'.format(channel))
 
-        self.api_call('system', 'set_base_channel', systemid, channel)
+        self.api_call('system', 'set_base_channel', systemid, channel)
+
+        if recurse:
+            sub_chans = [x['label'] for x in
+                         self.api_call('system',
+                                       'list_subscribable_child_channels',
+                                       systemid)]
+
+            self.api_call('system', 'set_child_channels', systemid, sub_chans)
+
+    def _schedule(self, method, sysids, *args):
+        '''Makes a list accepting `system.schedule_*` call for many systems.
+
+        :param str method: schedule method to call
+        :param sysids: ids of the systems to schedule the action on
+        :type sysids: list of ints
+        :param args: arguments following the list of system ids
+        :returns: list of action ids
+
+        The systems are split into chunks of :data:`_SCHEDULE_CHUNK_SIZE` which
+        are submitted concurrently.
+
+        '''
+        found = self.pmap(
+            lambda chunk: self.api_call('system', method, chunk, *args),
+            _chunks(sorted(set(sysids)), _SCHEDULE_CHUNK_SIZE))
+
+        actions = []
+        for rv in found:
+            # older servers return a single action id for the whole list
+            actions.extend(rv if isinstance(rv, list) else [rv])
+        return actions
+
+    def schedule_package_install(self, sysids, pkgids, earliest=None):
+        '''Schedules packages to be installed on systems.
+
+        :param sysids: ids of the systems to install the packages on
+        :type sysids: list of ints
+        :param pkgids: ids of the packages to install
+        :type pkgids: list of ints
+        :param earliest: earliest time the action may run, defaults to now
+        :type earliest: :class:`datetime.datetime`
+        :returns: list of action ids
+
+        '''
+        return self._schedule('schedule_package_install', sysids,
+                              sorted(set(pkgids)),
+                              _xmlrpc_time(earliest))
+
+    def schedule_apply_errata(self, sysids, errataids, earliest=None):
+        '''Schedules errata to be applied to systems.
+
+        :param sysids: ids of the systems to apply the errata to
+        :type sysids: list of ints
+        :param errataids: ids of the errata to apply
+        :type errataids: list of ints
+        :param earliest: earliest time the action may run, defaults to now
+        :type earliest: :class:`datetime.datetime`
+        :returns: list of action ids
+
+        '''
+        return self._schedule('schedule_apply_errata', sysids,
+                              sorted(set(errataids)),
+                              _xmlrpc_time(earliest))
+
+    def schedule_reboot(self, sysids, earliest=None):
+        '''Schedules systems to be rebooted.
+
+        :param sysids: ids of the systems to reboot
+        :type sysids: list of ints
+        :param earliest: earliest time the action may run, defaults to now
+        :type earliest: :class:`datetime.datetime`
+        :returns: list of action ids
+
+        `schedule_reboot` only accepts a single system so one call is made per
+        system, several at a time.
+
+        '''
+        when = _xmlrpc_time(earliest)
+        return self.pmap(
+            lambda sysid: self.api_call('system', 'schedule_reboot', sysid,
+                                        when),
+            sorted(set(sysids)))
+
+    def change_channels(self, sysids, base, children=None, earliest=None):
+        '''Moves systems to a base channel and some of its children.
+
+        :param sysids: ids of the systems to move
+        :type sysids: list of ints
+        :param str base: label of the new base channel
+        :param children: labels of the child channels to subscribe to, none
+            by default
+        :type children: list of str
+        :param earliest: earliest time the change may happen, defaults to now
+        :type earliest: :class:`datetime.datetime`
+        :returns: list of action ids
+
+        Servers offering the list accepting `schedule_change_channels` move
+        every system with one call per :data:`_SCHEDULE_CHUNK_SIZE` systems,
+        the change happens when each system next checks in and systems which
+        can't be moved show up as failed in the actions. Older servers change
+        the subscriptions straight away for each system, several at a time,
+        and no actions are returned. Each system is then only moved if base
+        is in its `list_subscribable_base_channels`, and is only subscribed
+        to the children in its `list_subscribable_child_channels`.
+
+        :raises SpacewalkError: naming every system which couldn't be moved,
+            after the rest have been
 
-        if recurse:
-            sub_chans = [x['label'] for x in
+        '''
+        children = sorted(set(children or []))
+        if 'system.schedule_change_channels' in self._api_calllist:
+            return self._schedule('schedule_change_channels', sysids, base,
+                                  children, _xmlrpc_time(earliest))
+
+        def change(sysid):
+            try:
+                bases = [c['label'] for c in
                          self.api_call('system',
-                                       'list_subscribable_child_channels',
-                                       systemid)]
+                                       'list_subscribable_base_channels',
+                                       sysid)]
+                if base not in bases:
+                    return "cannot be subscribed to {}".format(base)
+                self.api_call('system', 'set_base_channel', sysid, base)
+                allowed = [c['label'] for c in
+                           self.api_call('system',
+                                         'list_subscribable_child_channels',
+                                         sysid)] if children else []
+                self.api_call('system', 'set_child_channels', sysid,
+                              [c for c in children if c in allowed])
+            except SpacewalkError as e:
+                return str(e)
+
+        sysids = sorted(set(sysids))
+        problems = [(s, p) for s, p in zip(sysids, self.pmap(change, sysids))
+                    if p]
+        if problems:
+            raise SpacewalkError(
+                "{n} of {t} systems were not moved:\n  {p}".format(
+                    n=len(problems), t=len(sysids),
+                    p="\n  ".join("{s}: {p}".format(s=s, p=p)
+                                   for s, p in problems)))
+        return []
+
+    def errata_ids(self, advisories):
+        '''Looks up the ids of errata.
+
+        :param advisories: advisory names or ids
+        :type advisories: list
+        :returns: list of ints
 
-            self.api_call('system', 'set_child_channels', systemid, sub_chans)
+        '''
+        def lookup(advisory):
+            if isinstance(advisory, int) or str(advisory).isdigit():
+                return int(advisory)
+            try:
+                return self.api_call('errata', 'get_details', advisory)['id']
+            except SpacewalkAPIError:
+                raise SpacewalkError("Erratum {} cannot be "
+                                     "found".format(advisory))
+
+        return self.pmap(lookup, advisories)
 
     def lucerne_query(self, query, channels=None, keys=None):
         '''runs lucerne query on the spacewalk server
@@ -387,6 +1977,728 @@ class Spacewalk(object):
 
         return rv
 
+    def find_packages(self, spec, channels=None, channel_pkgs=None):
+        '''Finds all packages matching a package specification.
+
+        :param spec: package to look for. Either a package id, a string as
+            accepted by :func:`_parse_nvrea` or a dict with the same keys.
+        :param channels: channel labels to restrict the search to (opt)
+        :type channels: list of channel labels
+        :param set channel_pkgs: ids of the packages in channels, as returned
+            by :meth:`channel_package_ids`. Looked up when needed if not
+            given, pass it when finding many packages in the same channels.
+        :returns: list of dicts
+
+            * `int` - **id**
+            * `str` - **name**
+            * `str` - **epoch**
+            * `str` - **version**
+            * `str` - **release**
+            * `str` - **arch**
+
+        A package id is returned as is without asking the server. A fully
+        specified package is looked up with `find_by_nvrea`_, which searches
+        every channel so what it finds is filtered down to the packages in
+        channels. Anything else is searched for with :meth:`lucerne_query`
+        and filtered down to exact matches.
+
+        .. _find_by_nvrea: https://access.redhat.com/site/documentation/en-US/Red_Hat_Satellite/5.6/html/API_Overview/chap-packages.html#sect-packages-findByNvrea
+
+        '''
+        if isinstance(spec, int) or str(spec).strip().isdigit():
+            return [{'id': int(spec)}]
+
+        if isinstance(spec, str):
+            spec = _parse_nvrea(spec)
+
+        if spec.get('version') and spec.get('release') and spec.get('arch'):
+            found = self.api_call('packages', 'find_by_nvrea', spec['name'],
+                                  spec['version'], spec['release'],
+                                  spec.get('epoch') or '', spec['arch'])
+            if channels:
+                if channel_pkgs is None:
+                    channel_pkgs = self.channel_package_ids(channels)
+                found = [p for p in found if p['id'] in channel_pkgs]
+        else:
+            query = {'name': spec['name']}
+            if spec.get('version'):
+                query['version'] = spec['version']
+            found = self.lucerne_query(
+                " AND ".join('{k}:"{v}"'.format(k=k, v=v)
+                             for k, v in query.items()),
+                channels=channels)
+
+        rv = {}
+        for pkg in found:
+            pkg = {
+                'id': pkg['id'],
+                'name': pkg['name'],
+                'epoch': pkg.get('epoch') or '',
+                'version': pkg['version'],
+                'release': pkg['release'],
+                'arch': pkg.get('arch_label', pkg.get('arch')),
+            }
+            if any(spec.get(k) and spec[k] != pkg[k]
+                   for k in ['name', 'version', 'release', 'arch']):
+                continue
+            if spec.get('epoch') and spec['epoch'] != pkg['epoch']:
+                continue
+            rv[pkg['id']] = pkg
+
+        return list(rv.values())
+
+    def cached_channel(self, label):
+        '''Returns the :class:`Channel` for label if one is in use.
+
+        :param str label: channel label
+        :returns: :class:`Channel` or None
+
+        '''
+        return self._channels.get(label)
+
+    def forget_channels(self):
+        '''Drops every :class:`Channel` from the identity map.
+
+        Channels still referenced keep working but the next :class:`Channel`
+        for their label is loaded from the server again. Long running
+        sessions call this between commands so changes made outside houston
+        are seen.
+
+        '''
+        with self._channels_lock:
+            self._channels.clear()
+
+    def channel_package_ids(self, channels):
+        '''Returns the ids of every package in any of several channels.
+
+        :param channels: channel labels
+        :type channels: list of strings
+        :returns: set of ints
+
+        Channels already loaded are not asked for again, the rest are listed
+        concurrently.
+
+        '''
+        def ids(label):
+            cached = self.cached_channel(label)
+            return cached['all_pkgs'] if cached is not None else \
+                self._channel_pkgids(label)
+
+        return set().union(*self.pmap(ids, channels))
+
+    def _channel_pkgids(self, channel):
+        '''Returns the ids of all packages in a channel
+
+        :param str channel: channel label
+        :returns: list of ints
+
+        '''
+        return [p['id'] for p in self.api_call('channel.software',
+                                               'list_all_packages', channel)]
+
+    def _record(self, channel, op, **changes):
+        '''Adds an entry to the content journal, if there is one.
+
+        :param str channel: label of the channel changed
+        :param str op: name of the operation
+        :param \*\*changes: keyword args as accepted by :meth:`Journal.record`
+
+        '''
+        if self.journal is not None:
+            self.journal.record(self.server, channel, op, **changes)
+
+    def add_packages(self, channel, pkgids, existing=None):
+        '''Adds packages to a channel using as few api calls as possible.
+
+        :param str channel: label of channel to add packages to
+        :param pkgids: package ids to add
+        :type pkgids: list of ints
+        :param existing: ids of packages already in the channel. Looked up
+            if not given so only real changes are sent and journaled.
+        :type existing: list of ints
+        :returns: int number of api calls made
+
+        A :class:`Channel` in use for the channel is kept up to date, and
+        saves looking up the existing packages.
+
+        '''
+        cached = self.cached_channel(channel)
+        if existing is None:
+            existing = cached['all_pkgs'] if cached is not None else \
+                self._channel_pkgids(channel)
+        existing = set(existing)
+        pkgids = [p for p in dict.fromkeys(pkgids) if p not in existing]
+
+        calls = 0
+        for chunk in _chunks(pkgids):
+            self.api_call('channel.software', 'add_packages', channel, chunk)
+            self._record(channel, 'add_packages', pkgs_added=chunk)
+            if cached is not None:
+                cached['all_pkgs'].extend(chunk)
+            calls += 1
+
+        if cached is not None and pkgids:
+            calls += self._reload_latest(cached)
+        return calls
+
+    def remove_packages(self, channel, pkgids, existing=None):
+        '''Removes packages from a channel using as few api calls as possible.
+
+        This only removes the link between the channel and the packages, the
+        packages themselves stay on the server.
+
+        :param str channel: label of channel to remove packages from
+        :param pkgids: package ids to remove
+        :type pkgids: list of ints
+        :param existing: ids of packages in the channel. Looked up if not
+            given so only real changes are sent and journaled.
+        :type existing: list of ints
+        :returns: int number of api calls made
+
+        A :class:`Channel` in use for the channel is kept up to date, and
+        saves looking up the existing packages.
+
+        '''
+        cached = self.cached_channel(channel)
+        if existing is None:
+            existing = cached['all_pkgs'] if cached is not None else \
+                self._channel_pkgids(channel)
+        existing = set(existing)
+        pkgids = [p for p in dict.fromkeys(pkgids) if p in existing]
+
+        calls = 0
+        for chunk in _chunks(pkgids):
+            self.api_call('channel.software', 'remove_packages', channel,
+                          chunk)
+            self._record(channel, 'remove_packages', pkgs_removed=chunk)
+            calls += 1
+
+        if cached is not None and pkgids:
+            removed = set(pkgids)
+            cached['all_pkgs'] = [p for p in cached['all_pkgs']
+                                  if p not in removed]
+            calls += self._reload_latest(cached)
+        return calls
+
+    def _reload_latest(self, channel):
+        '''Works out the latest and older packages of a changed channel.
+
+        :param channel: :class:`Channel` whose **all_pkgs** is up to date
+        :returns: int number of api calls made
+
+        Adding a package can make an older version of it, and removing one
+        can make the version before it the latest, so this is asked of the
+        server with one `list_latest_packages` call.
+
+        '''
+        latest = [p['id'] for p in
+                  self.api_call('channel.software', 'list_latest_packages',
+                                channel['label'], fields=['id'])]
+        newest = set(latest)
+        channel['latest_pkgs'] = latest
+        channel['older_pkgs'] = [p for p in channel['all_pkgs']
+                                 if p not in newest]
+        return 1
+
+    def prune_channel(self, channel, keep, dry_run=False):
+        '''Removes all but the newest versions of each package in a channel.
+
+        :param str channel: channel label
+        :param int keep: number of versions of each package name and arch to
+            keep, ordered as rpm does
+        :param bool dry_run: only work out what would be removed
+        :returns: tuple (list of package dicts removed, int api calls made)
+
+        The package list takes one call and the removals are chunked, see
+        :meth:`remove_packages`. The packages stay on the server.
+
+        '''
+        pkgs = [dict(p, arch=p.get('arch', p.get('arch_label')))
+                for p in self.api_call('channel.software',
+                                       'list_all_packages', channel)]
+        pruned = prune_packages(pkgs, keep)
+        calls = 1
+        if not dry_run:
+            calls += self.remove_packages(channel,
+                                          [p['id'] for p in pruned],
+                                          existing=[p['id'] for p in pkgs])
+        return pruned, calls
+
+    def orphan_packages(self):
+        '''Lists the packages on the server that are in no channel.
+
+        :returns: list of package dicts
+
+        '''
+        return [dict(p, arch=p.get('arch', p.get('arch_label')))
+                for p in self.api_call('channel.software',
+                                       'list_packages_without_channel')]
+
+    def delete_packages(self, pkgids):
+        '''Deletes packages from the server entirely.
+
+        :param pkgids: ids of the packages to delete
+        :type pkgids: list of ints
+        :returns: int number of api calls made
+
+        The api deletes one package per call, so the calls are made
+        concurrently. Deleted packages can't be rolled back, they are
+        journaled so :meth:`rollback` can report the ones it can't put back.
+
+        '''
+        pkgids = list(dict.fromkeys(pkgids))
+        try:
+            self.pmap(lambda p: self.api_call('packages', 'remove_package',
+                                              p), pkgids)
+        finally:
+            self._record(None, 'delete_packages', pkgs_removed=pkgids)
+        return len(pkgids)
+
+    def merge_errata(self, from_channel, to_channel, advisories,
+                     existing=None):
+        '''Merges errata from one channel into another.
+
+        Any packages belonging to the errata are merged along with them.
+
+        :param str from_channel: label of channel to merge errata from
+        :param str to_channel: label of channel to merge errata into
+        :param advisories: advisory names of the errata to merge
+        :type advisories: list of strings
+        :param existing: ids of packages in to_channel before the merge.
+            Looked up if not given.
+        :type existing: list of ints
+        :returns: list of ints ids of all the packages in to_channel after
+            the merge
+
+        '''
+        cached = self.cached_channel(to_channel)
+        if existing is None:
+            existing = cached['all_pkgs'] if cached is not None else \
+                self._channel_pkgids(to_channel)
+        existing = set(existing)
+
+        for chunk in _chunks(advisories):
+            self.api_call('channel.software', 'merge_errata', from_channel,
+                          to_channel, chunk)
+
+        pkgids = self._channel_pkgids(to_channel)
+        self._record(to_channel, 'merge_errata', errata_added=advisories,
+                     pkgs_added=[p for p in pkgids if p not in existing])
+        if cached is not None:
+            cached['all_pkgs'] = list(pkgids)
+        return pkgids
+
+    def remove_errata(self, channel, advisories):
+        '''Removes errata from a channel, leaving their packages in place.
+
+        :param str channel: label of channel to remove errata from
+        :param advisories: advisory names of the errata to remove
+        :type advisories: list of strings
+        :returns: int number of api calls made
+
+        '''
+        calls = 0
+        for chunk in _chunks(advisories):
+            self.api_call('channel.software', 'remove_errata', channel,
+                          chunk, False)
+            self._record(channel, 'remove_errata', errata_removed=chunk)
+            calls += 1
+
+        cached = self.cached_channel(channel)
+        if cached is not None:
+            removed = set(advisories)
+            cached['errata_names'] = {i: n for i, n in
+                                      cached['errata_names'].items()
+                                      if n not in removed}
+            cached['errata'] = [e for e in cached['errata']
+                                if e in cached['errata_names']]
+        return calls
+
+    def clone_errata(self, advisories, channels, original=False):
+        '''Clones errata into channels with the asynchronous api calls.
+
+        :param advisories: advisory names of the errata to clone
+        :type advisories: list of strings
+        :param channels: labels of the channels to clone them into
+        :type channels: list of strings
+        :param bool original: use `clone_as_original_async`, which keeps
+            clones linked to the original errata so they show as applicable
+            to systems subscribed to the original channels
+        :returns: :class:`ErrataCloneTracker` following the clones
+
+        Errata already in a channel, or cloned into it before, are skipped.
+        The rest are sent in chunks, every chunk for every channel at once.
+        The server does the cloning in the background; wait on the tracker
+        to know when it is done.
+
+        '''
+        advisories = list(dict.fromkeys(advisories))
+        channels = list(dict.fromkeys(channels))
+        present = self.pmap(lambda c: [e['advisory_name'] for e in
+                                       self.api_call('channel.software',
+                                                     'list_errata', c)],
+                            channels)
+
+        pending = {}
+        for channel, names in zip(channels, present):
+            pending[channel] = [a for a in advisories
+                                if not any(_is_clone_of(n, a) for n in names)]
+
+        method = 'clone_as_original_async' if original else 'clone_async'
+        self.pmap(lambda job: self.api_call('errata', method, *job),
+                  [(channel, chunk) for channel, todo in pending.items()
+                   for chunk in _chunks(todo, _ERRATA_CHUNK_SIZE)])
+
+        return ErrataCloneTracker(self, pending)
+
+    def publish_errata(self, advisories, channels):
+        '''Publishes unpublished errata into channels.
+
+        :param advisories: advisory names of the errata to publish
+        :type advisories: list of strings
+        :param channels: labels of the channels to publish them into
+        :type channels: list of strings
+        :returns: int number of api calls made
+
+        The api publishes one erratum per call, into every channel at once,
+        so the calls are made concurrently.
+
+        '''
+        advisories = list(dict.fromkeys(advisories))
+        channels = list(dict.fromkeys(channels))
+        self.pmap(lambda a: self.api_call('errata', 'publish', a, channels),
+                  advisories)
+        for channel in channels:
+            self._record(channel, 'publish_errata', errata_added=advisories)
+            cached = self.cached_channel(channel)
+            if cached is not None:
+                cached.refresh()
+        return len(advisories)
+
+    def sync_activation_keys(self, desired, delete=False, adopt=False):
+        '''Brings activation keys in line with a description of them.
+
+        :param dict desired: keys mapped to dicts as accepted by
+            :meth:`ActivationKey.delta`. Keys may be given with or without
+            their org prefix.
+        :param bool delete: also delete keys that aren't in desired
+        :param bool adopt: a key in desired that doesn't exist takes over an
+            existing key not in desired with the same description and base
+            channel, rather than being created. Keys made with a random name
+            keep working this way, as keys can't be renamed.
+        :returns: dict counts of keys **created**, **adopted**, **changed**
+            and **deleted**, and of the **calls** made to list, create,
+            change and delete them
+
+        The keys are listed in one call and missing ones created. Each key
+        is then compared with its description and only what differs is
+        changed, the keys concurrently. Config channel changes take lists of
+        keys, so keys needing the same change share one call.
+
+        '''
+        listed = {}
+        for k in self.api_call('activationkey', 'list_activation_keys'):
+            listed[k['key']] = k
+            listed.setdefault(k['key'].split('-', 1)[-1], k)
+        stats = {'created': 0, 'adopted': 0, 'changed': 0, 'deleted': 0,
+                 'calls': 1}
+
+        claimed = {listed[name]['key'] for name in desired if name in listed}
+        unclaimed = [k for key, k in sorted(listed.items())
+                     if key == k['key'] and key not in claimed]
+
+        keys = []
+        for name, want in desired.items():
+            if name in listed:
+                keys.append((ActivationKey(listed[name]['key'], self,
+                                           listed[name]), want))
+                continue
+            found = next((k for k in unclaimed if
+                          k.get('description', '') ==
+                          want.get('description', '') and
+                          (k.get('base_channel_label') or '') ==
+                          (want.get('base_channel_label') or '')),
+                         None) if adopt else None
+            if found is not None:
+                unclaimed.remove(found)
+                keys.append((ActivationKey(found['key'], self, found), want))
+                stats['adopted'] += 1
+                continue
+            created = self.api_call(
+                'activationkey', 'create',
+                re.sub(r'^[0-9]+-', '', name), want.get('description', ''),
+                want.get('base_channel_label', ''),
+                want.get('entitlements', []),
+                want.get('universal_default', False))
+            stats['created'] += 1
+            stats['calls'] += 1
+            keys.append((ActivationKey(created, self), want))
+
+        deltas = self.pmap(lambda kw: kw[0].delta(kw[1]), keys)
+        calls = self.pmap(lambda kd: kd[0].apply(kd[1], config=False),
+                          [(key, delta) for (key, want), delta in
+                           zip(keys, deltas)])
+        stats['calls'] += sum(calls)
+
+        batches = collections.defaultdict(list)
+        for (key, want), delta in zip(keys, deltas):
+            if delta['remove_config']:
+                batches[('remove_config_channels',
+                         tuple(delta['remove_config']))].append(key['key'])
+            if delta['add_config']:
+                batches[('add_config_channels',
+                         tuple(delta['add_config']))].append(key['key'])
+            if delta['set_config'] is not None:
+                batches[('set_config_channels',
+                         tuple(delta['set_config']))].append(key['key'])
+        for (method, labels), names in batches.items():
+            extra = (False,) if method == 'add_config_channels' else ()
+            for chunk in _chunks(names):
+                self.api_call('activationkey', method, chunk, list(labels),
+                              *extra)
+                stats['calls'] += 1
+
+        for made, delta in zip(calls, deltas):
+            if made or delta['add_config'] or delta['remove_config'] or \
+                    delta['set_config'] is not None:
+                stats['changed'] += 1
+
+        if delete:
+            wanted = {k['key'] for k, w in keys}
+            extra = sorted({k['key'] for k in listed.values()} - wanted)
+            self.pmap(lambda k: self.api_call('activationkey', 'delete', k),
+                      extra)
+            stats['deleted'] = len(extra)
+            stats['calls'] += len(extra)
+
+        return stats
+
+    def create_channel(self, details):
+        '''Creates an empty software channel.
+
+        :param dict details: channel details as returned by get_details,
+            label, name, summary, arch_label, parent_channel_label and
+            checksum_label are used.
+        :returns: int 1 on success
+
+        '''
+        if not details.get('arch_label'):
+            raise SpacewalkError("No arch_label to create channel {} "
+                                 "with".format(details['label']))
+        ret = self.api_call('channel.software', 'create', details['label'],
+                            details['name'], details['summary'],
+                            details['arch_label'],
+                            details.get('parent_channel_label') or '',
+                            details.get('checksum_label') or 'sha256')
+        self._record(details['label'], 'create', details=details)
+        return ret
+
+    def delete_channel(self, channel, details=None, pkgids=None,
+                       advisories=None):
+        '''Deletes a software channel.
+
+        :param str channel: label of channel to delete
+        :param dict details: channel details, looked up if not given
+        :param pkgids: ids of the packages in the channel, looked up if not
+            given
+        :param advisories: advisory names of the errata in the channel,
+            looked up if not given
+        :returns: int 1 on success
+
+        The details and contents are only needed for the journal, so nothing
+        is looked up if there isn't one.
+
+        '''
+        if self.journal is not None:
+            if details is None:
+                details = self.api_call('channel.software', 'get_details',
+                                        channel)
+            if pkgids is None:
+                pkgids = self._channel_pkgids(channel)
+            if advisories is None:
+                advisories = [e['advisory_name'] for e in
+                              self.api_call('channel.software',
+                                            'list_errata', channel)]
+
+        ret = self.api_call('channel.software', 'delete', channel)
+        with self._channels_lock:
+            self._channels.pop(channel, None)
+        self._record(channel, 'delete', details=details,
+                     pkgs_removed=pkgids or [],
+                     errata_removed=advisories or [])
+        return ret
+
+    def rollback(self, since, channels=None, dry_run=False):
+        '''Undoes the journaled changes made to channels since a given time.
+
+        :param float since: time to roll back to, as returned by time.time()
+        :param channels: only roll back these channel labels (opt)
+        :type channels: list of strings
+        :param bool dry_run: only work out what would be done
+        :returns: list of tuples (channel label, operation, number of items)
+
+        Channels deleted since are created again, channels created since are
+        deleted and every other channel has the net change in packages and
+        errata reversed, each with chunked list accepting calls. A channel's
+        package list is looked up at most once. Errata can only be put back
+        by merging them from the channel's clone original, so each removed
+        clone is put back as the erratum it was cloned from there. Packages
+        since deleted from the server can't be put back and are reported
+        as **pkgs_not_restored**.
+
+        The rollback is journaled like any other change so it can itself be
+        rolled back.
+
+        '''
+        if self.journal is None:
+            raise SpacewalkError("No journal to roll back from.")
+
+        changes = self.journal.changes_since(self.server, since)
+        if channels:
+            changes = collections.OrderedDict(
+                (l, c) for l, c in changes.items() if l in channels)
+
+        gone = self.journal.deleted_packages(self.server, since)
+        done = []
+
+        def do(label, op, count, func, *args):
+            done.append((label, op, count))
+            if not dry_run:
+                func(*args)
+
+        # parents have to exist before their children can be created
+        deleted = [(l, c['deleted']) for l, c in changes.items()
+                   if c['deleted'] and not c['created']]
+        deleted.sort(key=lambda d: bool(d[1].get('parent_channel_label')))
+        for label, details in deleted:
+            do(label, 'create', 1, self.create_channel, details)
+
+        for label, c in changes.items():
+            if c['created']:
+                continue
+            restore = sorted(c['pkgs_removed'] - gone)
+            existing = [] if c['deleted'] else None
+            if existing is None and restore and c['pkgs_added'] \
+                    and not dry_run and self.cached_channel(label) is None:
+                # the packages being removed were there before the adds
+                existing = self._channel_pkgids(label)
+
+            if restore:
+                do(label, 'add_packages', len(restore),
+                   self.add_packages, label, restore, existing)
+            if len(restore) < len(c['pkgs_removed']):
+                done.append((label, 'pkgs_not_restored',
+                             len(c['pkgs_removed']) - len(restore)))
+            if c['pkgs_added'] and not c['deleted']:
+                do(label, 'remove_packages', len(c['pkgs_added']),
+                   self.remove_packages, label, sorted(c['pkgs_added']),
+                   existing)
+            if c['errata_added'] and not c['deleted']:
+                do(label, 'remove_errata', len(c['errata_added']),
+                   self.remove_errata, label, sorted(c['errata_added']))
+            if c['errata_removed']:
+                details = c['deleted'] or \
+                    self.api_call('channel.software', 'get_details', label)
+                source = details.get('clone_original')
+                originals = {}
+                if source:
+                    names = [e['advisory_name'] for e in
+                             self.api_call('channel.software', 'list_errata',
+                                           source)]
+                    for removed in c['errata_removed']:
+                        original = removed if removed in names else next(
+                            (n for n in names if _is_clone_of(removed, n)),
+                            None)
+                        if original is not None:
+                            originals[removed] = original
+                if originals:
+                    do(label, 'merge_errata', len(originals),
+                       self.merge_errata, source, label,
+                       sorted(set(originals.values())))
+                if len(originals) < len(c['errata_removed']):
+                    done.append((label, 'errata_not_restored',
+                                 len(c['errata_removed']) - len(originals)))
+
+        # children have to go before their parents
+        created = [l for l, c in changes.items()
+                   if c['created'] and not c['deleted']]
+        parents = {l: self.api_call('channel.software', 'get_details',
+                                    l).get('parent_channel_label')
+                   for l in created}
+        for label in sorted(created, key=lambda l: not parents[l]):
+            do(label, 'delete', 1, self.delete_channel, label)
+
+        return done
+
+
+# Channel snapshot file format, see :meth:`Channel.to_snapshot`.
+_SNAPSHOT_MAGIC = b'HOUSTON\x00'
+_SNAPSHOT_VERSION = 1
+_SNAPSHOT_HEADER = struct.Struct('<8sHHIQ')
+
+# channel keys that are stored in the id table rather than with the details.
+_SNAPSHOT_LISTS = ('latest_pkgs', 'older_pkgs', 'all_pkgs', 'errata',
+                   'errata_names', 'systems', 'repos', 'children', 'nvrea')
+
+
+class _SnapshotPackages(collections.abc.Mapping):
+    '''Read only mapping of package id to NVREA for a channel snapshot.
+
+    :param ids: sorted package ids
+    :type ids: memoryview of unsigned 64 bit ints
+    :param list nvrea: (name, epoch, version, release, arch) lists in the
+        same order as ids
+
+    Lookups are a binary search of ids, so the mapping costs nothing to
+    build however many packages the snapshot holds.
+
+    '''
+
+    def __init__(self, ids, nvrea):
+        '''init magic'''
+        self._ids = ids
+        self._nvrea = nvrea
+
+    def __getitem__(self, pkgid):
+        i = bisect.bisect_left(self._ids, pkgid)
+        if i == len(self._ids) or self._ids[i] != pkgid:
+            raise KeyError(pkgid)
+        return tuple(self._nvrea[i])
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+
+def _pkg_nvrea(pkg):
+    '''Returns the (name, epoch, version, release, arch) of a package dict.
+
+    :param dict pkg: package as returned by `list_all_packages`
+    :returns: tuple
+
+    '''
+    return (pkg['name'], pkg.get('epoch') or '', pkg['version'],
+            pkg['release'], pkg.get('arch_label', pkg.get('arch')))
+
+
+def _snapshot_ids(buf, offset, count):
+    '''Returns count unsigned 64 bit ints from a snapshot id table.
+
+    :param buf: memoryview of the id table
+    :param int offset: index of the first id
+    :param int count: number of ids
+    :returns: memoryview, or a list on big endian machines
+
+    '''
+    view = buf[offset * 8:(offset + count) * 8]
+    if sys.byteorder == 'little':
+        return view.cast('Q')
+    ids = array.array('Q', view)
+    ids.byteswap()
+    return ids.tolist()
+
 
 class Channel(collections.UserDict):
     '''Object representing the state of a channel
@@ -402,6 +2714,7 @@ class Channel(collections.UserDict):
 
     keys:
 
+        * `string` - **arch_label**
         * `string` - **arch_name**
         * `string` - **checksum_label**
         * `string` - **clone_original**
@@ -429,23 +2742,58 @@ class Channel(collections.UserDict):
             * :class:`Channel` object
         * `list` - **errata** all errata assigned to the channel
             * `int` **id** - Errata ID.
+        * `dict` - **errata_names** advisory names of the channel errata
+            * `int` **id** - `str` advisory name
         * `list` - **latest_packages** Latest versions of packages in the channel
             * `int` - **pkgid**
         * `list` - **older_packages** Older versions of packages in the channel
             * `int` - **pkgid**
         * `list` - **repos**
                 * `label` - **label**
+        * `dict` - **nvrea** package id to (name, epoch, version, release,
+          arch) of the packages in the channel when it was loaded
 
     '''
 
-    def __init__(self, label, spw):
-        '''Init  magic.'''
+    def __new__(cls, label, spw):
+        '''Returns the channel already in use for label, if there is one.
+
+        Each :class:`Spacewalk` session keeps a weak map of the channels built
+        with it, so a channel is only fetched once however many times it is
+        asked for while it is in use. Use :meth:`refresh` to load it again.
+
+        '''
+        self = spw.cached_channel(label)
+        if self is not None:
+            return self
+
+        self = super().__new__(cls)
         self.__spw__ = spw
         self.__ns__ = 'channel.software'
-        self._api = lambda meth, *args: self.__spw__.api_call(self.__ns__,
-                                                              meth,
-                                                              *args)
+        self.data = {}
+        self._load(label)
+
+        with spw._channels_lock:
+            return spw._channels.setdefault(label, self)
 
+    def __init__(self, label, spw):
+        '''Init  magic. Everything is loaded by :meth:`__new__`.'''
+
+    def refresh(self):
+        '''Loads the channel from the server again.
+
+        :returns: :class:`Channel` self
+
+        '''
+        self._load(self.data['label'])
+        return self
+
+    def _load(self, label):
+        '''Fetches the channel details and contents.
+
+        :param str label: label of the channel
+
+        '''
         self.data = {}
         self.update(self._api('get_details', label))
 
@@ -455,12 +2803,18 @@ class Channel(collections.UserDict):
             self._api('is_globally_subscribable', self.data['label'])
         self.data['latest_pkgs'] = [p['id']
                                     for p in self._api('list_latest_packages',
-                                                       self.data['label'])]
-
-        self.data['older_pkgs'] = [p['id']
-                                   for p in self._api('list_all_packages',
-                                                      self.data['label'])
-                                   if p['id'] not in self.data['latest_pkgs']]
+                                                       self.data['label'],
+                                                       fields=['id'])]
+
+        latest = set(self.data['latest_pkgs'])
+        self.data['nvrea'] = {p['id']: _pkg_nvrea(p) for p in
+                              self._api('list_all_packages',
+                                        self.data['label'],
+                                        fields=['id', 'name', 'epoch',
+                                                'version', 'release',
+                                                'arch_label'])}
+        self.data['older_pkgs'] = [p for p in self.data['nvrea']
+                                   if p not in latest]
 
         self.data['all_pkgs'] = []
         self.data['all_pkgs'].extend(self.data['latest_pkgs'] +
@@ -468,28 +2822,138 @@ class Channel(collections.UserDict):
 
         self.data['repos'] = [r['label']
                               for r in self._api('list_channel_repos',
-                                                 self.data['label'])]
-        self.data['children'] = [Channel(x['label'], spw) for x in
+                                                 self.data['label'],
+                                                 fields=['label'])]
+        self.data['children'] = [Channel(x['label'], self.__spw__) for x in
                                  self._api('list_children',
-                                           self.data['label'])]
-        self.data['errata'] = [e['id']
-                               for e in self._api('list_errata',
-                                                  self.data['label'])]
+                                           self.data['label'],
+                                           fields=['label'])]
+        errata = self._api('list_errata', self.data['label'],
+                           fields=['id', 'advisory_name'])
+        self.data['errata'] = [e['id'] for e in errata]
+        self.data['errata_names'] = {e['id']: e['advisory_name']
+                                     for e in errata}
         self.data['systems'] = [s['id']
                                 for s in self._api('list_subscribed_systems',
-                                                   self.data['label'])]
+                                                   self.data['label'],
+                                                   fields=['id'])]
 
     def add_pkg(self, pkgids):
-        '''Adds packages to the given channels
+        '''Adds packages to the channel
+
+        Large lists are split into chunks so a single call does not time out.
 
-        :param pkgids: Package id's to add to channels
+        :param pkgids: Package id's to add to the channel
         :type pkgids: list of ints
-        :param channels): Channel labels of channels to add packages to
-        :type channels): list of strings
-        :returns: Bool
+        :returns: int number of api calls made
+
+        '''
+        return self.__spw__.add_packages(self.data['label'], pkgids,
+                                         self.data['all_pkgs'])
+
+    def remove_pkg(self, pkgids):
+        '''Removes packages from the channel
+
+        :param pkgids: Package id's to remove from the channel
+        :type pkgids: list of ints
+        :returns: int number of api calls made
+
+        '''
+        return self.__spw__.remove_packages(self.data['label'],
+                                            sorted(set(pkgids)),
+                                            self.data['all_pkgs'])
+
+    def merge_errata(self, other, errataids):
+        '''Merges errata from another channel into this one.
+
+        :param other: channel to merge errata from
+        :type other: :class:`Channel`
+        :param errataids: ids of the errata to merge, must be in other
+        :type errataids: list of ints
+        :returns: int number of api calls made
+
+        '''
+        names = [other['errata_names'][e] for e in errataids]
+        self.__spw__.merge_errata(other['label'], self.data['label'], names,
+                                  self.data['all_pkgs'])
+        calls = len(list(_chunks(names)))
+        for e in errataids:
+            if e not in self.data['errata_names']:
+                self.data['errata'].append(e)
+                self.data['errata_names'][e] = other['errata_names'][e]
+        return calls
+
+    def delta(self, other):
+        '''Works out what needs to change to make other match this channel.
+
+        :param other: channel to compare against
+        :type other: :class:`Channel`
+        :returns: dict
+            * `list` - **add_pkgs** package ids missing from other
+            * `list` - **remove_pkgs** package ids only found in other
+            * `list` - **errata** errata ids missing from other
+            * `list` - **errata_remove** advisory names only found in other
+
+        Errata are matched by advisory name, so an erratum and a clone of
+        it, e.g. RHSA-2014:0376 and CLA-2014:0376, count as the same.
 
         '''
-        self._api('add_packages', self.data['label'], pkgids)
+        mine = set(self.data['all_pkgs'])
+        theirs = set(other['all_pkgs'])
+
+        def by_number(names):
+            found = collections.defaultdict(list)
+            for name in names:
+                found[name.split('-', 1)[-1]].append(name)
+            return found
+
+        def matched(name, names):
+            return any(_is_clone_of(name, n) or _is_clone_of(n, name)
+                       for n in names.get(name.split('-', 1)[-1], ()))
+
+        my_names = by_number(self.data['errata_names'].values())
+        their_names = by_number(other['errata_names'].values())
+
+        return {
+            'add_pkgs': sorted(mine - theirs),
+            'remove_pkgs': sorted(theirs - mine),
+            'errata': [e for e in self.data['errata']
+                       if not matched(self.data['errata_names'][e],
+                                      their_names)],
+            'errata_remove': sorted(n for n in other['errata_names'].values()
+                                    if not matched(n, my_names)),
+        }
+
+    def promote(self, other):
+        '''Makes other channel match this one by pushing only the changes.
+
+        Errata are merged first as this brings their packages along with
+        them, any packages still missing are then added. Errata which are
+        not in this channel are removed, then the packages which are not.
+
+        :param other: channel to promote into
+        :type other: :class:`Channel`
+        :returns: dict as returned from :meth:`delta` with the additional key
+            * `int` - **calls** number of write calls made
+
+        '''
+        delta = self.delta(other)
+        calls = 0
+
+        if delta['errata']:
+            # merging errata pulls in some of the packages as well, so work
+            # out what's left afterwards.
+            calls += other.merge_errata(self, delta['errata'])
+
+        remaining = self.delta(other)
+        calls += other.add_pkg(remaining['add_pkgs'])
+        if delta['errata_remove']:
+            calls += self.__spw__.remove_errata(other['label'],
+                                                delta['errata_remove'])
+        calls += other.remove_pkg(remaining['remove_pkgs'])
+
+        delta['calls'] = calls
+        return delta
 
     def delete(self):
         '''deletes specified channel
@@ -499,7 +2963,12 @@ class Channel(collections.UserDict):
 
         '''
         try:
-            self._api('delete', self.data['label'])
+            self.__spw__.delete_channel(
+                self.data['label'],
+                details={k: v for k, v in self.data.items()
+                         if k not in _SNAPSHOT_LISTS},
+                pkgids=list(self.data['all_pkgs']),
+                advisories=list(self.data['errata_names'].values()))
         except Exception as e:
             raise SpacewalkError("Error: Unable to remove channel \
                                  {c}: {err}".format(c=self.data['label'],
@@ -536,8 +3005,186 @@ class Channel(collections.UserDict):
         except Exception as e:
             raise SpacewalkError("Error: Unable to clone channel: {c}\n"
                                  "{err}".format(c=self.data['name'], err=e))
-        else:
-            return ret
+
+        if self.__spw__.journal is not None:
+            self.__spw__._record(
+                new_channel['label'], 'clone',
+                pkgs_added=self.__spw__._channel_pkgids(new_channel['label']),
+                errata_added=[e['advisory_name'] for e in
+                              self._api('list_errata', new_channel['label'])])
+        return ret
+
+    def _tree(self):
+        '''Yields this channel followed by all its children
+
+        :returns: generator of :class:`Channel`
+
+        '''
+        yield self
+        for child in self.data['children']:
+            yield from child._tree()
+
+    def to_snapshot(self, path):
+        '''Saves the channel and its children to a snapshot file.
+
+        :param str path: file to write
+        :returns: int number of channels saved
+
+        The file starts with a fixed header::
+
+            magic (8 bytes) | version (u16) | flags (u16) |
+            meta length (u32) | id count (u64)
+
+        followed by zlib compressed json holding the channel details, repos,
+        children, errata names and the NVREA of every package, then a table of
+        little endian unsigned 64 bit ids aligned to 8 bytes. The id table
+        holds each channel's package, errata and system ids and is left
+        uncompressed so :meth:`from_snapshot` can use it straight from the
+        mapped file without copying.
+
+        '''
+        channels = list(self._tree())
+        pkgs = {}
+        # packages added since a channel was loaded have to be looked up
+        stale = [c for c in channels
+                 if any(p not in c['nvrea'] for p in c['all_pkgs'])]
+        for c in channels:
+            pkgs.update((p, list(c['nvrea'][p])) for p in c['all_pkgs']
+                        if p in c['nvrea'])
+        for found in self.__spw__.pmap(
+                lambda c: c._api('list_all_packages', c['label']), stale):
+            pkgs.update((p['id'], list(_pkg_nvrea(p))) for p in found)
+
+        table = array.array('Q')
+        pkgids = sorted(pkgs)
+        meta = {
+            'created': int(time.time()),
+            'server': self.__spw__.server,
+            'root': self.data['label'],
+            'pkgs': [0, len(pkgids)],
+            'nvrea': [pkgs[p] for p in pkgids],
+            'channels': [],
+        }
+        table.extend(pkgids)
+
+        for c in channels:
+            entry = {
+                'details': {k: v for k, v in c.items()
+                            if k not in _SNAPSHOT_LISTS},
+                'repos': c['repos'],
+                'children': [x['label'] for x in c['children']],
+                'errata_names': [c['errata_names'].get(e)
+                                 for e in c['errata']],
+            }
+            for key in ['all_pkgs', 'errata', 'systems']:
+                entry[key] = [len(table), len(c[key])]
+                table.extend(c[key])
+            meta['channels'].append(entry)
+
+        compressed = zlib.compress(json.dumps(meta, default=str,
+                                              separators=(',', ':')).encode(),
+                                   9)
+        if sys.byteorder != 'little':
+            table.byteswap()
+
+        header = _SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, _SNAPSHOT_VERSION, 0,
+                                       len(compressed), len(table))
+        padding = -(len(header) + len(compressed)) % 8
+
+        tmp = '{}.tmp'.format(path)
+        with open(tmp, 'wb') as fh:
+            fh.write(header)
+            fh.write(compressed)
+            fh.write(b'\0' * padding)
+            table.tofile(fh)
+        os.replace(tmp, path)
+
+        return len(channels)
+
+    @classmethod
+    def from_snapshot(cls, path):
+        '''Loads a channel and its children from a snapshot file.
+
+        :param str path: file written by :meth:`to_snapshot`
+        :returns: :class:`Channel`
+
+        The returned channels have the same keys as live ones, plus **nvrea**
+        mapping package ids to (name, epoch, version, release, arch). Package,
+        errata and system id lists are read only views of the mapped file
+        rather than lists. The latest packages are worked out from the
+        versions of the packages, the newest of each name and arch. Snapshot
+        channels have no server connection so any method needing one raises
+        :class:`SpacewalkError`.
+
+        '''
+        with open(path, 'rb') as fh:
+            try:
+                mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise SpacewalkError("Empty snapshot: {}".format(path))
+
+        buf = memoryview(mapped)
+        if len(buf) < _SNAPSHOT_HEADER.size:
+            raise SpacewalkError("Not a houston snapshot: {}".format(path))
+        magic, version, flags, meta_len, count = \
+            _SNAPSHOT_HEADER.unpack_from(buf)
+        if magic != _SNAPSHOT_MAGIC:
+            raise SpacewalkError("Not a houston snapshot: {}".format(path))
+        if version > _SNAPSHOT_VERSION:
+            raise SpacewalkError("Snapshot {p} is version {v}, only up to "
+                                 "{s} is supported".format(
+                                     p=path, v=version, s=_SNAPSHOT_VERSION))
+
+        start = _SNAPSHOT_HEADER.size
+        meta = json.loads(zlib.decompress(buf[start:start + meta_len]))
+        start += meta_len
+        start += -start % 8
+        table = buf[start:start + count * 8]
+
+        nvrea = _SnapshotPackages(_snapshot_ids(table, *meta['pkgs']),
+                                  meta['nvrea'])
+
+        channels = {}
+        for entry in meta['channels']:
+            # snapshot channels stay out of the identity map
+            c = object.__new__(cls)
+            c.__spw__ = None
+            c.__ns__ = 'channel.software'
+            c.data = dict(entry['details'])
+            c.data['all_pkgs'] = _snapshot_ids(table, *entry['all_pkgs'])
+            latest = {p['id'] for p in latest_packages(
+                [dict(zip(('name', 'epoch', 'version', 'release', 'arch'),
+                          nvrea[p]), id=p) for p in c.data['all_pkgs']])}
+            c.data['latest_pkgs'] = [p for p in c.data['all_pkgs']
+                                     if p in latest]
+            c.data['older_pkgs'] = [p for p in c.data['all_pkgs']
+                                    if p not in latest]
+            c.data['errata'] = _snapshot_ids(table, *entry['errata'])
+            c.data['errata_names'] = dict(zip(c.data['errata'],
+                                              entry['errata_names']))
+            c.data['systems'] = _snapshot_ids(table, *entry['systems'])
+            c.data['repos'] = entry['repos']
+            c.data['nvrea'] = nvrea
+            c.data['children'] = entry['children']
+            channels[c.data['label']] = c
+
+        for c in channels.values():
+            c.data['children'] = [channels[x] for x in c.data['children']]
+
+        return channels[meta['root']]
+
+    def _api(self, method, *args, **kwargs):
+        '''Makes a `channel.software` call for this channel.
+
+        A method rather than a lambda stored on the instance, which would
+        keep the channel alive past its last use and in the identity map.
+
+        '''
+        if self.__spw__ is None:
+            raise SpacewalkError("Channel {} was loaded from a snapshot and "
+                                 "has no server connection".format(
+                                     self.data['label']))
+        return self.__spw__.api_call(self.__ns__, method, *args, **kwargs)
 
 
 class Repo(collections.UserDict):
@@ -545,14 +3192,592 @@ class Repo(collections.UserDict):
 
     def __init__(self, label, spw):
         '''init magic'''
-        self.data = {}
+        self.data = {}
+        self.__spw__ = spw
+        self.__ns__ = 'channel.software'
+        self._api = lambda m, *a: self.__spw__.api_call(self.__ns__, m, *a)
+
+        self.data.update(self._api('get_repo_details', label))
+        self.data['filters'] = self._api('list_repo_filters',
+                                         self.data['label'])
+
+
+# activation key details set with set_details, and what an unset value means
+_AKEY_DETAILS = {
+    'description': '',
+    'base_channel_label': '',
+    'usage_limit': 0,
+    'universal_default': False,
+    'disabled': False,
+    'contact_method': 'default',
+}
+
+
+def _akey_package(pkg):
+    '''Turns a package name, 'name.arch' or dict into a (name, arch) tuple.'''
+    if isinstance(pkg, dict):
+        return (pkg['name'], pkg.get('arch') or None)
+    name, _, arch = pkg.rpartition('.')
+    if name and arch in _RPM_ARCHES:
+        return (name, arch)
+    return (pkg, None)
+
+
+class ActivationKey(collections.UserDict):
+    '''Object representation of an activation key.
+
+    :param str key: the key, including its org prefix, e.g. 1-centos64
+    :param spw: :class:`Spacewalk` instance
+    :param dict details: details as returned by `list_activation_keys`, to
+        save fetching them again (opt)
+
+    The details are fetched with `get_details` the first time they are
+    needed, and the config channels with `list_config_channels`, so keys
+    listed in bulk cost nothing more until they are changed.
+
+    keys:
+        * `str` - **key**
+        * `str` - **description**
+        * `str` - **base_channel_label**
+        * `list` - **child_channel_labels**
+        * `list` - **entitlements**
+        * `list` - **server_group_ids**
+        * `list` - **packages** dicts of name and, optionally, arch
+        * `list` - **config_channels** config channel labels, in rank order
+
+    '''
+
+    def __init__(self, key, spw, details=None):
+        '''init magic'''
+        self.data = dict(details or {}, key=key)
+        self.__spw__ = spw
+        self.__ns__ = 'activationkey'
+        self._api = lambda m, *a: self.__spw__.api_call(self.__ns__, m, *a)
+        self._details = details is not None
+
+    def __missing__(self, key):
+        '''Fetches the details or config channels on first access.'''
+        if key == 'config_channels':
+            self.data[key] = [c['label'] for c in
+                              self._api('list_config_channels',
+                                        self.data['key'])]
+        elif not self._details:
+            self.data.update((k, v) for k, v in
+                             self._api('get_details', self.data['key']).items()
+                             if k != 'key')
+            self._details = True
+        if key not in self.data:
+            raise KeyError(key)
+        return self.data[key]
+
+    def _current(self, field, unset):
+        '''Returns a detail of the key, or unset if the server left it out.'''
+        try:
+            return self[field]
+        except KeyError:
+            return unset
+
+    def _packages(self):
+        '''Returns the key's packages as a set of (name, arch) tuples.'''
+        pkgs = self._current('packages', None)
+        if pkgs is None:
+            pkgs = self._current('package_names', [])
+        return {_akey_package(p) for p in pkgs}
+
+    def delta(self, desired):
+        '''Works out what has to change to make the key match desired.
+
+        :param dict desired: any of the keys of :data:`_AKEY_DETAILS`, and
+            lists of **child_channel_labels**, **entitlements**,
+            **server_group_ids**, **packages** (names, 'name.arch' strings or
+            dicts) and **config_channels**. Anything left out is not changed.
+        :returns: dict
+
+            * `dict` - **details** changed details for `set_details`
+            * `list` - **add_<what>** and **remove_<what>** for each of
+              children, entitlements, groups and packages
+            * `list` - **add_config**, **remove_config** config channels
+              to add to the end of the list and to remove
+            * `list` - **set_config** the full config channel list when
+              adding and removing can't get the order right, otherwise None
+
+        '''
+        delta = {'details': {}, 'set_config': None}
+        for field, unset in _AKEY_DETAILS.items():
+            if field in desired and (self._current(field, unset) or unset) \
+                    != (desired[field] or unset):
+                delta['details'][field] = desired[field] or unset
+
+        for name, field in [('children', 'child_channel_labels'),
+                            ('entitlements', 'entitlements'),
+                            ('groups', 'server_group_ids')]:
+            have = set(self._current(field, [])) if field in desired \
+                else set()
+            if name == 'children' and \
+                    'base_channel_label' in delta['details']:
+                # the server drops the children when the base changes
+                have = set()
+            want = set(desired.get(field, have))
+            delta['add_' + name] = sorted(want - have)
+            delta['remove_' + name] = sorted(have - want)
+
+        if 'packages' in desired:
+            have = self._packages()
+            want = {_akey_package(p) for p in desired['packages']}
+        else:
+            have = want = set()
+        delta['add_packages'] = [dict(name=n, **({'arch': a} if a else {}))
+                                 for n, a in sorted(want - have,
+                                                    key=str)]
+        delta['remove_packages'] = [dict(name=n, **({'arch': a} if a else {}))
+                                    for n, a in sorted(have - want,
+                                                       key=str)]
+
+        delta['add_config'] = delta['remove_config'] = []
+        if 'config_channels' in desired:
+            have = self['config_channels']
+            want = list(dict.fromkeys(desired['config_channels']))
+            remove = [c for c in have if c not in want]
+            kept = [c for c in have if c in want]
+            add = [c for c in want if c not in have]
+            if kept + add == want:
+                delta['add_config'], delta['remove_config'] = add, remove
+            elif have != want:
+                delta['set_config'] = want
+        return delta
+
+    def apply(self, delta, config=True):
+        '''Makes the changes worked out by :meth:`delta`.
+
+        :param dict delta: as returned by :meth:`delta`
+        :param bool config: also change the config channels. Off when the
+            caller batches those across keys itself
+        :returns: int number of api calls made
+
+        Each kind of change is a single call taking a list, and nothing is
+        sent for kinds with no changes.
+
+        '''
+        key = self.data['key']
+        calls = []
+        # details go first, changing the base channel drops the children
+        if delta['details']:
+            details = dict(delta['details'])
+            if 'usage_limit' in details and not details['usage_limit']:
+                del details['usage_limit']
+                details['unlimited_usage_limit'] = True
+            calls.append(('set_details', key, details))
+        for name, method in [('children', '{}_child_channels'),
+                             ('entitlements', '{}_entitlements'),
+                             ('groups', '{}_server_groups'),
+                             ('packages', '{}_packages')]:
+            for op in ['remove', 'add']:
+                if delta['{o}_{n}'.format(o=op, n=name)]:
+                    calls.append((method.format(op), key,
+                                  delta['{o}_{n}'.format(o=op, n=name)]))
+        if config:
+            if delta['remove_config']:
+                calls.append(('remove_config_channels', [key],
+                              delta['remove_config']))
+            if delta['add_config']:
+                calls.append(('add_config_channels', [key],
+                              delta['add_config'], False))
+            if delta['set_config'] is not None:
+                calls.append(('set_config_channels', [key],
+                              delta['set_config']))
+
+        for call in calls:
+            self._api(*call)
+
+        self.data.update(delta['details'])
+        for name, field in [('children', 'child_channel_labels'),
+                            ('entitlements', 'entitlements'),
+                            ('groups', 'server_group_ids')]:
+            if delta['add_' + name] or delta['remove_' + name]:
+                removed = set(delta['remove_' + name])
+                self.data[field] = [x for x in self.data.get(field, [])
+                                    if x not in removed] + \
+                    delta['add_' + name]
+        if delta['add_packages'] or delta['remove_packages']:
+            self.data.pop('packages', None)
+            self.data.pop('package_names', None)
+            self._details = False
+        if config and (delta['add_config'] or delta['remove_config'] or
+                       delta['set_config'] is not None):
+            self.data.pop('config_channels', None)
+        return len(calls)
+
+    def sync_to(self, desired):
+        '''Changes the key to match desired, touching only what differs.
+
+        :param dict desired: as accepted by :meth:`delta`
+        :returns: int number of api calls made
+
+        Unlike deleting and recreating the key, systems registered with it
+        keep working and nothing that already matches is sent.
+
+        '''
+        return self.apply(self.delta(desired))
+
+
+def _file_checksum(path, checksum_type='sha256'):
+    '''Returns the hex checksum of a local file.'''
+    digest = hashlib.new(checksum_type)
+    _hash_file(path, digest)
+    return digest.hexdigest()
+
+
+class ConfigChannel(collections.UserDict):
+    '''Object representation of a configuration channel.
+
+    :param str label: label of the config channel
+    :param spw: :class:`Spacewalk` instance
+
+    The channel details are fetched straight away and its file list, as
+    **files**, the first time it is used.
+
+    The api has no call returning a file's checksum without its contents,
+    so the checksum and revision of every file are cached per server in
+    ~/.houston along with the file's modification time. Only files the
+    server has changed since they were last seen are looked up again, in
+    chunks, when working out what differs from a local copy. Their contents
+    are kept so downloading them afterwards costs no more calls.
+
+    Paths from the server containing a '..' component are refused rather
+    than written or read outside the local directory.
+
+    '''
+
+    def __init__(self, label, spw):
+        '''init magic'''
+        self.data = {}
+        self.__spw__ = spw
+        self.__ns__ = 'configchannel'
+        self._api = lambda m, *a: self.__spw__.api_call(self.__ns__, m, *a)
+
+        try:
+            self.update(self._api('get_details', label))
+        except SpacewalkAPIError:
+            raise SpacewalkError("Config channel {} cannot be "
+                                 "found".format(label))
+        self.data['label'] = label
+        self.cache_path = spw._cache_file('config-{}.json'.format(label))
+        self._infos = {}
+
+    def __missing__(self, key):
+        '''Fetches the file list on first access.'''
+        if key != 'files':
+            raise KeyError(key)
+        self.data['files'] = self._api('list_files', self.data['label'])
+        return self.data['files']
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path) as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_cache(self, cache):
+        os.makedirs(os.path.dirname(self.cache_path), mode=0o700,
+                    exist_ok=True)
+        with open(self.cache_path + '.tmp', 'w') as fh:
+            json.dump(cache, fh, sort_keys=True)
+        os.replace(self.cache_path + '.tmp', self.cache_path)
+
+    @staticmethod
+    def _local_path(local, path):
+        '''Returns where a file from the channel lives in a local directory.
+
+        :param str local: local directory
+        :param str path: path of the file in the channel
+        :returns: str
+
+        '''
+        parts = [p for p in path.split('/') if p]
+        if '..' in parts or not parts:
+            raise SpacewalkError("Refusing to use {p} from the channel, it "
+                                 "is outside {l}".format(p=path, l=local))
+        return os.path.join(local, *parts)
+
+    @staticmethod
+    def _contents(info):
+        '''Returns the contents of a file from `lookup_file_info` as bytes.'''
+        contents = info.get('contents') or ''
+        if info.get('contents_enc64'):
+            return base64.b64decode(contents)
+        if isinstance(contents, xmlrpc.client.Binary):
+            return contents.data
+        return contents.encode('utf-8')
+
+    def lookup(self, paths):
+        '''Fetches the full revision info, contents included, of files.
+
+        :param paths: paths of the files in the channel
+        :type paths: list of strings
+        :returns: dict of path to dicts as returned by `lookup_file_info`
+
+        The paths are looked up in chunks, several chunks at once.
+
+        '''
+        found = self.__spw__.pmap(
+            lambda chunk: self._api('lookup_file_info', self.data['label'],
+                                    chunk),
+            _chunks(list(paths), 100))
+        return {info['path']: info for chunk in found for info in chunk}
+
+    def checksums(self):
+        '''Returns the checksum and revision of every file in the channel.
+
+        :returns: dict of path to dicts of **checksum**, **checksum_type**,
+            **revision**, **modified**, **owner**, **group** and
+            **permissions**
+
+        Uses the cache for files whose modification time hasn't changed.
+
+        '''
+        cache = self._load_cache()
+        current = {}
+        stale = []
+        for f in self['files']:
+            if f.get('type', 'file') != 'file':
+                continue
+            modified = str(getattr(f.get('last_modified'), 'value',
+                                   f.get('last_modified')))
+            entry = cache.get(f['path'])
+            if entry is not None and entry['modified'] == modified:
+                current[f['path']] = entry
+            else:
+                stale.append((f['path'], modified))
+
+        infos = self.lookup(p for p, m in stale)
+        self._infos.update(infos)
+        for path, modified in stale:
+            info = infos.get(path)
+            if info is None:
+                continue
+            for checksum_type in ['sha256', 'md5']:
+                if info.get(checksum_type):
+                    checksum = info[checksum_type]
+                    break
+            else:
+                checksum_type = 'sha256'
+                checksum = hashlib.sha256(self._contents(info)).hexdigest()
+            current[path] = {
+                'checksum': checksum,
+                'checksum_type': checksum_type,
+                'revision': info.get('revision'),
+                'modified': modified,
+                'owner': info.get('owner', 'root'),
+                'group': info.get('group', 'root'),
+                'permissions': str(info.get('permissions_mode',
+                                            info.get('permissions', '644'))),
+            }
+
+        if stale or set(cache) != set(current):
+            self._save_cache(current)
+        return current
+
+    def diff(self, local):
+        '''Compares the channel with a local directory of files.
+
+        :param str local: directory holding the files, /etc/motd in the
+            channel is local/etc/motd
+        :returns: dict of sorted lists of paths
+
+            * **changed** files whose checksums differ
+            * **added** files only in the local directory
+            * **removed** files only in the channel
+            * **same** files whose checksums match
+
+        '''
+        remote = self.checksums()
+        local_paths = set()
+        for root, dirs, files in os.walk(local):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            for name in files:
+                full = os.path.join(root, name)
+                local_paths.add('/' + os.path.relpath(full, local).replace(
+                    os.sep, '/'))
+
+        rv = {'changed': [], 'added': [], 'removed': [], 'same': []}
+        for path in sorted(local_paths | set(remote)):
+            entry = remote.get(path)
+            if entry is None:
+                rv['added'].append(path)
+            elif path not in local_paths:
+                rv['removed'].append(path)
+            elif _file_checksum(self._local_path(local, path),
+                                entry['checksum_type']) == entry['checksum']:
+                rv['same'].append(path)
+            else:
+                rv['changed'].append(path)
+        return rv
+
+    def download(self, paths, local):
+        '''Writes files from the channel into a local directory.
+
+        :param paths: paths of the files to fetch
+        :type paths: list of strings
+        :param str local: directory to write them under
+        :returns: int number of files written
+
+        Files whose contents were fetched by :meth:`checksums` aren't
+        looked up again. Every path is checked before anything is written.
+
+        '''
+        paths = list(paths)
+        infos = {p: self._infos[p] for p in paths if p in self._infos}
+        infos.update(self.lookup(p for p in paths if p not in infos))
+        dests = {path: self._local_path(local, path) for path in infos}
+        for path, info in infos.items():
+            dest = dests[path]
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            with open(dest + '.tmp', 'wb') as fh:
+                fh.write(self._contents(info))
+            os.replace(dest + '.tmp', dest)
+        return len(infos)
+
+    def upload(self, paths, local):
+        '''Uploads local files to the channel as new revisions.
+
+        :param paths: paths of the files to upload
+        :type paths: list of strings
+        :param str local: directory holding them
+        :returns: int number of api calls made
+
+        Owner, group and permissions are kept from the current revision,
+        new files get root, root and the local file's permissions. The api
+        takes one file per call so the files are sent concurrently.
+
+        '''
+        known = self._load_cache()
+
+        def send(path):
+            source = self._local_path(local, path)
+            with open(source, 'rb') as fh:
+                contents = fh.read()
+            entry = known.get(path, {})
+            info = {
+                'contents': base64.b64encode(contents).decode('ascii'),
+                'contents_enc64': True,
+                'owner': entry.get('owner', 'root'),
+                'group': entry.get('group', 'root'),
+                'permissions': entry.get('permissions', '{:o}'.format(
+                    os.stat(source).st_mode & 0o7777)),
+            }
+            self._api('create_or_update_path', self.data['label'], path,
+                      False, info)
+
+        paths = list(paths)
+        self.__spw__.pmap(send, paths)
+        self.data.pop('files', None)
+        for path in paths:
+            self._infos.pop(path, None)
+        return len(paths)
+
+    def deploy(self, sysids=None, earliest=None):
+        '''Schedules the files to be deployed to systems.
+
+        :param sysids: ids of the systems to deploy to, defaults to every
+            system subscribed to the channel
+        :type sysids: list of ints
+        :param earliest: earliest time the deploy may run, defaults to now
+        :type earliest: :class:`datetime.datetime`
+        :returns: int number of api calls made
+
+        Every subscribed system is scheduled with one call. Chosen systems
+        are scheduled in chunks of :data:`_SCHEDULE_CHUNK_SIZE`, sent
+        concurrently, and get the files of all their config channels.
+
+        '''
+        if sysids is None:
+            self._api('deploy_all_systems', self.data['label'],
+                      _xmlrpc_time(earliest))
+            return 1
+
+        chunks = list(_chunks(sorted(set(sysids)), _SCHEDULE_CHUNK_SIZE))
+        self.__spw__.pmap(
+            lambda chunk: self.__spw__.api_call('system.config', 'deploy_all',
+                                                chunk,
+                                                _xmlrpc_time(earliest)),
+            chunks)
+        return len(chunks)
+
+
+class Errata(collections.UserDict):
+    '''Object representation of an erratum.
+
+    :param str advisory: advisory name, e.g. RHSA-2014:0376
+    :param spw: :class:`Spacewalk` instance
+
+    Nothing is fetched when the object is made. The details returned by
+    `errata.get_details` are fetched the first time one of them is looked
+    up, and each of these keys is fetched the first time it is used:
+
+        * `list` - **packages** ids of the packages the erratum updates
+        * `list` - **cves** CVE names
+        * `list` - **keywords** keywords
+        * `dict` - **bugs** bug ids mapped to their summaries
+        * `list` - **channels** labels of the channels the erratum is in
+
+    `in` and :meth:`get` only see keys already fetched.
+
+    '''
+
+    _LOADERS = {
+        'packages': '_load_packages',
+        'cves': '_load_cves',
+        'keywords': '_load_keywords',
+        'bugs': '_load_bugs',
+        'channels': '_load_channels',
+    }
+
+    def __init__(self, advisory, spw):
+        '''init magic'''
+        self.data = {'advisory_name': advisory}
         self.__spw__ = spw
-        self.__ns__ = 'channel.software'
+        self.__ns__ = 'errata'
         self._api = lambda m, *a: self.__spw__.api_call(self.__ns__, m, *a)
-
-        self.data.update(self._api('get_repo_details', label))
-        self.data['filters'] = self._api('list_repo_filters',
-                                         self.data['label'])
+        self._details = False
+
+    def __missing__(self, key):
+        '''Fetches details and lazily loaded keys on first access.'''
+        loader = self._LOADERS.get(key)
+        if loader is not None:
+            getattr(self, loader)()
+        elif not self._details:
+            self._load_details()
+        if key not in self.data:
+            raise KeyError(key)
+        return self.data[key]
+
+    def _load_details(self):
+        details = self._api('get_details', self.data['advisory_name'])
+        self.data.update((k, v) for k, v in details.items()
+                         if k not in self.data)
+        self._details = True
+
+    def _load_packages(self):
+        self.data['packages'] = [p['id'] for p in
+                                 self._api('list_packages',
+                                           self.data['advisory_name'])]
+
+    def _load_cves(self):
+        self.data['cves'] = self._api('list_cves', self.data['advisory_name'])
+
+    def _load_keywords(self):
+        self.data['keywords'] = self._api('list_keywords',
+                                          self.data['advisory_name'])
+
+    def _load_bugs(self):
+        self.data['bugs'] = self._api('bugzilla_fixes',
+                                      self.data['advisory_name'])
+
+    def _load_channels(self):
+        self.data['channels'] = [c['label'] for c in
+                                 self._api('applicable_to_channels',
+                                           self.data['advisory_name'])]
 
 
 class System(collections.UserDict):
@@ -723,7 +3948,7 @@ class System(collections.UserDict):
         self.__spw__ = spw
         self._api = lambda m, *a: self.__spw__.api_call(self.__ns__, m, *a)
 
-        self.data = {}
+        self.data = {'id': sysid}
         self.data.update(self._api('get_details', self.data['id']))
         self.data['connection_path'] = self._api('get_connection_path',
                                                  self.data['id'])
@@ -760,6 +3985,1543 @@ class System(collections.UserDict):
                                                 self.data['id'])
 
 
+class SystemGroup(collections.UserDict):
+    '''Object representation of a system group.
+
+    :param str name: name of the group
+    :param spw: :class:`Spacewalk` instance
+
+    The details returned by `systemgroup.get_details` are fetched when the
+    object is made:
+
+        * `int` - **id** group id
+        * `str` - **name** group name
+        * `str` - **description**
+        * `int` - **system_count** number of systems in the group
+        * `int` - **org_id**
+
+    **systems**, the ids of every system in the group, is fetched with a
+    single `systemgroup.list_systems` call the first time it is used however
+    big the group is.
+
+    '''
+
+    def __init__(self, name, spw):
+        '''init magic'''
+        self.__spw__ = spw
+        self.__ns__ = 'systemgroup'
+        self._api = lambda m, *a: self.__spw__.api_call(self.__ns__, m, *a)
+        try:
+            self.data = dict(self._api('get_details', name))
+        except SpacewalkAPIError:
+            raise SpacewalkError("System group {} cannot be "
+                                 "found".format(name))
+
+    def __missing__(self, key):
+        '''Fetches the group's systems on first access.'''
+        if key != 'systems':
+            raise KeyError(key)
+        self.data['systems'] = sorted(s['id'] for s in
+                                      self.__spw__.api_call(
+                                          self.__ns__, 'list_systems',
+                                          self.data['name'], fields=['id']))
+        return self.data['systems']
+
+    def _change(self, sysids, add):
+        sysids = sorted(set(sysids))
+        if sysids:
+            self._api('add_or_remove_systems', self.data['name'], sysids, add)
+        self.data.pop('systems', None)
+
+    def add_systems(self, sysids):
+        '''Adds systems to the group with one call.
+
+        :param sysids: ids of the systems to add
+        :type sysids: list of ints
+
+        '''
+        self._change(sysids, True)
+
+    def remove_systems(self, sysids):
+        '''Removes systems from the group with one call.
+
+        :param sysids: ids of the systems to remove
+        :type sysids: list of ints
+
+        '''
+        self._change(sysids, False)
+
+
+class PackageIndex(object):
+    '''Local index of the packages installed on every system.
+
+    :param spw: :class:`Spacewalk` instance
+    :param str path: sqlite database to keep the index in, defaults to a
+        file per server under ~/.houston
+
+    The index holds the name, epoch, version, release and arch of every
+    package installed on every system. :meth:`refresh` only re-reads the
+    packages of systems which have checked in since they were last indexed,
+    pulling several systems at once, so after the first run keeping it up to
+    date costs little more than a single `list_systems` call.
+
+    The errata in each channel, the packages they carry and the systems
+    subscribed to each channel are kept too, so errata applicability can be
+    worked out locally by :meth:`applicable_errata` instead of asking the
+    server about each system in turn.
+
+    '''
+
+    def __init__(self, spw, path=None):
+        '''init magic'''
+        self.__spw__ = spw
+        self.path = path or spw._cache_file('index.db')
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        with self.db:
+            self.db.executescript('''
+                CREATE TABLE IF NOT EXISTS systems (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT,
+                    last_checkin TEXT
+                );
+                CREATE TABLE IF NOT EXISTS packages (
+                    system_id INTEGER,
+                    name TEXT,
+                    epoch TEXT,
+                    version TEXT,
+                    release TEXT,
+                    arch TEXT
+                );
+                CREATE INDEX IF NOT EXISTS packages_name
+                    ON packages (name);
+                CREATE INDEX IF NOT EXISTS packages_system
+                    ON packages (system_id);
+                CREATE TABLE IF NOT EXISTS channel_systems (
+                    channel TEXT,
+                    system_id INTEGER
+                );
+                CREATE TABLE IF NOT EXISTS channel_errata (
+                    channel TEXT,
+                    advisory TEXT
+                );
+                CREATE TABLE IF NOT EXISTS errata (
+                    advisory TEXT PRIMARY KEY,
+                    type TEXT,
+                    synopsis TEXT,
+                    last_modified TEXT
+                );
+                CREATE TABLE IF NOT EXISTS errata_packages (
+                    advisory TEXT,
+                    name TEXT,
+                    epoch TEXT,
+                    version TEXT,
+                    release TEXT,
+                    arch TEXT
+                );
+                CREATE INDEX IF NOT EXISTS errata_packages_name
+                    ON errata_packages (name, arch);
+            ''')
+
+    def close(self):
+        '''Closes the index database'''
+        self.db.close()
+
+    def refresh(self):
+        '''Brings the index up to date with the server.
+
+        :returns: tuple (number of systems re-read, number of systems removed)
+
+        '''
+        current = {s['id']: s for s in
+                   self.__spw__.api_call('system', 'list_systems')}
+        known = dict(self.db.execute('SELECT id, last_checkin FROM systems'))
+
+        stale = [sid for sid, s in current.items()
+                 if known.get(sid) != str(s.get('last_checkin'))]
+        gone = [sid for sid in known if sid not in current]
+
+        # read in chunks so memory use stays flat however big the fleet is
+        for chunk in _chunks(stale, self.__spw__.workers * 8):
+            found = self.__spw__.pmap(
+                lambda sid: self.__spw__.api_call('system', 'list_packages',
+                                                  sid), chunk)
+            with self.db:
+                for sid, pkgs in zip(chunk, found):
+                    self.db.execute('DELETE FROM packages WHERE system_id = ?',
+                                    (sid,))
+                    self.db.executemany(
+                        'INSERT INTO packages VALUES (?, ?, ?, ?, ?, ?)',
+                        ((sid, p['name'], p.get('epoch') or '', p['version'],
+                          p['release'], p.get('arch', p.get('arch_label')))
+                         for p in pkgs))
+                    self.db.execute(
+                        'INSERT OR REPLACE INTO systems VALUES (?, ?, ?)',
+                        (sid, current[sid].get('name'),
+                         str(current[sid].get('last_checkin'))))
+
+        with self.db:
+            for sid in gone:
+                self.db.execute('DELETE FROM packages WHERE system_id = ?',
+                                (sid,))
+                self.db.execute('DELETE FROM systems WHERE id = ?', (sid,))
+
+        return (len(stale), len(gone))
+
+    def refresh_errata(self):
+        '''Brings the channel errata and subscriptions up to date.
+
+        :returns: tuple (number of channels read, number of errata read)
+
+        The errata and subscribed systems of every channel are read on each
+        refresh as they are single calls per channel. The packages of an
+        erratum are only read when it is first seen or it has been updated.
+
+        '''
+        spw = self.__spw__
+        channels = [c['label'] for c in
+                    spw.api_call('channel', 'list_software_channels')]
+        found = spw.pmap(
+            lambda label: (spw.api_call('channel.software', 'list_errata',
+                                        label),
+                           spw.api_call('channel.software',
+                                        'list_subscribed_systems', label)),
+            channels)
+
+        errata = {}
+        with self.db:
+            self.db.execute('DELETE FROM channel_errata')
+            self.db.execute('DELETE FROM channel_systems')
+            for label, (chan_errata, systems) in zip(channels, found):
+                for e in chan_errata:
+                    errata[e['advisory_name']] = e
+                self.db.executemany(
+                    'INSERT INTO channel_errata VALUES (?, ?)',
+                    ((label, e['advisory_name']) for e in chan_errata))
+                self.db.executemany(
+                    'INSERT INTO channel_systems VALUES (?, ?)',
+                    ((label, s['id']) for s in systems))
+
+        known = dict(self.db.execute(
+            'SELECT advisory, last_modified FROM errata'))
+        stale = [name for name, e in errata.items()
+                 if known.get(name) != str(e.get('update_date'))]
+
+        for chunk in _chunks(stale, spw.workers * 8):
+            pkgs = spw.pmap(
+                lambda name: spw.api_call('errata', 'list_packages', name),
+                chunk)
+            with self.db:
+                for name, erratum_pkgs in zip(chunk, pkgs):
+                    e = errata[name]
+                    self.db.execute(
+                        'DELETE FROM errata_packages WHERE advisory = ?',
+                        (name,))
+                    self.db.executemany(
+                        'INSERT INTO errata_packages VALUES (?, ?, ?, ?, ?, ?)',
+                        ((name, p['name'], p.get('epoch') or '',
+                          p['version'], p['release'],
+                          p.get('arch_label', p.get('arch')))
+                         for p in erratum_pkgs))
+                    self.db.execute(
+                        'INSERT OR REPLACE INTO errata VALUES (?, ?, ?, ?)',
+                        (name, e.get('advisory_type'),
+                         e.get('advisory_synopsis'),
+                         str(e.get('update_date'))))
+
+        with self.db:
+            for name in set(known) - set(errata):
+                self.db.execute(
+                    'DELETE FROM errata_packages WHERE advisory = ?', (name,))
+                self.db.execute('DELETE FROM errata WHERE advisory = ?',
+                                (name,))
+
+        return (len(channels), len(stale))
+
+    def applicable_errata(self, advisory_type=None):
+        '''Works out which errata apply to each system.
+
+        :param str advisory_type: only report errata of this type, e.g.
+            'Security Advisory' (opt)
+        :returns: list of dicts sorted by system id then advisory
+
+            * `int` - **id** system id
+            * `str` - **system** system name
+            * `str` - **advisory** advisory name
+            * `str` - **type** advisory type
+            * `str` - **synopsis** advisory synopsis
+
+        An erratum applies to a system when it is in a channel the system is
+        subscribed to and it carries a newer version of an installed package
+        of the same arch. This is worked out from the index alone, so
+        :meth:`refresh` and :meth:`refresh_errata` should be called first.
+
+        '''
+        query = '''SELECT p.system_id, s.name, e.advisory, e.type, e.synopsis,
+                          p.epoch, p.version, p.release,
+                          ep.epoch, ep.version, ep.release
+                   FROM packages p
+                   JOIN systems s ON s.id = p.system_id
+                   JOIN channel_systems cs ON cs.system_id = p.system_id
+                   JOIN channel_errata ce ON ce.channel = cs.channel
+                   JOIN errata_packages ep ON ep.advisory = ce.advisory
+                        AND ep.name = p.name AND ep.arch = p.arch
+                   JOIN errata e ON e.advisory = ep.advisory'''
+        args = []
+        if advisory_type:
+            query += ' WHERE e.type = ?'
+            args.append(advisory_type)
+
+        rv = {}
+        for row in self.db.execute(query, args):
+            key = (row[0], row[2])
+            if key not in rv and _evr_cmp(row[8:11], row[5:8]) > 0:
+                rv[key] = dict(zip(['id', 'system', 'advisory', 'type',
+                                    'synopsis'], row[:5]))
+        return [rv[k] for k in sorted(rv)]
+
+    def find(self, name, constraints=None, arch=None):
+        '''Finds the systems with a package installed.
+
+        :param str name: package name
+        :param str constraints: version constraints as accepted by
+            :func:`_parse_evr_constraints`, e.g. '<1.0.1e-16'
+        :param str arch: only match packages of this arch (opt)
+        :returns: list of dicts sorted by system id
+
+            * `int` - **id** system id
+            * `str` - **system** system name
+            * `str` - **epoch**
+            * `str` - **version**
+            * `str` - **release**
+            * `str` - **arch**
+
+        '''
+        constraints = _parse_evr_constraints(constraints)
+        query = '''SELECT p.system_id, s.name, p.epoch, p.version, p.release,
+                          p.arch
+                   FROM packages p JOIN systems s ON s.id = p.system_id
+                   WHERE p.name = ?'''
+        args = [name]
+        if arch:
+            query += ' AND p.arch = ?'
+            args.append(arch)
+
+        rv = []
+        for row in self.db.execute(query + ' ORDER BY p.system_id', args):
+            if _evr_matches(row[2:5], constraints):
+                rv.append(dict(zip(['id', 'system', 'epoch', 'version',
+                                    'release', 'arch'], row)))
+        return rv
+
+
+class _Tracker(object):
+    '''Polls the server, backing off, until nothing is left pending.
+
+    Subclasses set :attr:`pending`, :attr:`min_interval` and
+    :attr:`max_interval` and implement :meth:`poll`.
+
+    '''
+
+    def poll(self):
+        '''Checks the server once for progress.
+
+        :returns: list of what has finished since the last poll
+
+        '''
+        raise NotImplementedError
+
+    def wait(self, timeout=None):
+        '''Polls until nothing is left pending.
+
+        :param float timeout: give up after this many seconds (opt)
+        :returns: generator of what :meth:`poll` returns, yielded as soon
+            as it is seen
+
+        Polls start at min_interval apart. The wait grows by half each time
+        nothing finishes, up to max_interval, and drops back when something
+        does. Stops early if the timeout is reached, leaving what hasn't
+        finished in :attr:`pending`.
+
+        '''
+        deadline = time.time() + timeout if timeout else None
+        interval = self.min_interval
+        while True:
+            events = self.poll()
+            for event in events:
+                yield event
+            if not self.pending:
+                return
+
+            if events:
+                interval = self.min_interval
+            else:
+                interval = min(interval * 1.5, self.max_interval)
+
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                interval = min(interval, remaining)
+            time.sleep(interval)
+
+
+class ActionTracker(_Tracker):
+    '''Follows scheduled actions until every system has finished them.
+
+    :param spw: :class:`Spacewalk` instance
+    :param actions: ids of the actions to follow
+    :type actions: list of ints
+    :param float min_interval: shortest wait between polls in seconds
+    :param float max_interval: longest wait between polls in seconds
+
+    Each poll makes a single `list_in_progress_actions` call and compares the
+    completed and failed system counts of every action followed with the last
+    poll. The systems of an action are only listed when its counts change, or
+    it stops being in progress, so following thousands of systems costs a few
+    calls per poll rather than one per system.
+
+    Polls start at min_interval apart and back off while nothing changes,
+    see :meth:`wait`.
+
+    '''
+
+    def __init__(self, spw, actions, min_interval=2, max_interval=60):
+        '''init magic'''
+        self.__spw__ = spw
+        self._api = lambda m, *a: self.__spw__.api_call('schedule', m, *a)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.pending = set(int(a) for a in actions)
+        self.results = {a: {'completed': {}, 'failed': {}}
+                        for a in self.pending}
+        self._counts = {}
+
+    def _systems(self, action, status):
+        '''Lists systems of an action that have not been reported yet.
+
+        :param int action: action id
+        :param str status: 'completed' or 'failed'
+        :returns: list of dicts as returned by `list_<status>_systems`
+
+        '''
+        seen = self.results[action][status]
+        new = [s for s in self._api('list_{}_systems'.format(status), action)
+               if s['server_id'] not in seen]
+        for s in new:
+            seen[s['server_id']] = s
+        return new
+
+    def poll(self):
+        '''Checks the server once for progress.
+
+        :returns: list of tuples (action id, 'completed' or 'failed', system
+            dict), one for each system that has finished since the last poll
+
+        '''
+        if not self.pending:
+            return []
+
+        running = {a['id']: (a.get('completedSystems', 0),
+                             a.get('failedSystems', 0))
+                   for a in self._api('list_in_progress_actions')}
+
+        check = []
+        for action in self.pending:
+            counts = running.get(action)
+            if counts is None:
+                check.extend([(action, 'completed'), (action, 'failed')])
+                continue
+            last = self._counts.get(action, (0, 0))
+            if counts[0] != last[0]:
+                check.append((action, 'completed'))
+            if counts[1] != last[1]:
+                check.append((action, 'failed'))
+            self._counts[action] = counts
+
+        found = self.__spw__.pmap(lambda c: self._systems(*c), check)
+
+        self.pending = set(a for a in self.pending if a in running)
+        return [(action, status, system)
+                for (action, status), systems in zip(check, found)
+                for system in systems]
+
+
+def _is_clone_of(name, advisory):
+    '''Checks whether an advisory name is an erratum or a clone of it.
+
+    The server names clones by replacing the first three characters of the
+    original with CL, e.g. CLA-2014:0376 for RHSA-2014:0376. If that name is
+    taken it numbers them instead, CL1A-2014:0376, CL2A-2014:0376 and so on.
+
+    :param str name: advisory name found in a channel
+    :param str advisory: advisory name of the original erratum
+    :returns: Boolean
+
+    '''
+    return name == advisory or re.match(
+        r'CL[0-9]*{}\Z'.format(re.escape(advisory[3:])), name) is not None
+
+
+class ErrataCloneTracker(_Tracker):
+    '''Follows asynchronous errata clones until they appear in their channels.
+
+    :param spw: :class:`Spacewalk` instance
+    :param pending: channel labels mapped to the advisory names being cloned
+        into them
+    :type pending: dict of str to lists of str
+    :param float min_interval: shortest wait between polls in seconds
+    :param float max_interval: longest wait between polls in seconds
+
+    The async clone calls return as soon as the server has queued the work,
+    so the only sign of completion is the clone showing up in the channel.
+    Each poll lists the errata of every channel still waiting, concurrently,
+    one call per channel however many advisories are outstanding. Polls back
+    off as in :class:`ActionTracker`.
+
+    Completed clones are journaled against their channel so
+    :meth:`Spacewalk.rollback` can remove them again. The clones' names are
+    only known once they appear, so clones nobody waits for are never
+    journaled.
+
+    '''
+
+    def __init__(self, spw, pending, min_interval=2, max_interval=60):
+        '''init magic'''
+        self.__spw__ = spw
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.pending = {c: set(a) for c, a in pending.items() if a}
+        self.results = {c: {} for c in self.pending}
+
+    def poll(self):
+        '''Checks the server once for progress.
+
+        :returns: list of tuples (channel label, advisory, clone advisory
+            name), one for each clone that has appeared since the last poll
+
+        '''
+        spw = self.__spw__
+        channels = sorted(self.pending)
+        listed = spw.pmap(lambda c: [e['advisory_name'] for e in
+                                     spw.api_call('channel.software',
+                                                  'list_errata', c)],
+                          channels)
+
+        done = []
+        for channel, names in zip(channels, listed):
+            landed = []
+            for advisory in sorted(self.pending[channel]):
+                clone = next((n for n in names if _is_clone_of(n, advisory)),
+                             None)
+                if clone is not None:
+                    landed.append(clone)
+                    self.pending[channel].discard(advisory)
+                    self.results[channel][advisory] = clone
+                    done.append((channel, advisory, clone))
+            if landed:
+                spw._record(channel, 'clone_errata', errata_added=landed)
+            if not self.pending[channel]:
+                del self.pending[channel]
+                cached = spw.cached_channel(channel)
+                if cached is not None:
+                    cached.refresh()
+        return done
+
+
+class _HTTPPool(object):
+    '''Keep-alive http connections, one per host for each thread.
+
+    :param float timeout: socket timeout in seconds
+
+    '''
+
+    def __init__(self, timeout=60):
+        '''init magic'''
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self, parts):
+        '''Returns the calling thread's connection to a host.
+
+        :param parts: :func:`urllib.parse.urlsplit` result
+        :returns: :class:`http.client.HTTPConnection`
+
+        '''
+        try:
+            conns = self._local.conns
+        except AttributeError:
+            conns = self._local.conns = {}
+        key = (parts.scheme, parts.netloc)
+        if key not in conns:
+            cls = http.client.HTTPSConnection if parts.scheme == 'https' \
+                else http.client.HTTPConnection
+            conns[key] = cls(parts.netloc, timeout=self.timeout)
+        return conns[key]
+
+    def get(self, url, headers=None):
+        '''Starts a GET request, following redirects.
+
+        :param str url: url to fetch
+        :param dict headers: extra request headers (opt)
+        :returns: :class:`http.client.HTTPResponse` which must be read to
+            the end before the next request from this thread
+
+        '''
+        for redirect in range(5):
+            parts = urllib.parse.urlsplit(url)
+            path = parts.path + ('?' + parts.query if parts.query else '')
+            for attempt in range(2):
+                conn = self._connection(parts)
+                try:
+                    conn.request('GET', path, headers=headers or {})
+                    resp = conn.getresponse()
+                    break
+                except (http.client.HTTPException, OSError):
+                    # the server may have closed an idle connection
+                    conn.close()
+                    if attempt:
+                        raise
+            if resp.status in (301, 302, 303, 307, 308):
+                resp.read()
+                url = urllib.parse.urljoin(url, resp.getheader('Location'))
+                continue
+            return resp
+        raise SpacewalkError("Too many redirects fetching {}".format(url))
+
+
+def _package_file(pkg):
+    '''Path of a package in a mirror's Packages directory.
+
+    :param dict pkg: package details with at least **file** and
+        **checksum**
+    :returns: str checksum/file name
+
+    '''
+    return '{c}/{f}'.format(c=pkg['checksum'],
+                            f=os.path.basename(pkg['file']))
+
+
+class Mirror(object):
+    '''Local copy of the packages in channels.
+
+    :param spw: :class:`Spacewalk` instance
+    :param str dest: directory to mirror into, packages are kept in its
+        Packages directory
+    :param int workers: downloads to run at once, defaults to the session's
+        workers
+
+    Each package is kept in a directory named after its checksum, see
+    :func:`_package_file`, so packages sharing a file name don't overwrite
+    each other. A manifest in dest records the id, file and checksum of
+    every package downloaded. Packages already in the manifest, with their
+    file present and the right size, are skipped without asking the server
+    anything, so refreshing a mirror only costs calls and downloads for new
+    packages.
+
+    Each file is checksummed as it is written and only moved into place once
+    it matches. Partial downloads are kept and resumed next time.
+
+    '''
+
+    MANIFEST = '.houston-mirror.json'
+
+    def __init__(self, spw, dest, workers=None):
+        '''init magic'''
+        self.__spw__ = spw
+        self.dest = dest
+        self.workers = workers or spw.workers
+        self.pool = _HTTPPool()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(dest, 'Packages'), exist_ok=True)
+        try:
+            with open(os.path.join(dest, self.MANIFEST)) as fh:
+                self.manifest = {int(k): v for k, v in json.load(fh).items()}
+        except (OSError, ValueError):
+            self.manifest = {}
+
+    def save(self):
+        '''Writes the manifest, replacing the old one in one step.'''
+        path = os.path.join(self.dest, self.MANIFEST)
+        with self._lock:
+            data = json.dumps(self.manifest, sort_keys=True)
+        with open(path + '.tmp', 'w') as fh:
+            fh.write(data)
+        os.replace(path + '.tmp', path)
+
+    def path(self, entry):
+        '''Local path of a manifest entry.'''
+        return os.path.join(self.dest, 'Packages', entry['file'])
+
+    def is_current(self, pkgid):
+        '''Checks whether a package is already mirrored.
+
+        :param int pkgid: package id
+        :returns: Boolean
+
+        '''
+        entry = self.manifest.get(pkgid)
+        if entry is None or entry['file'] != _package_file(entry):
+            return False
+        try:
+            return os.path.getsize(self.path(entry)) == entry['size']
+        except OSError:
+            return False
+
+    def _download(self, url, part, checksum_type):
+        '''Downloads a package into its partial file, resuming what is there.
+
+        :param str url: url of the package
+        :param str part: partial file to write to
+        :param str checksum_type: hashlib name of the checksum to take
+        :returns: tuple (hex checksum of the whole file, bytes resumed from,
+            bytes downloaded)
+
+        '''
+        name = os.path.basename(part[:-len('.part')])
+        digest = hashlib.new(checksum_type)
+        offset = _hash_file(part, digest) if os.path.exists(part) else 0
+
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else None
+        resp = self.pool.get(url, headers)
+        if resp.status == 200 and offset:
+            # the server ignored the range, start again
+            digest = hashlib.new(checksum_type)
+            offset = 0
+        elif resp.status == 416:
+            resp.read()
+            os.unlink(part)
+            raise SpacewalkError("Partial download of {f} is larger than "
+                                 "the package".format(f=name))
+        elif resp.status not in (200, 206):
+            resp.read()
+            raise SpacewalkError("Unable to download {f}: HTTP {s} "
+                                 "{r}".format(f=name, s=resp.status,
+                                              r=resp.reason))
+
+        fetched = 0
+        with open(part, 'ab' if offset else 'wb') as fh:
+            while True:
+                chunk = resp.read(1 << 16)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                fh.write(chunk)
+                fetched += len(chunk)
+        return digest.hexdigest(), offset, fetched
+
+    def _fetch(self, pkgid):
+        '''Downloads one package unless an intact copy is on disk.
+
+        :param int pkgid: package id
+        :returns: int bytes downloaded
+
+        A resumed download whose checksum doesn't match is downloaded again
+        from the start once, as the partial file may have been stale.
+
+        '''
+        spw = self.__spw__
+        details = spw.api_call('packages', 'get_details', pkgid)
+        entry = {
+            'file': _package_file(details),
+            'checksum': details['checksum'],
+            'checksum_type': details['checksum_type'],
+        }
+        final = self.path(entry)
+        os.makedirs(os.path.dirname(final), exist_ok=True)
+
+        # a file left by an earlier run with a lost manifest, or by a mirror
+        # from before packages were kept under their checksum
+        legacy = os.path.join(self.dest, 'Packages',
+                              os.path.basename(entry['file']))
+        for found in (final, legacy):
+            digest = hashlib.new(entry['checksum_type'])
+            try:
+                size = _hash_file(found, digest)
+                if digest.hexdigest() != entry['checksum']:
+                    continue
+                os.replace(found, final)
+            except FileNotFoundError:
+                # missing, or just moved by a package with the same file name
+                continue
+            entry['size'] = size
+            with self._lock:
+                self.manifest[pkgid] = entry
+            return 0
+
+        part = final + '.part'
+        url = spw.api_call('packages', 'get_package_url', pkgid)
+        fetched = 0
+        while True:
+            checksum, offset, got = self._download(url, part,
+                                                   entry['checksum_type'])
+            fetched += got
+            if checksum == entry['checksum']:
+                break
+            os.unlink(part)
+            if not offset:
+                raise SpacewalkError("Checksum mismatch for {}".format(
+                    entry['file']))
+
+        os.replace(part, final)
+        entry['size'] = offset + got
+        with self._lock:
+            self.manifest[pkgid] = entry
+        return fetched
+
+    def sync(self, pkgids, progress=None):
+        '''Mirrors packages, skipping any already mirrored.
+
+        :param pkgids: ids of the packages to mirror
+        :type pkgids: list of ints
+        :param progress: called with (package id, bytes downloaded, error)
+            as each download finishes (opt)
+        :returns: dict counts of **skipped**, **fetched**, **failed** and
+            **bytes**
+
+        The manifest is saved as downloads finish so an interrupted mirror
+        loses little.
+
+        '''
+        todo = [p for p in dict.fromkeys(pkgids) if not self.is_current(p)]
+        stats = {'skipped': len(set(pkgids)) - len(todo), 'fetched': 0,
+                 'failed': 0, 'bytes': 0}
+
+        def fetch(pkgid):
+            try:
+                return pkgid, self._fetch(pkgid), None
+            except (SpacewalkError, OSError, http.client.HTTPException) as e:
+                return pkgid, 0, e
+
+        try:
+            for done, (pkgid, size, error) in enumerate(
+                    self.__spw__.imap(fetch, todo, self.workers), 1):
+                if error is None:
+                    stats['fetched'] += 1
+                    stats['bytes'] += size
+                else:
+                    stats['failed'] += 1
+                if progress is not None:
+                    progress(pkgid, size, error)
+                if done % 100 == 0:
+                    self.save()
+        finally:
+            self.save()
+
+        return stats
+
+
+def _hash_file(path, digest):
+    '''Feeds the contents of a file to a hashlib object.
+
+    :param str path: file to read
+    :param digest: hashlib object to update
+    :returns: int bytes read
+
+    '''
+    size = 0
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    return size
+
+
+_DEP_FLAGS = {'<': 'LT', '<=': 'LE', '=': 'EQ', '==': 'EQ', '>=': 'GE',
+              '>': 'GT'}
+
+# files listed in primary as well as filelists, as createrepo does.
+_PRIMARY_FILE = re.compile(r'^(/etc/|/usr/lib/sendmail$|.*bin/)')
+
+
+def _timestamp(value):
+    '''Converts an api date to seconds since the epoch.
+
+    :param value: :class:`xmlrpc.client.DateTime`, string or number
+    :returns: int, 0 if the date can't be understood
+
+    '''
+    if isinstance(value, (int, float)):
+        return int(value)
+    value = getattr(value, 'value', value) or ''
+    for fmt in ('%Y%m%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return int(time.mktime(time.strptime(str(value)[:19], fmt)))
+        except ValueError:
+            continue
+    return 0
+
+
+def _parse_dep_modifier(modifier):
+    '''Splits a dependency modifier such as '>= 1:2.12-1'.
+
+    :param str modifier: modifier as returned by `list_dependencies`
+    :returns: tuple (operator, (epoch, version, release)), (None, None) for
+        an unversioned dependency
+
+    '''
+    match = re.match(r'\s*([<>=]+)\s*(\S+)', modifier or '')
+    if not match:
+        return None, None
+    return match.group(1), _parse_evr(match.group(2))
+
+
+def _dep_entries(deps):
+    '''Builds the rpm:entry elements for a list of dependencies.
+
+    :param deps: (name, modifier) tuples as held by :class:`PKG`, e.g.
+        ('glibc', '>= 2.12-1')
+    :returns: str
+
+    '''
+    rv = []
+    for name, modifier in deps:
+        if name.startswith('rpmlib('):
+            continue
+        attrs = 'name={}'.format(xml.sax.saxutils.quoteattr(name))
+        op, evr = _parse_dep_modifier(modifier)
+        if op:
+            epoch, version, release = evr
+            attrs += ' flags="{f}" epoch="{e}" ver={v}'.format(
+                f=_DEP_FLAGS.get(op, 'EQ'), e=epoch or '0',
+                v=xml.sax.saxutils.quoteattr(version))
+            if release is not None:
+                attrs += ' rel={}'.format(xml.sax.saxutils.quoteattr(release))
+        rv.append('      <rpm:entry {}/>\n'.format(attrs))
+    return ''.join(rv)
+
+
+def _repodata_fragments(pkg):
+    '''Builds the primary, filelists and other xml for a package.
+
+    :param pkg: :class:`PKG` instance
+    :returns: tuple of three strings
+
+    '''
+    esc = xml.sax.saxutils.escape
+    attr = xml.sax.saxutils.quoteattr
+    arch = pkg.get('arch_label', pkg.get('arch'))
+    version = '<version epoch="{e}" ver={v} rel={r}/>'.format(
+        e=pkg.get('epoch') or '0', v=attr(pkg['version']),
+        r=attr(pkg['release']))
+    ident = 'pkgid={c} name={n} arch={a}'.format(
+        c=attr(pkg['checksum']), n=attr(pkg['name']), a=attr(arch))
+
+    files = []
+    primary_files = []
+    for f in pkg['files']:
+        entry = '<file type="dir">{}</file>'.format(esc(f['path'])) \
+            if f.get('type') == 'directory' else \
+            '<file>{}</file>'.format(esc(f['path']))
+        files.append('    {}\n'.format(entry))
+        if _PRIMARY_FILE.match(f['path']):
+            primary_files.append('    {}\n'.format(entry))
+
+    deps = ''
+    for kind in ['provides', 'requires', 'conflicts', 'obsoletes']:
+        entries = _dep_entries(pkg[kind])
+        if entries:
+            deps += '    <rpm:{k}>\n{e}    </rpm:{k}>\n'.format(k=kind,
+                                                              e=entries)
+
+    primary = (
+        '<package type="rpm">\n'
+        '  <name>{name}</name>\n'
+        '  <arch>{arch}</arch>\n'
+        '  {version}\n'
+        '  <checksum type={ctype} pkgid="YES">{checksum}</checksum>\n'
+        '  <summary>{summary}</summary>\n'
+        '  <description>{description}</description>\n'
+        '  <packager>{vendor}</packager>\n'
+        '  <url></url>\n'
+        '  <time file="{mtime}" build="{btime}"/>\n'
+        # the api has no installed size, yum only shows it to the user
+        '  <size package="{size}" installed="0" archive="{archive}"/>\n'
+        '  <location href={href}/>\n'
+        '  <format>\n'
+        '    <rpm:license>{license}</rpm:license>\n'
+        '    <rpm:vendor>{vendor}</rpm:vendor>\n'
+        '    <rpm:buildhost>{buildhost}</rpm:buildhost>\n'
+        '{deps}{files}'
+        '  </format>\n'
+        '</package>\n').format(
+            name=esc(pkg['name']), arch=esc(arch), version=version,
+            ctype=attr(pkg['checksum_type']), checksum=esc(pkg['checksum']),
+            summary=esc(pkg.get('summary') or ''),
+            description=esc(pkg.get('description') or ''),
+            vendor=esc(pkg.get('vendor') or ''),
+            mtime=_timestamp(pkg.get('last_modified_date')),
+            btime=_timestamp(pkg.get('build_date')),
+            size=pkg.get('size') or 0,
+            archive=pkg.get('payload_size') or 0,
+            href=attr('Packages/' + _package_file(pkg)),
+            license=esc(pkg.get('license') or ''),
+            buildhost=esc(pkg.get('build_host') or ''),
+            deps=deps, files=''.join(primary_files))
+
+    filelists = '<package {i}>\n  {v}\n{f}</package>\n'.format(
+        i=ident, v=version, f=''.join(files))
+    other = '<package {i}>\n  {v}\n</package>\n'.format(i=ident, v=version)
+    return primary, filelists, other
+
+
+class _HashingWriter(object):
+    '''File wrapper which checksums and counts everything written to it.
+
+    :param fh: binary file object to write to
+
+    '''
+
+    def __init__(self, fh):
+        '''init magic'''
+        self.fh = fh
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        return self.fh.write(data)
+
+    def flush(self):
+        self.fh.flush()
+
+
+class Repodata(object):
+    '''Writes yum repodata for packages on the server.
+
+    :param spw: :class:`Spacewalk` instance
+    :param str path: sqlite database to cache package metadata in, defaults
+        to a file per server under ~/.houston
+
+    The primary, filelists and other xml of each package is built from
+    :class:`PKG` the first time the package is seen and kept in the cache
+    along with its checksum and modification time. Later exports only fetch
+    the packages which are new to the cache or were changed on the server
+    since, and stream the rest straight from it.
+
+    '''
+
+    _DOCS = [
+        ('primary', '<metadata xmlns="http://linux.duke.edu/metadata/common" '
+                    'xmlns:rpm="http://linux.duke.edu/metadata/rpm" '
+                    'packages="{n}">\n', '</metadata>\n'),
+        ('filelists', '<filelists xmlns="http://linux.duke.edu/metadata/'
+                      'filelists" packages="{n}">\n', '</filelists>\n'),
+        ('other', '<otherdata xmlns="http://linux.duke.edu/metadata/other" '
+                  'packages="{n}">\n', '</otherdata>\n'),
+    ]
+
+    def __init__(self, spw, path=None):
+        '''init magic'''
+        self.__spw__ = spw
+        self.path = path or spw._cache_file('repodata.db')
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        with self.db:
+            # caches from before packages were stamped
+            self.db.execute('DROP TABLE IF EXISTS fragments')
+            self.db.execute('''
+                CREATE TABLE IF NOT EXISTS packages (
+                    id INTEGER PRIMARY KEY,
+                    stamp TEXT,
+                    primary_xml TEXT,
+                    filelists_xml TEXT,
+                    other_xml TEXT
+                )''')
+
+    def close(self):
+        '''Closes the cache database'''
+        self.db.close()
+
+    @staticmethod
+    def _stamp(pkg):
+        '''Identifies the version of a package's metadata.
+
+        :param dict pkg: package as returned by list_all_packages
+        :returns: str
+
+        '''
+        return '{c}:{m}'.format(c=pkg.get('checksum', ''),
+                                m=pkg.get('last_modified', ''))
+
+    def fetch(self, pkgs, workers=None):
+        '''Adds any packages missing from the cache, or changed since.
+
+        :param pkgs: packages as returned by list_all_packages, at least
+            their id, checksum and last_modified
+        :type pkgs: list of dicts
+        :param int workers: packages to fetch at once (opt)
+        :returns: int number of packages fetched
+
+        '''
+        stamps = {p['id']: self._stamp(p) for p in pkgs}
+        cached = {}
+        for chunk in _chunks(sorted(stamps)):
+            cached.update(self.db.execute(
+                'SELECT id, stamp FROM packages WHERE id IN ({})'.format(
+                    ','.join('?' * len(chunk))), chunk))
+        missing = [p for p in stamps if cached.get(p) != stamps[p]]
+
+        spw = self.__spw__
+        fetched = spw.imap(
+            lambda p: (p, _repodata_fragments(PKG({'id': p}, spw))),
+            missing, workers)
+        try:
+            for done, (pkgid, fragments) in enumerate(fetched, 1):
+                self.db.execute('INSERT OR REPLACE INTO packages '
+                                'VALUES (?, ?, ?, ?, ?)',
+                                (pkgid, stamps[pkgid]) + fragments)
+                if done % 500 == 0:
+                    self.db.commit()
+        finally:
+            self.db.commit()
+        return len(missing)
+
+    def write(self, pkgids, dest):
+        '''Writes repodata for packages into dest/repodata.
+
+        :param pkgids: ids of the packages in the repo, all must have been
+            fetched
+        :type pkgids: list of ints
+        :param str dest: repo directory, packages are expected to be in its
+            Packages directory
+        :returns: int number of packages written
+
+        Each file is streamed from the cache through gzip. The new files
+        replace the old ones once they are all written.
+
+        '''
+        pkgids = list(dict.fromkeys(pkgids))
+        repodata = os.path.join(dest, 'repodata')
+        os.makedirs(repodata, exist_ok=True)
+
+        records = []
+        for column, (name, head, tail) in enumerate(self._DOCS, 1):
+            tmp = os.path.join(repodata, '.{}.xml.gz'.format(name))
+            opened = hashlib.sha256()
+            opened_size = 0
+            with open(tmp, 'wb') as raw:
+                out = _HashingWriter(raw)
+                with gzip.GzipFile(fileobj=out, mode='wb', mtime=0) as gz:
+                    def emit(text):
+                        data = text.encode('utf-8')
+                        opened.update(data)
+                        gz.write(data)
+                        return len(data)
+
+                    opened_size += emit('<?xml version="1.0" '
+                                        'encoding="UTF-8"?>\n')
+                    opened_size += emit(head.format(n=len(pkgids)))
+                    for chunk in _chunks(pkgids):
+                        rows = dict(self.db.execute(
+                            'SELECT id, {c} FROM packages WHERE id IN '
+                            '({q})'.format(c=('primary_xml', 'filelists_xml',
+                                              'other_xml')[column - 1],
+                                           q=','.join('?' * len(chunk))),
+                            chunk))
+                        for pkgid in chunk:
+                            if pkgid not in rows:
+                                raise SpacewalkError("Package {} has not "
+                                                     "been fetched".format(
+                                                         pkgid))
+                            opened_size += emit(rows[pkgid])
+                    opened_size += emit(tail)
+            records.append((name, tmp, out.digest.hexdigest(), out.size,
+                            opened.hexdigest(), opened_size))
+
+        now = int(time.time())
+        repomd = ['<?xml version="1.0" encoding="UTF-8"?>\n'
+                  '<repomd xmlns="http://linux.duke.edu/metadata/repo" '
+                  'xmlns:rpm="http://linux.duke.edu/metadata/rpm">\n'
+                  '  <revision>{}</revision>\n'.format(now)]
+        for name, tmp, checksum, size, open_checksum, open_size in records:
+            filename = '{c}-{n}.xml.gz'.format(c=checksum, n=name)
+            os.replace(tmp, os.path.join(repodata, filename))
+            repomd.append(
+                '  <data type="{n}">\n'
+                '    <checksum type="sha256">{c}</checksum>\n'
+                '    <open-checksum type="sha256">{oc}</open-checksum>\n'
+                '    <location href="repodata/{f}"/>\n'
+                '    <timestamp>{t}</timestamp>\n'
+                '    <size>{s}</size>\n'
+                '    <open-size>{os}</open-size>\n'
+                '  </data>\n'.format(n=name, c=checksum, oc=open_checksum,
+                                     f=filename, t=now, s=size,
+                                     os=open_size))
+        repomd.append('</repomd>\n')
+
+        tmp = os.path.join(repodata, '.repomd.xml')
+        with open(tmp, 'w') as fh:
+            fh.write(''.join(repomd))
+        os.replace(tmp, os.path.join(repodata, 'repomd.xml'))
+
+        # drop metadata files from earlier exports
+        current = {'repomd.xml'} | {'{c}-{n}.xml.gz'.format(c=r[2], n=r[0])
+                                    for r in records}
+        for f in os.listdir(repodata):
+            if f not in current and not f.startswith('.'):
+                os.unlink(os.path.join(repodata, f))
+
+        return len(pkgids)
+
+
+def _deps_overlap(provide, require):
+    '''Checks whether a provided version satisfies a required one.
+
+    :param provide: (operator, evr) as returned by :func:`_parse_dep_modifier`
+    :param require: (operator, evr) as returned by :func:`_parse_dep_modifier`
+    :returns: Boolean
+
+    As in rpm an unversioned provide or require matches anything, otherwise
+    the two version ranges have to overlap.
+
+    '''
+    p_op, p_evr = provide
+    r_op, r_evr = require
+    if not p_op or not r_op:
+        return True
+    cmp = _evr_cmp(p_evr, r_evr)
+    if cmp < 0:
+        return '>' in p_op or '<' in r_op
+    if cmp > 0:
+        return '<' in p_op or '>' in r_op
+    return ('=' in p_op and '=' in r_op) or \
+        ('<' in p_op and '<' in r_op) or ('>' in p_op and '>' in r_op)
+
+
+def _format_dep(name, version):
+    '''Formats a dependency for display, e.g. 'glibc >= 2.12-1'.
+
+    :param str name: capability
+    :param version: (operator, evr) as returned by :func:`_parse_dep_modifier`
+    :returns: str
+
+    '''
+    op, evr = version
+    if not op:
+        return name
+    return '{n} {o} {e}{v}{r}'.format(n=name, o=op,
+                                      e=evr[0] + ':' if evr[0] else '',
+                                      v=evr[1],
+                                      r='-' + evr[2] if evr[2] else '')
+
+
+class DependencyResolver(object):
+    '''Works out what else a channel needs when packages are added to it.
+
+    :param spw: :class:`Spacewalk` instance
+    :param sources: labels of the channels missing dependencies are taken from
+    :type sources: list of str
+    :param str path: sqlite database to cache dependencies in, defaults to a
+        file per server under ~/.houston
+
+    Each channel is indexed at most once per resolver. Its package list takes
+    one call and the dependencies of its packages come from the cache, only
+    packages never seen before are fetched, concurrently. A package's
+    dependencies never change so cached entries are never refreshed.
+
+    Requirements on files are matched against the provides first. Only if
+    that fails are the file lists of a channel's packages fetched, again
+    once per package.
+
+    '''
+
+    def __init__(self, spw, sources, path=None):
+        '''init magic'''
+        self.__spw__ = spw
+        self.sources = list(sources)
+        self.path = path or spw._cache_file('dependencies.db')
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        with self.db:
+            self.db.executescript('''
+                CREATE TABLE IF NOT EXISTS deps_fetched (
+                    id INTEGER PRIMARY KEY
+                );
+                CREATE TABLE IF NOT EXISTS deps (
+                    pkg INTEGER,
+                    type TEXT,
+                    name TEXT,
+                    modifier TEXT
+                );
+                CREATE INDEX IF NOT EXISTS deps_pkg ON deps (pkg);
+                CREATE TABLE IF NOT EXISTS files_fetched (
+                    id INTEGER PRIMARY KEY
+                );
+                CREATE TABLE IF NOT EXISTS files (
+                    pkg INTEGER,
+                    path TEXT
+                );
+                CREATE INDEX IF NOT EXISTS files_pkg ON files (pkg);
+            ''')
+        self.packages = {}
+        self._deps = {}
+        self._indexes = {}
+        self._parents = {}
+
+    def close(self):
+        '''Closes the cache database'''
+        self.db.close()
+
+    def _uncached(self, table, pkgids):
+        '''Returns the package ids not yet recorded in a *_fetched table.'''
+        missing = set(pkgids)
+        for chunk in _chunks(sorted(missing)):
+            missing.difference_update(r[0] for r in self.db.execute(
+                'SELECT id FROM {t} WHERE id IN ({q})'.format(
+                    t=table, q=','.join('?' * len(chunk))), chunk))
+        return sorted(missing)
+
+    def _cache(self, method, pkgids, rows):
+        '''Fetches and caches package records not already cached.
+
+        :param str method: packages api method, list_dependencies or
+            list_files
+        :param pkgids: package ids
+        :param rows: callable turning a package id and the api result into
+            rows for the table
+        :returns: int number of packages fetched
+
+        '''
+        table = 'deps' if method == 'list_dependencies' else 'files'
+        missing = self._uncached(table + '_fetched', pkgids)
+        spw = self.__spw__
+        fetched = spw.imap(
+            lambda p: (p, spw.api_call('packages', method, p)), missing)
+        try:
+            for done, (pkgid, result) in enumerate(fetched, 1):
+                values = rows(pkgid, result)
+                if values:
+                    self.db.executemany(
+                        'INSERT INTO {t} VALUES ({q})'.format(
+                            t=table, q=','.join('?' * len(values[0]))),
+                        values)
+                self.db.execute('INSERT INTO {}_fetched VALUES (?)'.format(
+                    table), (pkgid,))
+                if done % 500 == 0:
+                    self.db.commit()
+        finally:
+            self.db.commit()
+        return len(missing)
+
+    def _load(self, pkgids):
+        '''Reads the dependencies of packages into memory.'''
+        todo = [p for p in set(pkgids) if p not in self._deps]
+        self._cache('list_dependencies', todo,
+                    lambda p, deps: [(p, d['dependency_type'],
+                                      d['dependency'],
+                                      d['dependency_modifier'] or '')
+                                     for d in deps])
+        for pkgid in todo:
+            self._deps[pkgid] = collections.defaultdict(list)
+        for chunk in _chunks(sorted(todo)):
+            for pkgid, kind, name, modifier in self.db.execute(
+                    'SELECT pkg, type, name, modifier FROM deps WHERE pkg '
+                    'IN ({})'.format(','.join('?' * len(chunk))), chunk):
+                self._deps[pkgid][kind].append(
+                    (name, _parse_dep_modifier(modifier)))
+
+    def dependencies(self, pkgid):
+        '''Returns the dependencies of a package.
+
+        :param int pkgid: package id
+        :returns: dict of dependency type ( requires, provides, conflicts,
+            obsoletes ) to lists of (name, (operator, evr)) tuples
+
+        '''
+        self._load([pkgid])
+        return self._deps[pkgid]
+
+    def index(self, channel):
+        '''Indexes what the packages in a channel provide.
+
+        :param str channel: channel label
+        :returns: dict
+
+            * `set` - **pkgs** ids of the packages in the channel
+            * `dict` - **provides** capability name to a list of (package
+              id, (operator, evr)) tuples
+
+        '''
+        if channel not in self._indexes:
+            ids = []
+            for p in self.__spw__.api_call('channel.software',
+                                           'list_all_packages', channel):
+                self.packages[p['id']] = dict(
+                    p, arch=p.get('arch', p.get('arch_label')))
+                ids.append(p['id'])
+            self._load(ids)
+
+            provides = collections.defaultdict(list)
+            for pkgid in ids:
+                pkg = self.packages[pkgid]
+                provides[pkg['name']].append((pkgid, ('=', _evr(pkg))))
+                for name, version in self._deps[pkgid]['provides']:
+                    provides[name].append((pkgid, version))
+
+            self._indexes[channel] = {'pkgs': set(ids),
+                                      'provides': provides,
+                                      'files': None}
+        return self._indexes[channel]
+
+    def _file_owners(self, channel, path):
+        '''Returns the ids of the packages in a channel owning a file.'''
+        index = self.index(channel)
+        if index['files'] is None:
+            self._cache('list_files', index['pkgs'],
+                        lambda p, files: [(p, f['path']) for f in files])
+            owners = collections.defaultdict(set)
+            for chunk in _chunks(sorted(index['pkgs'])):
+                for pkgid, owned in self.db.execute(
+                        'SELECT pkg, path FROM files WHERE pkg IN '
+                        '({})'.format(','.join('?' * len(chunk))), chunk):
+                    owners[owned].add(pkgid)
+            index['files'] = owners
+        return index['files'].get(path, set())
+
+    def providers(self, channel, name, version=(None, None)):
+        '''Finds the packages in a channel satisfying a requirement.
+
+        :param str channel: channel label
+        :param str name: capability or file path
+        :param version: (operator, evr) as returned by
+            :func:`_parse_dep_modifier`
+        :returns: set of package ids
+
+        '''
+        found = {pkgid for pkgid, provided in
+                 self.index(channel)['provides'].get(name, ())
+                 if _deps_overlap(provided, version)}
+        if not found and name.startswith('/'):
+            found = set(self._file_owners(channel, name))
+        return found
+
+    def subscribed_with(self, channel):
+        '''Returns the channels a system using channel is subscribed to.
+
+        :param str channel: channel label
+        :returns: list of channel labels, channel followed by its parent if
+            it is a child channel
+
+        '''
+        if channel not in self._parents:
+            self._parents[channel] = self.__spw__.api_call(
+                'channel.software', 'get_details',
+                channel).get('parent_channel_label') or None
+        return [c for c in [channel, self._parents[channel]] if c]
+
+    def _best(self, candidates, arch):
+        '''Picks the newest candidate, preferring arch or noarch.'''
+        pool = sorted(candidates)
+        pool = [p for p in pool
+                if self.packages[p].get('arch') in (arch, 'noarch')] or pool
+        best = pool[0]
+        for pkgid in pool[1:]:
+            if _evr_cmp(_evr(self.packages[pkgid]),
+                        _evr(self.packages[best])) > 0:
+                best = pkgid
+        return best
+
+    def resolve(self, pkgids, target):
+        '''Works out the packages to add to a channel to satisfy
+        dependencies.
+
+        :param pkgids: ids of the packages being added
+        :type pkgids: list of ints
+        :param str target: label of the channel they are added to
+        :returns: dict
+
+            * `list` - **add** ids of the packages to add. The requested
+              packages not already in target, followed by the dependencies
+              they need that target lacks, taken from the source channels
+            * `list` - **unresolved** (package id, requirement) tuples that
+              nothing in target or the source channels satisfies
+            * `list` - **conflicts** (package id, package id, conflict)
+              tuples of packages that would end up in target together but
+              conflict
+
+        Each missing requirement is met by the newest package providing it
+        in the source channels, preferring the arch of the package needing
+        it. The closure is minimal in that nothing is added for a
+        requirement target or an earlier addition already meets. When target
+        is a child channel its parent counts as part of target, as systems
+        using target get both.
+
+        '''
+        installed = self.subscribed_with(target)
+        target_pkgs = set()
+        for channel in installed:
+            target_pkgs |= self.index(channel)['pkgs']
+        for source in self.sources:
+            self.index(source)
+        self._load(pkgids)
+
+        def in_target(name, version):
+            found = set()
+            for channel in installed:
+                found |= self.providers(channel, name, version)
+            return found
+
+        add = [p for p in dict.fromkeys(pkgids)
+               if p not in self.index(target)['pkgs']]
+        chosen = set(add)
+        chosen_provides = collections.defaultdict(list)
+
+        def provide(pkgid):
+            pkg = self.packages.get(pkgid)
+            if pkg is not None:
+                chosen_provides[pkg['name']].append((pkgid, ('=', _evr(pkg))))
+            for name, version in self._deps[pkgid]['provides']:
+                chosen_provides[name].append((pkgid, version))
+
+        for pkgid in add:
+            provide(pkgid)
+
+        unresolved = []
+        queue = collections.deque(add)
+        while queue:
+            pkgid = queue.popleft()
+            for name, version in self._deps[pkgid]['requires']:
+                if name.startswith('rpmlib(') or \
+                        any(_deps_overlap(p, version)
+                            for _, p in chosen_provides.get(name, ())) or \
+                        in_target(name, version):
+                    continue
+                candidates = set()
+                for source in self.sources:
+                    candidates |= self.providers(source, name, version)
+                if candidates & chosen:
+                    continue
+                if not candidates:
+                    unresolved.append((pkgid, _format_dep(name, version)))
+                    continue
+                best = self._best(candidates,
+                                  self.packages.get(pkgid, {}).get('arch'))
+                self._load([best])
+                chosen.add(best)
+                add.append(best)
+                provide(best)
+                queue.append(best)
+
+        conflicts = []
+        for pkgid in add:
+            for name, version in self._deps[pkgid]['conflicts']:
+                others = in_target(name, version) | {
+                    p for p, provided in chosen_provides.get(name, ())
+                    if _deps_overlap(provided, version)}
+                conflicts.extend((pkgid, other, _format_dep(name, version))
+                                 for other in sorted(others - {pkgid}))
+        for pkgid in sorted(target_pkgs):
+            for name, version in self._deps[pkgid]['conflicts']:
+                for other, provided in chosen_provides.get(name, ()):
+                    if other != pkgid and _deps_overlap(provided, version):
+                        conflicts.append((other, pkgid,
+                                          _format_dep(name, version)))
+
+        return {'add': add, 'unresolved': unresolved, 'conflicts': conflicts}
+
+
 class PKG(collections.UserDict):
     '''Object representation of an RPM.
 
@@ -780,7 +5542,7 @@ class PKG(collections.UserDict):
         * `str` **arch** Arch of package
 
     If all keys are provided then the id will be used, as it is more reliable,
-    others will be ignored.
+    others will be ignored. A bare package id may also be given.
 
     .. note::
     From Redhat Docs
@@ -817,8 +5579,10 @@ class PKG(collections.UserDict):
         * `list` - **errata** all errata associated with the channel
             * `int` errata id
 
-
-
+    Only the package details are fetched up front. The keys above are each
+    fetched the first time they are looked up, so a PKG used just for its
+    version costs one call rather than seven. They are always listed by
+    :meth:`keys` and `in`, and :meth:`get` fetches them as needed.
 
     '''
 
@@ -833,6 +5597,9 @@ class PKG(collections.UserDict):
         self.ns = 'packages'
         self.api = lambda m, *a: self.__spw__.api_call(self.ns, m, *a)
 
+        if isinstance(pkg, int):
+            pkg = {'id': pkg}
+
         try:
             pkgid = pkg['id']
         except KeyError:
@@ -846,29 +5613,63 @@ class PKG(collections.UserDict):
                                         "name, version, release, epoch, arch")
 
         self.update(self.api('get_details', pkgid))
-        self.data['url'] = self.api('get_package_url', pkgid)
-
-        deps = self.api('list_dependencies', pkgid)
-
-        self.data['conflicts'] = [(x['dependency'], x['dependency_modifier'])
-                                  for x in deps
-                                  if x['dependency_type'] == 'conflicts']
-        self.data['obsoletes'] = [(x['dependency'], x['dependency_modifier'])
-                                  for x in deps
-                                  if x['dependency_type'] == 'obsoletes']
-        self.data['provides'] = [(x['dependency'], x['dependency_modifier'])
-                                 for x in deps
-                                 if x['dependency_type'] == 'provides']
-        self.data['requires'] = [(x['dependency'], x['dependency_modifier'])
-                                 for x in deps
-                                 if x['dependency_type'] == 'requires']
-
-        self.data['files'] = self.api('list_files', pkgid)
-        self.data['channels'] = [c['label']
-                                 for c in self.api('list_providing_channels',
-                                                   pkgid)]
+        self.pkgid = pkgid
+
+    # keys not returned by get_details, fetched the first time they are used
+    _LOADERS = {
+        'url': '_load_url',
+        'conflicts': '_load_dependencies',
+        'obsoletes': '_load_dependencies',
+        'provides': '_load_dependencies',
+        'requires': '_load_dependencies',
+        'files': '_load_files',
+        'channels': '_load_channels',
+        'errata': '_load_errata',
+    }
+
+    def __missing__(self, key):
+        '''Fetches lazily loaded keys on first access.'''
+        loader = self._LOADERS.get(key)
+        if loader is None:
+            raise KeyError(key)
+        getattr(self, loader)()
+        return self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data or key in self._LOADERS
+
+    def __iter__(self):
+        # a copy, iterating over items() fetches keys as it goes
+        return iter(list(self.data) +
+                    [k for k in self._LOADERS if k not in self.data])
+
+    def __len__(self):
+        return len(self.data.keys() | self._LOADERS.keys())
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def _load_url(self):
+        self.data['url'] = self.api('get_package_url', self.pkgid)
+
+    def _load_dependencies(self):
+        deps = self.api('list_dependencies', self.pkgid)
+        for kind in ['conflicts', 'obsoletes', 'provides', 'requires']:
+            self.data[kind] = [(x['dependency'], x['dependency_modifier'])
+                               for x in deps
+                               if x['dependency_type'] == kind]
+
+    def _load_files(self):
+        self.data['files'] = self.api('list_files', self.pkgid)
+
+    def _load_channels(self):
+        self.data['channels'] = [c['label'] for c in
+                                 self.api('list_providing_channels',
+                                          self.pkgid)]
+
+    def _load_errata(self):
         self.data['errata'] = [e['id'] for e in
-                               self.api('list_providing_errata', pkgid)]
+                               self.api('list_providing_errata', self.pkgid)]
 
     def __cmp__(self, other):
         '''returns 1 if other newer, -1 if self newer 0 if identical'''
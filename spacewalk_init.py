@@ -3,6 +3,8 @@
 
 import xmlrpc.client
 
+from Houston.libhouston import Spacewalk
+
 SATELLITE_URL = 'https://10.250.140.18/rpc/api'
 SATELLITE_LOGIN = 'admin'
 SATELLITE_PASSWORD = 'Sh33pd0g'
@@ -161,18 +163,23 @@ for label, name, summary, arch, parent, chksum, repo in channel_matrix:
         client.channel.software.associate_repo(key, label, repo)
         client.channel.software.sync_repo(key, label)
 #
-# clean any existing activation keys
-for k in [x['key'] for x in client.activationkey.list_activation_keys(key)]:
-    client.activationkey.delete(key, k)
-
-client.activationkey.create(key, "", "activation key for centos 6.4 i386",
-                            "centos-6.4-parent-i386", [], False)
-client.activationkey.create(key, "", "activation key for centos 6.4 x86_64",
-                            "centos-6.4-parent-x86_64", [], False)
-
-for k in client.activationkey.list_activation_keys(key):
-    client.activationkey.add_child_channels(key, k['key'],
-                                            [x[0] for x in channel_matrix
-                                             if x[4] == k["base_channel_label"]
-                                             ]
-                                            )
+# activation keys are changed in place so systems registered with them keep
+# working. Keys made before they were named here, with a random name, are
+# taken over by matching their description and base channel. Any other keys
+# are deleted.
+activation_keys = {
+    "centos-6.4-i386": {
+        "description": "activation key for centos 6.4 i386",
+        "base_channel_label": "centos-6.4-parent-i386",
+    },
+    "centos-6.4-x86_64": {
+        "description": "activation key for centos 6.4 x86_64",
+        "base_channel_label": "centos-6.4-parent-x86_64",
+    },
+}
+for k in activation_keys.values():
+    k["child_channel_labels"] = [x[0] for x in channel_matrix
+                                 if x[4] == k["base_channel_label"]]
+
+with Spacewalk(SATELLITE_URL, SATELLITE_LOGIN, SATELLITE_PASSWORD) as spw:
+    spw.sync_activation_keys(activation_keys, delete=True, adopt=True)
@@ -0,0 +1,294 @@
+#!/usr/bin/python3
+''' Unit Tests for the houston command line
+
+'''
+
+import Houston.libhouston as libhouston
+import argparse
+import importlib.machinery
+import importlib.util
+import json
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                     'houston')
+_loader = importlib.machinery.SourceFileLoader('houston', _path)
+houston = importlib.util.module_from_spec(
+    importlib.util.spec_from_loader('houston', _loader))
+_loader.exec_module(houston)
+
+
+class FakeSpacewalk(libhouston.Spacewalk):
+    '''Spacewalk session answering api calls from handlers, no server needed
+
+    :param dict handlers: 'namespace.method' mapped to a callable taking the
+        call's arguments
+
+    '''
+
+    def __init__(self, handlers=None):
+        self.handlers = dict(handlers or {})
+        self.calls = []
+        self.workers = 1
+        self._api_calllist = ()
+
+    def api_call(self, namespace, method, *args, fields=None):
+        api = '{}.{}'.format(namespace, method)
+        self.calls.append((api,) + args)
+        if api not in self.handlers:
+            raise libhouston.SpacewalkAPIError("No such Api Method: "
+                                               "{}".format(api))
+        return self.handlers[api](*args)
+
+
+def args(spw, **kwargs):
+    '''Command line args for a command run on spw'''
+    defaults = {'systems': None, 'systems_file': None, 'group': None,
+                'verbose': False, 'at': None, 'session': spw}
+    defaults.update(kwargs)
+    return argparse.Namespace(**defaults)
+
+
+class TestResolveSystems(unittest.TestCase):
+    '''Tests systems given by id, profile name and group'''
+
+    def setUp(self):
+        groups = {'web': [11, 12], 'db': [12, 13]}
+
+        def group(name):
+            if name not in groups:
+                raise libhouston.SpacewalkAPIError("No such group")
+            return {'id': 1, 'name': name}
+
+        self.spw = FakeSpacewalk({
+            'systemgroup.get_details': group,
+            'systemgroup.list_systems': lambda name: [
+                {'id': s} for s in groups[name]],
+            'system.list_systems': lambda: [
+                {'id': 21, 'name': 'mail01'}, {'id': 22, 'name': 'dup'},
+                {'id': 23, 'name': 'dup'}],
+        })
+
+    def test_mixed(self):
+        '''Tests ids, names and groups are combined without duplicates'''
+        a = args(self.spw, systems=['5,mail01'], group=['web', 'db'])
+        self.assertEqual(houston._resolve_systems(a, self.spw),
+                         [5, 11, 12, 13, 21])
+
+    def test_ids_only(self):
+        '''Tests system ids are used without any calls'''
+        a = args(self.spw, systems=['7', '3'])
+        self.assertEqual(houston._resolve_systems(a, self.spw), [3, 7])
+        self.assertEqual(self.spw.calls, [])
+
+    def test_unknown_group(self):
+        '''Tests an unknown group stops the command'''
+        a = args(self.spw, group=['mail'])
+        self.assertRaises(SystemExit, houston._resolve_systems, a, self.spw)
+
+    def test_ambiguous_name(self):
+        '''Tests a profile name shared by several systems stops the command'''
+        a = args(self.spw, systems=['dup'])
+        self.assertRaises(SystemExit, houston._resolve_systems, a, self.spw)
+
+
+class TestMigrate(unittest.TestCase):
+    '''Tests which systems migrate moves'''
+
+    def setUp(self):
+        self.moved = {}
+        self.spw = FakeSpacewalk({
+            'channel.software.get_details': lambda label: {'label': label},
+            'channel.software.list_subscribed_systems': lambda label: [
+                {'id': s} for s in [1, 2, 3]],
+            'channel.software.list_children': lambda label: [
+                {'label': 'prod-tools'}],
+            'systemgroup.get_details': lambda name: {'name': name},
+            'systemgroup.list_systems': lambda name: [{'id': 2}, {'id': 9}],
+            'system.list_subscribable_base_channels': lambda s: [
+                {'label': 'prod-base'}],
+            'system.list_subscribable_child_channels': lambda s: [
+                {'label': 'prod-tools'}],
+            'system.set_base_channel': lambda s, c: self.moved.update(
+                {s: [c]}) or 1,
+            'system.set_child_channels': lambda s, c: self.moved[s].extend(
+                c) or 1,
+        })
+
+    def migrate(self, **kwargs):
+        kwargs.setdefault('recursive', False)
+        houston.migrate(args(self.spw, from_channel='dev-base',
+                             to_channel='prod-base', **kwargs))
+
+    def test_all(self):
+        '''Tests every subscribed system is moved by default'''
+        self.migrate()
+        self.assertEqual(sorted(self.moved), [1, 2, 3])
+
+    def test_group(self):
+        '''Tests only group members subscribed to from-channel are moved'''
+        self.migrate(group=['web'], recursive=True)
+        self.assertEqual(self.moved, {2: ['prod-base', 'prod-tools']})
+
+    def test_systems(self):
+        '''Tests --systems narrows the subscribed systems'''
+        self.migrate(systems=['3,9'])
+        self.assertEqual(self.moved, {3: ['prod-base']})
+
+
+class TestPlanBatch(unittest.TestCase):
+    '''Tests the order batch operations are run in'''
+
+    def setUp(self):
+        kids = {'rhel-base': [{'label': 'rhel-tools'}]}
+
+        def children(label):
+            if label.startswith('dev-'):
+                raise libhouston.SpacewalkAPIError("No such channel")
+            return kids.get(label, [])
+
+        self.spw = FakeSpacewalk({
+            'channel.software.list_children': children})
+        self.month = time.strftime("%b").lower()
+
+    def plan(self, *commands):
+        return houston._plan_batch([{'id': str(i), 'command': c, 'after': []}
+                                    for i, c in enumerate(commands, 1)],
+                                   self.spw)
+
+    def test_clone_children(self):
+        '''Tests a change to a cloned child waits for the clone'''
+        deps = self.plan(
+            'channel clone -c rhel-base -p web -t t1',
+            'pkg add -c dev-web-{}-t1-rhel-tools -n vim'.format(self.month),
+            'pkg add -c rhel-tools -n git',
+            'pkg add -c qa-web -n git')
+        self.assertEqual(deps, {'1': set(), '2': {'1'}, '3': {'1'},
+                                '4': set()})
+
+    def test_recursive_delete(self):
+        '''Tests deleting a tree waits for changes to the children'''
+        deps = self.plan('pkg add -c rhel-tools -n vim',
+                         'channel delete -c rhel-base -r')
+        self.assertEqual(deps, {'1': set(), '2': {'1'}})
+        self.assertEqual(self.spw.calls,
+                         [('channel.software.list_children', 'rhel-base')])
+
+
+class TestDaemon(unittest.TestCase):
+    '''Tests commands sent to houstond over its socket'''
+
+    def setUp(self):
+        self.moved = {}
+        self.spw = FakeSpacewalk({
+            'channel.software.get_details': lambda label: {'label': label},
+            'channel.software.list_subscribed_systems': lambda label: [
+                {'id': 1}],
+            'system.list_subscribable_base_channels': lambda s: [
+                {'label': 'prod-base'}],
+            'system.set_base_channel': lambda s, c: self.moved.update(
+                {s: c}) or 1,
+            'system.set_child_channels': lambda s, c: 1,
+        })
+        self.spw.server = 'https://spw.example.com/rpc/api'
+        self.spw.user = 'admin'
+        self.spw.profile = None
+        self.spw.throttle = libhouston.Throttle()
+        self.spw._channels = {}
+        self.spw._channels_lock = threading.Lock()
+        self.migrate = ['channel', 'migrate', '-f', 'dev-base', '-t',
+                        'prod-base']
+
+    def server(self, path=None):
+        '''Daemon server for the fake session, not yet listening'''
+        server = socketserver.UnixStreamServer(path, houston._DaemonHandler,
+                                               bind_and_activate=bool(path))
+        server.spw = self.spw
+        server.started = time.time()
+        server.served = 0
+        return server
+
+    def request(self, msg):
+        '''Sends msg to a handler on a socketpair, returns the replies'''
+        ours, theirs = socket.socketpair()
+        server = self.server()
+        self.addCleanup(server.server_close)
+
+        def handle():
+            with theirs:
+                houston._DaemonHandler(theirs, None, server)
+
+        handler = threading.Thread(target=handle)
+        handler.start()
+        with ours, ours.makefile('rwb') as fh:
+            houston._send(fh, msg)
+            replies = [json.loads(line.decode()) for line in fh]
+        handler.join()
+        return replies
+
+    def test_status(self):
+        '''Tests the status shows the session'''
+        status = self.request({'control': 'status'})[0]['status']
+        self.assertEqual(status['server'], self.spw.server)
+        self.assertEqual(status['commands'], 0)
+
+    def test_run(self):
+        '''Tests commands run with the daemon's session'''
+        self.assertEqual(self.request({'argv': self.migrate}),
+                         [{'exit': 0}])
+        self.assertEqual(self.moved, {1: 'prod-base'})
+
+    def test_same_server(self):
+        '''Tests the daemon's server given another way still runs'''
+        self.assertEqual(
+            self.request({'argv': ['-s', 'spw.example.com', '-u', 'admin'] +
+                          self.migrate}), [{'exit': 0}])
+
+    def test_fallback(self):
+        '''Tests other servers, users and profiles are run directly'''
+        for opts in [['-s', 'other.example.com'], ['-u', 'root'],
+                     ['-P', 'prod'], ['--servers', 'all']]:
+            self.assertEqual(self.request({'argv': opts + self.migrate}),
+                             [{'fallback': True}], opts)
+        self.assertEqual(self.moved, {})
+
+    def test_run_via_daemon(self):
+        '''Tests the client runs commands through a listening daemon'''
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, 'houstond.sock')
+        with unittest.mock.patch.dict(os.environ, {'HOUSTOND_SOCKET': path}):
+            self.assertIsNone(houston._run_via_daemon(self.migrate))
+            server = self.server(path)
+            thread = threading.Thread(target=server.serve_forever,
+                                      args=(0.05,))
+            thread.start()
+            try:
+                self.assertEqual(houston._run_via_daemon(self.migrate), 0)
+                self.assertIsNone(houston._run_via_daemon(
+                    ['-P', 'prod'] + self.migrate))
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
+        self.assertEqual(server.served, 2)
+
+    def test_start_options(self):
+        '''Tests daemon start passes the session options on'''
+        a = houston.build_parser().parse_args(
+            ['-P', 'prod', '-v', '--rate', '5', '--transport', 'fast',
+             '--compress-requests', '4096', 'daemon', 'start'])
+        self.assertEqual(houston._daemon_argv(a), [
+            '-P', 'prod', '--rate', '5.0', '--compress-requests', '4096',
+            '--transport', 'fast', '-v', 'daemon', 'run'])
+
+
+if __name__ == '__main__':
+    unittest.main()
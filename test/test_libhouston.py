@@ -4,7 +4,19 @@
 '''
 
 import Houston.libhouston as libhouston
+import base64
+import gzip
+import hashlib
+import http.server
+import os
+import tempfile
+import threading
+import time
 import unittest
+import unittest.mock
+import weakref
+import xml.etree.ElementTree
+import xmlrpc.client
 
 spw = libhouston.Spacewalk()
 pkg = libhouston.PKG(40472, spw)
@@ -42,6 +54,98 @@ pkg_keys = [
 ]
 
 
+class FakeSpacewalk(libhouston.Spacewalk):
+    '''Spacewalk session answering api calls from handlers, no server needed
+
+    :param dict handlers: 'namespace.method' mapped to a callable taking the
+        call's arguments
+    :param journal: :class:`libhouston.Journal` to record changes in (opt)
+
+    '''
+
+    def __init__(self, handlers=None, journal=None):
+        self.handlers = dict(handlers or {})
+        self.calls = []
+        self.server = 'https://spw.example.com/rpc/api'
+        self.workers = 4
+        self.journal = journal
+        self._channels = weakref.WeakValueDictionary()
+        self._channels_lock = threading.Lock()
+        self._api_calllist = ()
+
+    def api_call(self, namespace, method, *args, fields=None):
+        api = '{}.{}'.format(namespace, method)
+        self.calls.append((api,) + args)
+        if api not in self.handlers:
+            raise libhouston.SpacewalkAPIError("No such Api Method: "
+                                               "{}".format(api))
+        return self.handlers[api](*args)
+
+    def count(self, api):
+        '''Number of calls made to api'''
+        return sum(1 for c in self.calls if c[0] == api)
+
+
+def fake_channels(channels, pkgs):
+    '''Handlers serving channel.software calls from in memory channels
+
+    :param dict channels: label mapped to a dict of **pkgs** (ids), and
+        optionally **parent**, **original** (label of the channel it was
+        cloned from), **errata** (names) and **systems** (ids)
+    :param dict pkgs: package id mapped to (name, epoch, version, release)
+
+    '''
+    def pkg(i):
+        name, epoch, version, release = pkgs[i]
+        return {'id': i, 'name': name, 'epoch': epoch, 'version': version,
+                'release': release, 'arch_label': 'x86_64'}
+
+    def details(label):
+        if label not in channels:
+            raise libhouston.SpacewalkAPIError("No such channel")
+        return {'label': label, 'name': label, 'summary': label,
+                'arch_name': 'x86_64', 'arch_label': 'channel-x86_64',
+                'parent_channel_label': channels[label].get('parent', ''),
+                'clone_original': channels[label].get('original', '')}
+
+    def latest(label):
+        return libhouston.latest_packages(
+            [dict(pkg(i), arch='x86_64') for i in channels[label]['pkgs']])
+
+    def add(label, ids):
+        channels[label]['pkgs'].extend(ids)
+        return 1
+
+    def remove(label, ids):
+        channels[label]['pkgs'] = [i for i in channels[label]['pkgs']
+                                   if i not in ids]
+        return 1
+
+    # an erratum has the same id in every channel it is in
+    errata_ids = {}
+    ns = 'channel.software.'
+    return {
+        ns + 'get_details': details,
+        ns + 'get_repo_sync_cron_expression': lambda label: '',
+        ns + 'is_globally_subscribable': lambda label: True,
+        ns + 'list_latest_packages': latest,
+        ns + 'list_all_packages': lambda label: [
+            pkg(i) for i in channels[label]['pkgs']],
+        ns + 'list_channel_repos': lambda label: [],
+        ns + 'list_children': lambda label: [
+            {'label': c} for c, v in sorted(channels.items())
+            if v.get('parent') == label],
+        ns + 'list_errata': lambda label: [
+            {'id': errata_ids.setdefault(e, 100 + len(errata_ids)),
+             'advisory_name': e}
+            for e in channels[label].get('errata', [])],
+        ns + 'list_subscribed_systems': lambda label: [
+            {'id': s} for s in channels[label].get('systems', [])],
+        ns + 'add_packages': add,
+        ns + 'remove_packages': remove,
+    }
+
+
 class TestPKGDetailsGoodID(unittest.TestCase):
     '''checks all appropriate fields are filled in on the package'''
 
@@ -50,6 +154,123 @@ class TestPKGDetailsGoodID(unittest.TestCase):
             self.assertTrue(key in pkg.keys())
 
 
+class TestPKGLazyKeys(unittest.TestCase):
+    '''Tests keys fetched on first use still look like any other key'''
+
+    def setUp(self):
+        self.spw = FakeSpacewalk({
+            'packages.get_details': lambda i: {
+                'id': i, 'name': 'bash', 'version': '4.1', 'release': '2',
+                'epoch': '', 'arch_label': 'x86_64'},
+            'packages.list_dependencies': lambda i: [
+                {'dependency': 'glibc', 'dependency_type': 'requires',
+                 'dependency_modifier': '>= 2.12'}],
+        })
+        self.pkg = libhouston.PKG(7, self.spw)
+
+    def test_keys(self):
+        '''Tests lazy keys are listed without being fetched'''
+        for key in ['url', 'conflicts', 'obsoletes', 'provides', 'requires',
+                    'files', 'channels', 'errata']:
+            self.assertIn(key, self.pkg.keys())
+            self.assertTrue(key in self.pkg)
+        self.assertEqual(len(self.spw.calls), 1)
+
+    def test_get(self):
+        '''Tests get fetches a lazy key once'''
+        self.assertEqual(self.pkg.get('requires'), [('glibc', '>= 2.12')])
+        self.assertEqual(self.pkg.get('provides'), [])
+        self.assertEqual(self.pkg.get('nothing', 5), 5)
+        self.assertEqual(self.spw.count('packages.list_dependencies'), 1)
+
+
+class TestRepodata(unittest.TestCase):
+    '''Tests repodata is written from the cache and refetched on change'''
+
+    def setUp(self):
+        self.checksums = {1: 'aa', 2: 'bb'}
+        names = {1: 'bash', 2: 'zsh'}
+        self.spw = FakeSpacewalk({
+            'packages.get_details': lambda i: {
+                'id': i, 'name': names[i], 'version': '4.1',
+                'release': '2.el6', 'epoch': '', 'arch_label': 'x86_64',
+                'checksum': self.checksums[i], 'checksum_type': 'sha256',
+                'size': '1024', 'payload_size': '4096',
+                'file': '/var/satellite/{}.rpm'.format(names[i])},
+            'packages.list_dependencies': lambda i: [
+                {'dependency': 'glibc', 'dependency_type': 'requires',
+                 'dependency_modifier': '>= 2.12'},
+                {'dependency': 'rpmlib(PayloadIsXz)',
+                 'dependency_type': 'requires',
+                 'dependency_modifier': '<= 5.2-1'}],
+            'packages.list_files': lambda i: [
+                {'path': '/bin/' + names[i], 'type': 'file'}],
+        })
+        self.tmp = tempfile.TemporaryDirectory()
+        self.repodata = libhouston.Repodata(
+            self.spw, os.path.join(self.tmp.name, 'cache', 'repodata.db'))
+
+    def tearDown(self):
+        self.repodata.close()
+        self.tmp.cleanup()
+
+    def listed(self):
+        return [{'id': i, 'checksum': c, 'last_modified': '2016-01-01'}
+                for i, c in sorted(self.checksums.items())]
+
+    def primary(self):
+        ns = {'c': 'http://linux.duke.edu/metadata/common',
+              'rpm': 'http://linux.duke.edu/metadata/rpm'}
+        repodata = os.path.join(self.tmp.name, 'repodata')
+        name = [f for f in os.listdir(repodata)
+                if f.endswith('-primary.xml.gz')][0]
+        with gzip.open(os.path.join(repodata, name)) as fh:
+            root = xml.etree.ElementTree.parse(fh).getroot()
+        return root, ns
+
+    def test_primary(self):
+        '''Tests the written primary.xml parses back to the packages'''
+        self.assertEqual(self.repodata.fetch(self.listed()), 2)
+        self.assertEqual(self.repodata.write([1, 2], self.tmp.name), 2)
+        root, ns = self.primary()
+        self.assertEqual(root.get('packages'), '2')
+        pkgs = root.findall('c:package', ns)
+        self.assertEqual([p.find('c:name', ns).text for p in pkgs],
+                         ['bash', 'zsh'])
+        bash = pkgs[0]
+        self.assertEqual(bash.find('c:version', ns).attrib,
+                         {'epoch': '0', 'ver': '4.1', 'rel': '2.el6'})
+        self.assertEqual(bash.find('c:checksum', ns).text, 'aa')
+        self.assertEqual(bash.find('c:location', ns).get('href'),
+                         'Packages/aa/bash.rpm')
+        self.assertEqual(bash.find('c:size', ns).attrib,
+                         {'package': '1024', 'installed': '0',
+                          'archive': '4096'})
+        requires = bash.findall('c:format/rpm:requires/rpm:entry', ns)
+        self.assertEqual([(r.get('name'), r.get('flags'), r.get('ver'))
+                          for r in requires], [('glibc', 'GE', '2.12')])
+        self.assertEqual(bash.find('c:format/c:file', ns).text, '/bin/bash')
+
+    def test_refetch(self):
+        '''Tests only packages changed on the server are fetched again'''
+        self.repodata.fetch(self.listed())
+        self.assertEqual(self.repodata.fetch(self.listed()), 0)
+        self.checksums[2] = 'cc'
+        self.assertEqual(self.repodata.fetch(self.listed()), 1)
+        self.assertEqual(self.spw.count('packages.get_details'), 3)
+        self.repodata.write([1, 2], self.tmp.name)
+        root, ns = self.primary()
+        self.assertEqual([p.find('c:checksum', ns).text
+                          for p in root.findall('c:package', ns)],
+                         ['aa', 'cc'])
+
+    def test_unfetched(self):
+        '''Tests writing a package missing from the cache fails'''
+        self.repodata.fetch(self.listed()[:1])
+        self.assertRaises(libhouston.SpacewalkError, self.repodata.write,
+                          [1, 2], self.tmp.name)
+
+
 class TestPKGcomparisonsGoodStringInputs(unittest.TestCase):
     '''Tests the rich comparison functions for PKG'''
 
@@ -118,5 +339,1438 @@ class TestPKGcomparisonsBadStringInputs(unittest.TestCase):
             self.assertFalse(pkg < v)
 
 
+class TestRpmVerCmp(unittest.TestCase):
+    '''Tests version comparisons follow rpm ordering'''
+
+    def test_newer(self):
+        '''Tests _rpmvercmp returns 1 when first version is newer'''
+        for v in older_versions:
+            self.assertEqual(libhouston._rpmvercmp('1.7.5rc2', v), 1)
+
+    def test_older(self):
+        '''Tests _rpmvercmp returns -1 when first version is older'''
+        for v in newer_versions:
+            self.assertEqual(libhouston._rpmvercmp('1.7.5rc2', v), -1)
+
+    def test_identical(self):
+        '''Tests _rpmvercmp returns 0 for equivalent versions'''
+        for v in identical_versions:
+            self.assertEqual(libhouston._rpmvercmp('1.7.5rc2', v), 0)
+
+    def test_tilde_and_caret(self):
+        '''Tests ~ sorts before and ^ after the end of a version'''
+        self.assertEqual(libhouston._rpmvercmp('1.0~rc1', '1.0'), -1)
+        self.assertEqual(libhouston._rpmvercmp('1.0^1', '1.0'), 1)
+        self.assertEqual(libhouston._rpmvercmp('1.0^1', '1.0.1'), -1)
+
+    def test_epoch(self):
+        '''Tests epoch outweighs version'''
+        self.assertEqual(libhouston._evr_cmp(('1', '1.0', '1'),
+                                             ('', '2.0', '1')), 1)
+
+    def test_latest_packages(self):
+        '''Tests newest of each name and arch is kept'''
+        pkgs = [
+            {'id': 1, 'name': 'a', 'arch': 'x86_64', 'epoch': '',
+             'version': '1.0', 'release': '10'},
+            {'id': 2, 'name': 'a', 'arch': 'x86_64', 'epoch': '',
+             'version': '1.0', 'release': '9'},
+            {'id': 3, 'name': 'a', 'arch': 'i686', 'epoch': '',
+             'version': '0.9', 'release': '1'},
+        ]
+        self.assertEqual(sorted(p['id'] for p in
+                                libhouston.latest_packages(pkgs)), [1, 3])
+
+    def test_prune_packages(self):
+        '''Tests versions beyond the newest N of each package are picked'''
+        pkgs = [
+            {'id': 1, 'name': 'a', 'arch': 'x86_64', 'epoch': '',
+             'version': '1.0', 'release': '9'},
+            {'id': 2, 'name': 'a', 'arch': 'x86_64', 'epoch': '',
+             'version': '1.0', 'release': '10'},
+            {'id': 3, 'name': 'a', 'arch': 'x86_64', 'epoch': '1',
+             'version': '0.1', 'release': '1'},
+            {'id': 4, 'name': 'a', 'arch': 'i686', 'epoch': '',
+             'version': '0.9', 'release': '1'},
+        ]
+        self.assertEqual([p['id'] for p in
+                          libhouston.prune_packages(pkgs, 2)], [1])
+        self.assertEqual(libhouston.prune_packages(pkgs, 3), [])
+
+
+class TestParseNVREA(unittest.TestCase):
+    '''Tests package specifications are split correctly'''
+
+    def test_full(self):
+        '''Tests a full NVREA string'''
+        self.assertEqual(
+            libhouston._parse_nvrea('openssl-1:1.0.1e-16.el6.x86_64'),
+            {'name': 'openssl', 'epoch': '1', 'version': '1.0.1e',
+             'release': '16.el6', 'arch': 'x86_64'})
+
+    def test_name_only(self):
+        '''Tests a name containing dashes'''
+        self.assertEqual(libhouston._parse_nvrea('libstdc++-devel')['name'],
+                         'libstdc++-devel')
+
+    def test_name_version(self):
+        '''Tests a name and version without release'''
+        p = libhouston._parse_nvrea('python-2.7')
+        self.assertEqual((p['name'], p['version'], p['release']),
+                         ('python', '2.7', None))
+
+
+class TestEVRConstraints(unittest.TestCase):
+    '''Tests version constraints are parsed and matched correctly'''
+
+    def matches(self, evr, spec):
+        return libhouston._evr_matches(
+            libhouston._parse_evr(evr),
+            libhouston._parse_evr_constraints(spec))
+
+    def test_less_than(self):
+        '''Tests a release older than the constraint matches'''
+        self.assertTrue(self.matches('1.0.1e-15', '<1.0.1e-16'))
+        self.assertFalse(self.matches('1.0.1e-16', '<1.0.1e-16'))
+
+    def test_range(self):
+        '''Tests comma seperated constraints must all match'''
+        self.assertTrue(self.matches('1.5-1', '>=1.0,<2'))
+        self.assertFalse(self.matches('2.0-1', '>=1.0,<2'))
+
+    def test_epoch(self):
+        '''Tests the epoch outweighs the version'''
+        self.assertTrue(self.matches('1:0.9-1', '>2.0'))
+
+    def test_no_operator(self):
+        '''Tests a bare version matches any release of it'''
+        self.assertTrue(self.matches('1.0-7', '1.0'))
+        self.assertTrue(self.matches('1.0-7', ''))
+
+
+class TestDepsOverlap(unittest.TestCase):
+    '''Tests provided versions are matched against requirements'''
+
+    def overlap(self, provide, require):
+        return libhouston._deps_overlap(
+            libhouston._parse_dep_modifier(provide),
+            libhouston._parse_dep_modifier(require))
+
+    def test_unversioned(self):
+        '''Tests an unversioned provide or require matches anything'''
+        self.assertTrue(self.overlap('', '>= 2.12'))
+        self.assertTrue(self.overlap('= 1.0-1', ''))
+
+    def test_exact_provide(self):
+        '''Tests an exact provide is checked against the required range'''
+        self.assertTrue(self.overlap('= 2.12-1', '>= 2.12'))
+        self.assertFalse(self.overlap('= 2.11-1', '>= 2.12'))
+        self.assertFalse(self.overlap('= 1:1.0-1', '< 2.0'))
+
+    def test_ranges(self):
+        '''Tests open ranges overlap unless they point apart'''
+        self.assertTrue(self.overlap('>= 1.0', '< 2.0'))
+        self.assertFalse(self.overlap('< 1.0', '> 2.0'))
+        self.assertFalse(self.overlap('< 1.0', '>= 1.0'))
+
+
+class TestServerHost(unittest.TestCase):
+    '''Tests the host is pulled out of server names and urls'''
+
+    def test_forms(self):
+        '''Tests names and urls of a server give the same host'''
+        for url in ['spw.example.com', 'https://spw.example.com',
+                    'https://spw.example.com/rpc/api',
+                    'http://spw.example.com/rpc/api/',
+                    'https://spw.example.com/']:
+            self.assertEqual(libhouston.server_host(url), 'spw.example.com')
+
+    def test_cache_file(self):
+        '''Tests each server keeps its caches in a directory of its own'''
+        spw = FakeSpacewalk()
+        self.assertEqual(spw._cache_file('index.db'), os.path.join(
+            os.path.expanduser('~/.houston'), 'spw.example.com', 'index.db'))
+
+
+class TestImap(unittest.TestCase):
+    '''Tests bounded lazy fan-out'''
+
+    def setUp(self):
+        # imap needs no session, skip logging in
+        self.spw = libhouston.Spacewalk.__new__(libhouston.Spacewalk)
+        self.spw.workers = 4
+
+    def test_order(self):
+        '''Tests results come back in the order of the input'''
+        self.assertEqual(list(self.spw.imap(lambda x: x * 2, range(50))),
+                         [x * 2 for x in range(50)])
+
+    def test_window(self):
+        '''Tests no more than window items are read ahead'''
+        read = []
+
+        def items():
+            for i in range(1000):
+                read.append(i)
+                yield i
+
+        results = self.spw.imap(lambda x: x, items(), window=5)
+        self.assertEqual(next(results), 0)
+        results.close()
+        self.assertLessEqual(len(read), 5)
+
+
+class TestCassette(unittest.TestCase):
+    '''Tests recorded calls are played back'''
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.gz')
+        os.close(fd)
+        self.addCleanup(os.unlink, self.path)
+
+    def call(self, method, *params):
+        return xmlrpc.client.dumps(params, method).encode('utf-8')
+
+    def reply(self, value):
+        return xmlrpc.client.dumps((value,), methodresponse=True).encode()
+
+    def test_replay(self):
+        '''Tests exact matches are preferred and the password is left out'''
+        cassette = libhouston.Cassette(self.path, 'w')
+        cassette.record(self.call('auth.login', 'admin', 'secret'),
+                        self.reply('KEY'), 0.5, 'https://spw/rpc/api')
+        cassette.record(self.call('system.get_name', 'KEY', 1),
+                        self.reply('one'), 0.1)
+        cassette.record(self.call('system.get_name', 'KEY', 2),
+                        self.reply('two'), 0.1)
+        cassette.close()
+
+        cassette = libhouston.Cassette(self.path, 'r', scale=0)
+        self.assertEqual((cassette.server, cassette.user),
+                         ('https://spw/rpc/api', 'admin'))
+        with gzip.open(self.path) as fh:
+            self.assertNotIn(b'secret', fh.read())
+
+        body, wait = cassette.play(self.call('system.get_name', 'KEY', 2))
+        self.assertEqual(xmlrpc.client.loads(body)[0][0], 'two')
+        self.assertEqual(wait, 0)
+        body, _ = cassette.play(self.call('system.get_name', 'KEY', 3))
+        self.assertEqual(xmlrpc.client.loads(body)[0][0], 'one')
+        self.assertEqual(cassette.unplayed(), 1)
+        self.assertRaises(libhouston.SpacewalkError, cassette.play,
+                          self.call('system.get_name', 'KEY', 4))
+
+
+class TestFastUnmarshal(unittest.TestCase):
+    '''Tests the fast transport decodes responses as the stock one does'''
+
+    def stock(self, body):
+        parser, unmarshaller = xmlrpc.client.getparser()
+        parser.feed(body)
+        parser.close()
+        return unmarshaller.close()
+
+    def test_values(self):
+        '''Tests every xmlrpc type comes back the same'''
+        values = [
+            1, -5, '', 'a&b<c>', 'caf\xe9', True, False, 1.5, None, [], {},
+            xmlrpc.client.DateTime('20140101T10:00:00'),
+            xmlrpc.client.Binary(b'\x00\x01'),
+            [{'id': 1, 'files': [{'path': '/etc/x'}], 'meta': {'a': None}}],
+        ]
+        for value in values:
+            body = xmlrpc.client.dumps((value,), methodresponse=True,
+                                       allow_none=True).encode('utf-8')
+            self.assertEqual(libhouston._fast_unmarshal(body),
+                             self.stock(body))
+
+    def test_fault(self):
+        '''Tests faults are raised'''
+        body = xmlrpc.client.dumps(xmlrpc.client.Fault(2, 'No such channel'),
+                                   methodresponse=True).encode('utf-8')
+        with self.assertRaises(xmlrpc.client.Fault) as cm:
+            libhouston._fast_unmarshal(body)
+        self.assertEqual(cm.exception.faultCode, 2)
+
+    def test_fields(self):
+        '''Tests only the wanted members of listed structs are kept'''
+        pkgs = [{'id': 1, 'name': 'bash', 'meta': {'name': 'x'}}]
+        body = xmlrpc.client.dumps((pkgs,), methodresponse=True).encode()
+        self.assertEqual(libhouston._fast_unmarshal(body, {'id', 'meta'}),
+                         ([{'id': 1, 'meta': {'name': 'x'}}],))
+
+
+class TestFindPackages(unittest.TestCase):
+    '''Tests packages are found only in the channels asked for'''
+
+    def setUp(self):
+        self.channels = {'dev-base': {'pkgs': [1, 2]},
+                         'dev-tools': {'pkgs': [3]}}
+        handlers = fake_channels(self.channels, {
+            i: ('bash', '', '4.1', '2') for i in range(1, 10)})
+        handlers['packages.find_by_nvrea'] = lambda *a: [
+            {'id': i, 'name': 'bash', 'epoch': '', 'version': '4.1',
+             'release': '2', 'arch_label': 'x86_64'} for i in [1, 9]]
+        self.spw = FakeSpacewalk(handlers)
+
+    def test_any_channel(self):
+        '''Tests every match is found without channels'''
+        self.assertEqual(
+            [p['id'] for p in self.spw.find_packages('bash-4.1-2.x86_64')],
+            [1, 9])
+
+    def test_channels(self):
+        '''Tests packages only in other channels are left out'''
+        self.assertEqual(
+            [p['id'] for p in self.spw.find_packages(
+                'bash-4.1-2.x86_64', ['dev-base', 'dev-tools'])], [1])
+        self.assertEqual(
+            self.spw.count('channel.software.list_all_packages'), 2)
+
+    def test_shared_ids(self):
+        '''Tests channel package ids looked up once are used as given'''
+        ids = self.spw.channel_package_ids(['dev-base', 'dev-tools'])
+        self.assertEqual(ids, {1, 2, 3})
+        for i in range(3):
+            self.spw.find_packages('bash-4.1-2.x86_64', ['dev-base'], ids)
+        self.assertEqual(
+            self.spw.count('channel.software.list_all_packages'), 2)
+
+
+class TestChannelCache(unittest.TestCase):
+    '''Tests the identity map of channels in use'''
+
+    def setUp(self):
+        self.channels = {'dev-base': {'pkgs': [1, 2, 3]}}
+        self.spw = FakeSpacewalk(fake_channels(self.channels, {
+            1: ('openssl', '', '1.0.1e', '15'),
+            2: ('openssl', '', '1.0.1e', '16'),
+            3: ('bash', '', '4.1', '2'),
+            4: ('openssl', '', '1.0.1e', '30'),
+        }))
+
+    def test_shared(self):
+        '''Tests a channel in use is handed out again without any calls'''
+        channel = libhouston.Channel('dev-base', self.spw)
+        calls = len(self.spw.calls)
+        self.assertIs(libhouston.Channel('dev-base', self.spw), channel)
+        self.assertEqual(len(self.spw.calls), calls)
+
+    def test_evicted(self):
+        '''Tests a dropped channel leaves the map straight away'''
+        channel = libhouston.Channel('dev-base', self.spw)
+        del channel
+        self.assertIsNone(self.spw.cached_channel('dev-base'))
+        libhouston.Channel('dev-base', self.spw)
+        self.assertEqual(self.spw.count('channel.software.get_details'), 2)
+
+    def test_forget(self):
+        '''Tests forgotten channels are loaded again'''
+        channel = libhouston.Channel('dev-base', self.spw)
+        self.spw.forget_channels()
+        self.assertIsNot(libhouston.Channel('dev-base', self.spw), channel)
+
+    def test_exists_asks_server(self):
+        '''Tests a channel deleted behind houston's back isn't found'''
+        channel = libhouston.Channel('dev-base', self.spw)
+        del self.channels['dev-base']
+        self.assertRaises(libhouston.SpacewalkChannelNotFound,
+                          self.spw.channel_exists, 'dev-base')
+        self.assertEqual(channel['label'], 'dev-base')
+
+    def test_add_remove(self):
+        '''Tests latest and older packages follow adds and removes'''
+        channel = libhouston.Channel('dev-base', self.spw)
+        self.assertEqual(sorted(channel['latest_pkgs']), [2, 3])
+        self.spw.add_packages('dev-base', [4])
+        self.assertEqual(sorted(channel['all_pkgs']), [1, 2, 3, 4])
+        self.assertEqual(sorted(channel['latest_pkgs']), [3, 4])
+        self.assertEqual(sorted(channel['older_pkgs']), [1, 2])
+        self.spw.remove_packages('dev-base', [4, 2])
+        self.assertEqual(sorted(channel['latest_pkgs']), [1, 3])
+        self.assertEqual(channel['older_pkgs'], [])
+
+
+
+class TestSnapshot(unittest.TestCase):
+    '''Tests saving channels to snapshot files and loading them again'''
+
+    def setUp(self):
+        self.channels = {
+            'dev-base': {'pkgs': [1, 2, 3], 'errata': ['CLA-2014:0001'],
+                         'systems': [7]},
+            'dev-tools': {'pkgs': [3], 'parent': 'dev-base'},
+        }
+        self.spw = FakeSpacewalk(fake_channels(self.channels, {
+            1: ('openssl', '', '1.0.1e', '15'),
+            2: ('openssl', '', '1.0.1e', '16'),
+            3: ('bash', '1', '4.1', '2'),
+            4: ('openssl', '', '1.0.1e', '30'),
+        }))
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'dev-base.snap')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_roundtrip(self):
+        '''Tests a loaded channel is saved without looking it up again'''
+        channel = libhouston.Channel('dev-base', self.spw)
+        calls = len(self.spw.calls)
+        self.assertEqual(channel.to_snapshot(self.path), 2)
+        self.assertEqual(len(self.spw.calls), calls)
+
+        loaded = libhouston.Channel.from_snapshot(self.path)
+        for key in ['all_pkgs', 'latest_pkgs', 'older_pkgs', 'errata',
+                    'systems']:
+            self.assertEqual(list(loaded[key]), channel[key], key)
+        self.assertEqual(loaded['errata_names'], channel['errata_names'])
+        self.assertEqual(loaded['nvrea'][3], ('bash', '1', '4.1', '2',
+                                               'x86_64'))
+        self.assertEqual([c['label'] for c in loaded['children']],
+                         ['dev-tools'])
+        self.assertEqual(list(loaded['children'][0]['all_pkgs']), [3])
+
+    def test_latest_by_version(self):
+        '''Tests the latest packages don't depend on the package order'''
+        channel = libhouston.Channel('dev-base', self.spw)
+        self.spw.add_packages('dev-base', [4])
+        calls = self.spw.count('channel.software.list_all_packages')
+        channel.to_snapshot(self.path)
+        # only the changed channel is looked up again
+        self.assertEqual(
+            self.spw.count('channel.software.list_all_packages') - calls, 1)
+
+        loaded = libhouston.Channel.from_snapshot(self.path)
+        self.assertEqual(sorted(loaded['latest_pkgs']), [3, 4])
+        self.assertEqual(sorted(loaded['older_pkgs']), [1, 2])
+        self.assertEqual(loaded['nvrea'][4][3], '30')
+
+
+class TestPromote(unittest.TestCase):
+    '''Tests promoting only the differences between two channels'''
+
+    def setUp(self):
+        # stage-base was cloned from qa-base, so its errata are clones
+        self.channels = {
+            'qa-base': {'pkgs': [1, 2, 3],
+                        'errata': ['RHSA-2014:0001', 'RHSA-2014:0002']},
+            'stage-base': {'pkgs': [1, 4], 'original': 'qa-base',
+                           'errata': ['CLA-2014:0001', 'CLA-2014:0009']},
+        }
+        errata_pkgs = {'RHSA-2014:0002': [3]}
+        handlers = fake_channels(self.channels, {
+            i: ('pkg{}'.format(i), '', '1', '1') for i in range(1, 5)})
+
+        def merge_errata(source, label, names):
+            for name in names:
+                self.channels[label]['errata'].append(name)
+                self.channels[label]['pkgs'].extend(errata_pkgs[name])
+            return []
+
+        def remove_errata(label, names, remove_pkgs):
+            self.channels[label]['errata'] = [
+                e for e in self.channels[label]['errata'] if e not in names]
+            return 1
+
+        handlers['channel.software.merge_errata'] = merge_errata
+        handlers['channel.software.remove_errata'] = remove_errata
+        self.spw = FakeSpacewalk(handlers)
+        self.src = libhouston.Channel('qa-base', self.spw)
+        self.dst = libhouston.Channel('stage-base', self.spw)
+
+    def test_delta(self):
+        '''Tests packages and errata missing or extra are found'''
+        self.assertEqual(self.src.delta(self.dst), {
+            'add_pkgs': [2, 3], 'remove_pkgs': [4], 'errata': [101],
+            'errata_remove': ['CLA-2014:0009']})
+        self.assertEqual(self.src.delta(self.src), {
+            'add_pkgs': [], 'remove_pkgs': [], 'errata': [],
+            'errata_remove': []})
+
+    def test_promote(self):
+        '''Tests only new errata are merged and extra ones removed'''
+        self.src.promote(self.dst)
+        for api in ['merge_errata', 'remove_errata', 'add_packages',
+                    'remove_packages']:
+            self.assertEqual(self.spw.count('channel.software.' + api), 1)
+        self.assertIn(('channel.software.merge_errata', 'qa-base',
+                       'stage-base', ['RHSA-2014:0002']), self.spw.calls)
+        self.assertIn(('channel.software.remove_errata', 'stage-base',
+                       ['CLA-2014:0009'], False), self.spw.calls)
+        # packages brought in by the errata aren't added again
+        self.assertIn(('channel.software.add_packages', 'stage-base', [2]),
+                      self.spw.calls)
+        self.assertEqual(sorted(self.channels['stage-base']['pkgs']),
+                         [1, 2, 3])
+        self.assertEqual(self.channels['stage-base']['errata'],
+                         ['CLA-2014:0001', 'RHSA-2014:0002'])
+        self.assertFalse(any(self.src.delta(self.dst).values()))
+
+
+class TestApplicableErrata(unittest.TestCase):
+    '''Tests errata applicability worked out from the local index'''
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.index = libhouston.PackageIndex(
+            FakeSpacewalk(), os.path.join(self.tmp.name, 'index.db'))
+        db = self.index.db
+        with db:
+            db.executemany('INSERT INTO systems VALUES (?, ?, ?)', [
+                (1, 'web01', ''), (2, 'web02', ''), (3, 'db01', '')])
+            db.executemany('INSERT INTO packages VALUES (?, ?, ?, ?, ?, ?)', [
+                (1, 'openssl', '', '1.0.1e', '15', 'x86_64'),
+                (2, 'openssl', '', '1.0.1e', '16', 'x86_64'),
+                (2, 'bash', '', '4.1', '2', 'x86_64'),
+                (3, 'openssl', '', '1.0.1e', '15', 'i686'),
+                (3, 'bash', '', '4.1', '2', 'x86_64')])
+            db.executemany('INSERT INTO channel_systems VALUES (?, ?)', [
+                ('prod-base', 1), ('prod-base', 2), ('prod-base', 3)])
+            db.executemany('INSERT INTO channel_errata VALUES (?, ?)', [
+                ('prod-base', 'CLSA-1'), ('prod-base', 'CLBA-2'),
+                ('dev-base', 'CLSA-3')])
+            db.executemany('INSERT INTO errata VALUES (?, ?, ?, ?)', [
+                ('CLSA-1', 'Security Advisory', 'openssl', ''),
+                ('CLBA-2', 'Bug Fix Advisory', 'bash', ''),
+                ('CLSA-3', 'Security Advisory', 'bash', '')])
+            db.executemany(
+                'INSERT INTO errata_packages VALUES (?, ?, ?, ?, ?, ?)', [
+                    ('CLSA-1', 'openssl', '', '1.0.1e', '16', 'x86_64'),
+                    ('CLBA-2', 'bash', '', '4.1', '2', 'x86_64'),
+                    ('CLSA-3', 'bash', '', '4.2', '1', 'x86_64')])
+
+    def tearDown(self):
+        self.index.close()
+        self.tmp.cleanup()
+
+    def test_newer(self):
+        '''Tests only newer versions from subscribed channels apply'''
+        self.assertEqual(
+            [(e['id'], e['advisory']) for e in
+             self.index.applicable_errata()], [(1, 'CLSA-1')])
+
+    def test_type(self):
+        '''Tests errata can be narrowed down by type'''
+        self.assertEqual(self.index.applicable_errata('Bug Fix Advisory'), [])
+        self.assertEqual(
+            self.index.applicable_errata('Security Advisory')[0],
+            {'id': 1, 'system': 'web01', 'advisory': 'CLSA-1',
+             'type': 'Security Advisory', 'synopsis': 'openssl'})
+
+
+class TestActionTracker(unittest.TestCase):
+    '''Tests following actions until their systems finish'''
+
+    def setUp(self):
+        # in progress counts seen by each poll, None once finished
+        self.polls = [(0, 0), (0, 0), (0, 0), (1, 0), (1, 0), None]
+        self.done = []
+
+        def in_progress():
+            counts = self.polls.pop(0)
+            if counts is None:
+                self.done = [{'server_id': 11}, {'server_id': 12}]
+                return []
+            self.done = [{'server_id': 11}][:counts[0]]
+            return [{'id': 5, 'completedSystems': counts[0],
+                     'failedSystems': counts[1]}]
+
+        self.spw = FakeSpacewalk({
+            'schedule.list_in_progress_actions': in_progress,
+            'schedule.list_completed_systems': lambda a: self.done,
+            'schedule.list_failed_systems': lambda a: [],
+        })
+
+    def test_backoff(self):
+        '''Tests the wait grows while nothing changes and drops back'''
+        tracker = libhouston.ActionTracker(self.spw, [5], min_interval=2,
+                                           max_interval=5)
+        with unittest.mock.patch.object(libhouston.time, 'sleep') as sleep:
+            events = list(tracker.wait())
+        self.assertEqual([c[0][0] for c in sleep.call_args_list],
+                         [3, 4.5, 5, 2, 3])
+        self.assertEqual([(a, s, d['server_id']) for a, s, d in events],
+                         [(5, 'completed', 11), (5, 'completed', 12)])
+        self.assertEqual(tracker.pending, set())
+
+    def test_counts(self):
+        '''Tests systems are only listed when the counts change'''
+        tracker = libhouston.ActionTracker(self.spw, [5])
+        for i in range(5):
+            tracker.poll()
+        self.assertEqual(self.spw.count('schedule.list_completed_systems'),
+                         1)
+        self.assertEqual(self.spw.count('schedule.list_failed_systems'), 0)
+        tracker.poll()
+        self.assertEqual(self.spw.count('schedule.list_failed_systems'), 1)
+
+
+class TestChangeChannels(unittest.TestCase):
+    '''Tests moving systems on servers without schedule_change_channels'''
+
+    def setUp(self):
+        # system id mapped to the base and child channels it may use
+        self.allowed = {
+            1: (['prod-base'], ['prod-tools', 'prod-extras']),
+            2: (['prod-base'], ['prod-tools']),
+            3: (['dev-base'], []),
+        }
+        self.subscribed = {}
+        self.spw = FakeSpacewalk({
+            'system.list_subscribable_base_channels': lambda s: [
+                {'label': c} for c in self.allowed[s][0]],
+            'system.list_subscribable_child_channels': lambda s: [
+                {'label': c} for c in self.allowed[s][1]],
+            'system.set_base_channel': lambda s, c: self.subscribed.update(
+                {s: [c]}) or 1,
+            'system.set_child_channels': lambda s, c: self.subscribed[
+                s].extend(c) or 1,
+        })
+
+    def test_children(self):
+        '''Tests each system only gets the children it may use'''
+        self.assertEqual(self.spw.change_channels(
+            [2, 1], 'prod-base', ['prod-extras', 'prod-tools']), [])
+        self.assertEqual(self.subscribed, {
+            1: ['prod-base', 'prod-extras', 'prod-tools'],
+            2: ['prod-base', 'prod-tools']})
+
+    def test_failures(self):
+        '''Tests systems which can't move are reported after the rest'''
+        with self.assertRaises(libhouston.SpacewalkError) as e:
+            self.spw.change_channels([1, 2, 3], 'prod-base')
+        self.assertIn('1 of 3 systems', str(e.exception))
+        self.assertIn('3: cannot be subscribed to prod-base',
+                      str(e.exception))
+        self.assertEqual(sorted(self.subscribed), [1, 2])
+        self.assertEqual(self.spw.count(
+            'system.list_subscribable_child_channels'), 0)
+
+    def test_scheduled(self):
+        '''Tests servers which can schedule the change get one call'''
+        self.spw._api_calllist = ('system.schedule_change_channels',)
+        self.spw.handlers['system.schedule_change_channels'] = \
+            lambda sysids, base, children, earliest: [50]
+        self.assertEqual(self.spw.change_channels([3, 1, 2], 'prod-base'),
+                         [50])
+        self.assertEqual(len(self.spw.calls), 1)
+        self.assertEqual(self.spw.calls[0][:4],
+                         ('system.schedule_change_channels', [1, 2, 3],
+                          'prod-base', []))
+
+
+
+
+class TestSchedule(unittest.TestCase):
+    '''Tests actions scheduled on many systems at once'''
+
+    def setUp(self):
+        self.next_action = iter(range(500, 1000))
+        self.spw = FakeSpacewalk({
+            'system.schedule_package_install': lambda s, p, w: [
+                next(self.next_action) for i in s],
+            'system.schedule_apply_errata': lambda s, e, w: next(
+                self.next_action),
+            'system.schedule_reboot': lambda s, w: s * 10,
+        })
+
+    def chunks(self, api):
+        return [c[1] for c in self.spw.calls if c[0] == api]
+
+    def test_chunks(self):
+        '''Tests systems are sent in sorted chunks without duplicates'''
+        with unittest.mock.patch.object(libhouston, '_SCHEDULE_CHUNK_SIZE',
+                                        2):
+            actions = self.spw.schedule_package_install([5, 1, 3, 1, 4],
+                                                        [9, 8, 9])
+        self.assertEqual(sorted(self.chunks(
+            'system.schedule_package_install')), [[1, 3], [4, 5]])
+        self.assertEqual(self.spw.calls[0][2], [8, 9])
+        self.assertEqual(sorted(actions), [500, 501, 502, 503])
+
+    def test_single_action(self):
+        '''Tests older servers giving one action per call are handled'''
+        with unittest.mock.patch.object(libhouston, '_SCHEDULE_CHUNK_SIZE',
+                                        2):
+            actions = self.spw.schedule_apply_errata([1, 2, 3], [7])
+        self.assertEqual(len(self.chunks('system.schedule_apply_errata')), 2)
+        self.assertEqual(sorted(actions), [500, 501])
+
+    def test_reboot(self):
+        '''Tests reboots are scheduled with a call per system'''
+        self.assertEqual(self.spw.schedule_reboot([3, 1, 3, 2]),
+                         [10, 20, 30])
+        self.assertEqual(self.spw.count('system.schedule_reboot'), 3)
+
+
+class TestDependencyResolver(unittest.TestCase):
+    '''Tests the packages resolve adds to meet dependencies'''
+
+    def setUp(self):
+        channels = {
+            'prod-base': {'pkgs': [5]},
+            'prod-tools': {'pkgs': [], 'parent': 'prod-base'},
+            'prod-other': {'pkgs': []},
+            'dev-tools': {'pkgs': [1, 2, 3, 4, 7, 8, 9, 10, 11]},
+        }
+        pkgs = {
+            1: ('app', '', '1.0', '1'),
+            2: ('libfoo', '', '1.0', '1'),
+            3: ('libfoo', '', '2.0', '1'),
+            4: ('libfoo', '', '2.1', '1'),
+            5: ('python', '', '2.7', '1'),
+            7: ('tool', '', '1.0', '1'),
+            8: ('zlib-tools', '', '1.0', '1'),
+            9: ('broken', '', '1.0', '1'),
+            10: ('py3app', '', '1.0', '1'),
+            11: ('python', '', '3.0', '1'),
+        }
+        deps = {
+            1: [('requires', 'libfoo', '>= 2.0'),
+                ('requires', '/usr/bin/python', ''),
+                ('requires', 'rpmlib(PayloadIsXz)', '<= 5.2-1')],
+            7: [('requires', 'libfoo', '')],
+            8: [('requires', 'zlib', '')],
+            9: [('requires', 'missing-thing', '>= 1')],
+            10: [('conflicts', 'python', '< 3')],
+        }
+        files = {5: ['/usr/bin/python'], 11: ['/usr/bin/python']}
+        handlers = fake_channels(channels, pkgs)
+        handlers['packages.list_dependencies'] = lambda i: [
+            {'dependency_type': t, 'dependency': n, 'dependency_modifier': m}
+            for t, n, m in deps.get(i, [])]
+        handlers['packages.list_files'] = lambda i: [
+            {'path': f} for f in files.get(i, [])]
+        self.spw = FakeSpacewalk(handlers)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.resolver = libhouston.DependencyResolver(
+            self.spw, ['dev-tools'], os.path.join(self.tmp.name, 'deps.db'))
+
+    def tearDown(self):
+        self.resolver.close()
+        self.tmp.cleanup()
+
+    def test_closure(self):
+        '''Tests only the newest provider is added, once'''
+        found = self.resolver.resolve([1, 7], 'prod-tools')
+        self.assertEqual(found, {'add': [1, 7, 4], 'unresolved': [],
+                                 'conflicts': []})
+
+    def test_parent(self):
+        '''Tests a child channel's parent meets requirements too'''
+        self.assertEqual(self.resolver.subscribed_with('prod-tools'),
+                         ['prod-tools', 'prod-base'])
+        self.assertEqual(self.resolver.resolve([1], 'prod-other')['add'],
+                         [1, 4, 11])
+
+    def test_files(self):
+        '''Tests file requirements fall back to the file lists'''
+        self.resolver.resolve([1], 'prod-tools')
+        self.assertEqual(self.spw.count('packages.list_files'), 1)
+        self.assertEqual(self.resolver.providers('dev-tools',
+                                                 '/usr/bin/python'), {11})
+
+    def test_unresolved(self):
+        '''Tests requirements nothing provides are reported'''
+        found = self.resolver.resolve([9, 8], 'prod-tools')
+        self.assertEqual(found['add'], [9, 8])
+        self.assertEqual(found['unresolved'], [(9, 'missing-thing >= 1'),
+                                               (8, 'zlib')])
+
+    def test_conflicts(self):
+        '''Tests conflicts with packages in the parent are reported'''
+        found = self.resolver.resolve([10], 'prod-tools')
+        self.assertEqual(found['conflicts'], [(10, 5, 'python < 3')])
+
+
+
+class TestIsCloneOf(unittest.TestCase):
+    '''Tests clone names are matched to the original advisory'''
+
+    def test_clones(self):
+        '''Tests the original, the CL name and numbered CL names match'''
+        for name in ['RHSA-2014:0376', 'CLA-2014:0376', 'CL1A-2014:0376',
+                     'CL12A-2014:0376']:
+            self.assertTrue(libhouston._is_clone_of(name, 'RHSA-2014:0376'))
+
+    def test_others(self):
+        '''Tests other advisories and longer names don't match'''
+        for name in ['CLA-2014:0377', 'CLA-2014:03761', 'CLXA-2014:0376',
+                     'RHSA-2014:0377', 'XCLA-2014:0376']:
+            self.assertFalse(libhouston._is_clone_of(name, 'RHSA-2014:0376'))
+
+
+class TestErrataCloneTracker(unittest.TestCase):
+    '''Tests clones are picked up and journaled as they appear'''
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.journal = libhouston.Journal(os.path.join(self.tmp.name,
+                                                       'journal'))
+        self.errata = {'prod-base': ['CLA-2014:0001'], 'prod-tools': []}
+        self.spw = FakeSpacewalk({
+            'channel.software.list_errata': lambda label: [
+                {'advisory_name': e} for e in self.errata[label]],
+        }, journal=self.journal)
+        self.tracker = libhouston.ErrataCloneTracker(self.spw, {
+            'prod-base': ['RHSA-2014:0001', 'RHBA-2014:0002'],
+            'prod-tools': ['RHSA-2014:0001'],
+            'prod-empty': [],
+        }, min_interval=0, max_interval=0)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_poll(self):
+        '''Tests each poll reports and journals only new clones'''
+        self.assertEqual(self.tracker.poll(), [
+            ('prod-base', 'RHSA-2014:0001', 'CLA-2014:0001')])
+        self.assertEqual(self.tracker.poll(), [])
+        self.errata['prod-base'].append('CL1A-2014:0002')
+        self.errata['prod-tools'].append('CL1A-2014:0001')
+        self.assertEqual(self.tracker.poll(), [
+            ('prod-base', 'RHBA-2014:0002', 'CL1A-2014:0002'),
+            ('prod-tools', 'RHSA-2014:0001', 'CL1A-2014:0001')])
+        self.assertEqual(self.tracker.pending, {})
+        self.assertEqual(self.spw.count('channel.software.list_errata'), 6)
+        self.assertEqual([(e['channel'], e['errata_added'])
+                          for e in self.journal.entries()], [
+            ('prod-base', ['CLA-2014:0001']),
+            ('prod-base', ['CL1A-2014:0002']),
+            ('prod-tools', ['CL1A-2014:0001'])])
+
+    def test_timeout(self):
+        '''Tests wait gives up leaving the missing clones pending'''
+        seen = list(self.tracker.wait(timeout=0.01))
+        self.assertEqual(len(seen), 1)
+        self.assertEqual(self.tracker.pending,
+                         {'prod-base': {'RHBA-2014:0002'},
+                          'prod-tools': {'RHSA-2014:0001'}})
+
+
+
+class _PackageHandler(http.server.BaseHTTPRequestHandler):
+    '''Serves the server's files, honouring Range and redirecting /r/'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('Range')))
+        if self.path.startswith('/r/'):
+            self.send_response(302)
+            self.send_header('Location', '/p/' + self.path[3:])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = self.server.files[self.path[3:]]
+        start = 0
+        if self.headers.get('Range'):
+            start = int(self.headers['Range'][6:-1])
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+        self.wfile.write(body[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class TestMirror(unittest.TestCase):
+    '''Tests downloads against a local http server'''
+
+    def setUp(self):
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                     _PackageHandler)
+        self.httpd.files = {'1': b'a' * 5000, '2': b'b' * 3000}
+        self.httpd.requests = []
+        threading.Thread(target=self.httpd.serve_forever, args=(0.05,),
+                         daemon=True).start()
+        self.checksums = {i: hashlib.sha256(body).hexdigest()
+                          for i, body in self.httpd.files.items()}
+        url = 'http://127.0.0.1:{}/r/'.format(self.httpd.server_port)
+        self.spw = FakeSpacewalk({
+            # both packages have the same file name
+            'packages.get_details': lambda i: {
+                'file': '/var/satellite/{}/bash.rpm'.format(i),
+                'checksum': self.checksums[str(i)],
+                'checksum_type': 'sha256'},
+            'packages.get_package_url': lambda i: url + str(i),
+        })
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.tmp.cleanup()
+
+    def local(self, pkgid):
+        return os.path.join(self.tmp.name, 'Packages',
+                            self.checksums[str(pkgid)], 'bash.rpm')
+
+    def test_sync(self):
+        '''Tests same named packages are both kept and not fetched twice'''
+        mirror = libhouston.Mirror(self.spw, self.tmp.name, workers=2)
+        self.assertEqual(mirror.sync([1, 2]), {
+            'skipped': 0, 'fetched': 2, 'failed': 0, 'bytes': 8000})
+        for pkgid in [1, 2]:
+            with open(self.local(pkgid), 'rb') as fh:
+                self.assertEqual(fh.read(), self.httpd.files[str(pkgid)])
+
+        calls = len(self.spw.calls)
+        mirror = libhouston.Mirror(self.spw, self.tmp.name)
+        self.assertEqual(mirror.sync([1, 2])['skipped'], 2)
+        self.assertEqual(len(self.spw.calls), calls)
+
+    def test_resume(self):
+        '''Tests a partial download is resumed with a Range request'''
+        os.makedirs(os.path.dirname(self.local(1)))
+        with open(self.local(1) + '.part', 'wb') as fh:
+            fh.write(b'a' * 2000)
+        stats = libhouston.Mirror(self.spw, self.tmp.name).sync([1])
+        self.assertEqual(stats['bytes'], 3000)
+        self.assertEqual(self.httpd.requests, [('/r/1', 'bytes=2000-'),
+                                               ('/p/1', 'bytes=2000-')])
+        self.assertEqual(os.path.getsize(self.local(1)), 5000)
+
+    def test_stale_partial(self):
+        '''Tests a resumed download that doesn't match starts again'''
+        os.makedirs(os.path.dirname(self.local(1)))
+        with open(self.local(1) + '.part', 'wb') as fh:
+            fh.write(b'x' * 2000)
+        stats = libhouston.Mirror(self.spw, self.tmp.name).sync([1])
+        self.assertEqual((stats['fetched'], stats['bytes']), (1, 8000))
+        self.assertEqual([r[1] for r in self.httpd.requests],
+                         ['bytes=2000-', 'bytes=2000-', None, None])
+        with open(self.local(1), 'rb') as fh:
+            self.assertEqual(fh.read(), self.httpd.files['1'])
+
+    def test_mismatch(self):
+        '''Tests a download that never matches fails and leaves nothing'''
+        self.httpd.files['1'] = b'c' * 5000
+        errors = []
+        stats = libhouston.Mirror(self.spw, self.tmp.name).sync(
+            [1], lambda p, s, e: errors.append(e))
+        self.assertEqual(stats['failed'], 1)
+        self.assertIn('Checksum mismatch', str(errors[0]))
+        self.assertEqual(os.listdir(os.path.dirname(self.local(1))), [])
+
+    def test_legacy(self):
+        '''Tests a file mirrored under its bare name is moved, not fetched'''
+        os.makedirs(os.path.join(self.tmp.name, 'Packages'))
+        with open(os.path.join(self.tmp.name, 'Packages', 'bash.rpm'),
+                  'wb') as fh:
+            fh.write(self.httpd.files['2'])
+        stats = libhouston.Mirror(self.spw, self.tmp.name).sync([1, 2])
+        self.assertEqual(stats['bytes'], 5000)
+        self.assertTrue(os.path.exists(self.local(2)))
+
+
+
+class TestThrottle(unittest.TestCase):
+    '''Tests the token bucket and the AIMD limit on calls in flight'''
+
+    def call(self, throttle, latency, error=None, method='a'):
+        throttle.acquire()
+        throttle.release(latency, error, method)
+
+    def test_bucket(self):
+        '''Tests calls past the burst wait their turn for a token'''
+        throttle = libhouston.Throttle(rate=10, burst=2)
+        with unittest.mock.patch.object(libhouston.time, 'sleep') as sleep:
+            for i in range(4):
+                self.call(throttle, 0.01)
+        waits = [c[0][0] for c in sleep.call_args_list]
+        self.assertEqual(len(waits), 2)
+        self.assertAlmostEqual(waits[0], 0.1, delta=0.02)
+        self.assertAlmostEqual(waits[1], 0.2, delta=0.02)
+
+    def test_increase(self):
+        '''Tests quick calls raise the limit up to max_limit'''
+        throttle = libhouston.Throttle(limit=4, max_limit=6)
+        for i in range(5):
+            self.call(throttle, 0.01)
+        self.assertEqual(throttle.limit, 5)
+        for i in range(50):
+            self.call(throttle, 0.01)
+        self.assertEqual(throttle.limit, 6)
+
+    def test_slow(self):
+        '''Tests only calls slow for their own method cut the limit'''
+        throttle = libhouston.Throttle(limit=10)
+        self.call(throttle, 0.01, method='packages.get_details')
+        self.call(throttle, 1.0, method='channel.software.list_all_packages')
+        self.assertGreaterEqual(throttle.limit, 10)
+        throttle._last_cut = 0
+        self.call(throttle, 1.0, method='packages.get_details')
+        self.assertEqual(throttle.limit, 9)
+
+    def test_errors(self):
+        '''Tests errors halve the limit once per typical call time'''
+        throttle = libhouston.Throttle(limit=16, min_limit=3)
+        self.call(throttle, 0.01)
+        throttle.typical = 60
+        throttle._last_cut = 0
+        self.call(throttle, 5, OSError())
+        self.call(throttle, 5, OSError())
+        self.assertEqual(throttle.limit, 8)
+        throttle._last_cut = 0
+        self.call(throttle, 5, xmlrpc.client.ProtocolError('', 503, '', {}))
+        throttle._last_cut = 0
+        self.call(throttle, 5, OSError())
+        self.assertEqual(throttle.limit, 3)
+
+    def test_faults(self):
+        '''Tests faults only cut the limit once they are common'''
+        throttle = libhouston.Throttle(limit=8)
+        fault = libhouston.SpacewalkAPIError(
+            'Could not get a database connection')
+        self.call(throttle, 0.01, fault)
+        self.call(throttle, 0.01, fault)
+        self.assertEqual(throttle.limit, 8)
+        self.call(throttle, 0.01, fault)
+        self.assertEqual(throttle.limit, 4)
+
+    def test_lookup_faults(self):
+        '''Tests faults for things that don't exist don't cut the limit'''
+        throttle = libhouston.Throttle(limit=8)
+        for message in ['No such channel', 'Errata not found',
+                        'Package does not exist', 'Invalid errata']:
+            self.call(throttle, 0.01, libhouston.SpacewalkAPIError(
+                "RPC Fault while calling x\n<Fault -212: '{}'>".format(
+                    message)))
+        self.assertEqual(throttle.fault_rate, 0)
+        self.assertGreaterEqual(throttle.limit, 8)
+
+
+
+class TestJournal(unittest.TestCase):
+    '''Tests the net changes worked out from the journal'''
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.journal = libhouston.Journal(os.path.join(self.tmp.name, 'j'))
+        self.server = 'https://spw.example.com/rpc/api'
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_net(self):
+        '''Tests changes that cancel out are left out'''
+        record = self.journal.record
+        record(self.server, 'prod', 'add_packages', pkgs_added=[1, 2])
+        record(self.server, 'prod', 'remove_packages', pkgs_removed=[2, 3])
+        record(self.server, 'prod', 'remove_errata', errata_removed=['A'])
+        record(self.server, 'prod', 'merge_errata', errata_added=['A', 'B'])
+        record('https://other/rpc/api', 'prod', 'add_packages',
+               pkgs_added=[9])
+        prod = self.journal.changes_since(self.server, 0)['prod']
+        self.assertEqual(prod, {'created': False, 'deleted': None,
+                                'pkgs_added': {1}, 'pkgs_removed': {3},
+                                'errata_added': {'B'},
+                                'errata_removed': set()})
+
+    def test_since(self):
+        '''Tests only entries after since count'''
+        self.journal.record(self.server, 'prod', 'add_packages',
+                            pkgs_added=[1])
+        since = time.time()
+        time.sleep(0.01)
+        self.journal.record(self.server, 'prod', 'add_packages',
+                            pkgs_added=[2])
+        self.assertEqual(self.journal.changes_since(
+            self.server, since)['prod']['pkgs_added'], {2})
+
+    def test_created_deleted(self):
+        '''Tests channels created or deleted since are marked'''
+        details = {'label': 'old'}
+        self.journal.record(self.server, 'new', 'create')
+        self.journal.record(self.server, 'old', 'delete', details=details,
+                            pkgs_removed=[4])
+        with open(self.journal.path, 'a') as fh:
+            fh.write('{"time": 1')
+        changes = self.journal.changes_since(self.server, 0)
+        self.assertEqual(list(changes), ['new', 'old'])
+        self.assertTrue(changes['new']['created'])
+        self.assertEqual(changes['old']['deleted'], details)
+        self.assertEqual(changes['old']['pkgs_removed'], {4})
+
+
+class TestRollback(unittest.TestCase):
+    '''Tests journaled changes are undone'''
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.channels = {
+            'rhel-base': {'pkgs': [], 'errata': ['RHSA-2014:0001']},
+            'prod-base': {'pkgs': [1, 2], 'original': 'rhel-base',
+                          'errata': ['CLA-2014:0001', 'CLA-2014:0009']},
+        }
+        self.merged = []
+        handlers = fake_channels(self.channels, {
+            i: ('pkg{}'.format(i), '', '1', '1') for i in range(1, 5)})
+        ns = 'channel.software.'
+
+        def remove_errata(label, names, remove_pkgs):
+            self.channels[label]['errata'] = [
+                e for e in self.channels[label]['errata'] if e not in names]
+            return 1
+
+        def merge_errata(source, label, names):
+            self.merged.append((source, label, names))
+            self.channels[label]['errata'].extend(names)
+            return []
+
+        def create(label, name, summary, arch, parent, checksum):
+            self.channels[label] = {'pkgs': [], 'parent': parent,
+                                    'errata': []}
+            return 1
+
+        handlers.update({
+            ns + 'remove_errata': remove_errata,
+            ns + 'merge_errata': merge_errata,
+            ns + 'create': create,
+            ns + 'delete': lambda label: self.channels.pop(label) and 1,
+        })
+        self.spw = FakeSpacewalk(handlers, libhouston.Journal(
+            os.path.join(self.tmp.name, 'journal')))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_contents(self):
+        '''Tests packages and errata are put back'''
+        self.spw.add_packages('prod-base', [3])
+        self.spw.remove_packages('prod-base', [1])
+        self.spw.remove_errata('prod-base', ['CLA-2014:0001',
+                                             'CLA-2014:0009'])
+        calls = self.spw.count('channel.software.list_all_packages')
+
+        self.assertEqual(self.spw.rollback(0), [
+            ('prod-base', 'add_packages', 1),
+            ('prod-base', 'remove_packages', 1),
+            ('prod-base', 'merge_errata', 1),
+            ('prod-base', 'errata_not_restored', 1)])
+        self.assertEqual(sorted(self.channels['prod-base']['pkgs']), [1, 2])
+        self.assertEqual(self.merged, [('rhel-base', 'prod-base',
+                                        ['RHSA-2014:0001'])])
+        # one shared lookup, and before and after the merge
+        self.assertEqual(self.spw.count(
+            'channel.software.list_all_packages') - calls, 3)
+
+    def test_dry_run(self):
+        '''Tests a dry run changes nothing'''
+        self.spw.add_packages('prod-base', [3])
+        calls = len(self.spw.calls)
+        self.assertEqual(self.spw.rollback(0, dry_run=True),
+                         [('prod-base', 'remove_packages', 1)])
+        self.assertEqual(len(self.spw.calls), calls)
+
+    def test_channels(self):
+        '''Tests created channels are deleted and deleted ones created'''
+        since = 0
+        self.spw.delete_channel('prod-base')
+        self.spw.create_channel({'label': 'prod-tools', 'name': 'tools',
+                                 'summary': 'tools',
+                                 'arch_label': 'channel-x86_64',
+                                 'parent_channel_label': 'rhel-base'})
+        done = self.spw.rollback(since, channels=['prod-tools'])
+        self.assertEqual(done, [('prod-tools', 'delete', 1)])
+        self.assertNotIn('prod-tools', self.channels)
+
+        done = self.spw.rollback(since, channels=['prod-base'])
+        self.assertEqual(done, [('prod-base', 'create', 1),
+                                ('prod-base', 'add_packages', 2),
+                                ('prod-base', 'merge_errata', 1),
+                                ('prod-base', 'errata_not_restored', 1)])
+        self.assertEqual(sorted(self.channels['prod-base']['pkgs']), [1, 2])
+        self.assertEqual(self.channels['prod-base']['errata'],
+                         ['RHSA-2014:0001'])
+
+    def test_deleted_packages(self):
+        '''Tests packages deleted from the server are reported, not added'''
+        self.spw.handlers['packages.remove_package'] = lambda p: 1
+        self.spw.remove_packages('prod-base', [1, 2])
+        self.spw.delete_packages([2])
+        self.assertEqual(self.spw.rollback(0), [
+            ('prod-base', 'add_packages', 1),
+            ('prod-base', 'pkgs_not_restored', 1)])
+        self.assertEqual(self.channels['prod-base']['pkgs'], [1])
+
+    def test_arch_label(self):
+        '''Tests channels can't be created without an arch label'''
+        self.assertRaises(libhouston.SpacewalkError,
+                          self.spw.create_channel,
+                          {'label': 'prod-tools', 'name': 'tools',
+                           'summary': 'tools', 'arch_name': 'x86_64'})
+        self.assertNotIn('prod-tools', self.channels)
+
+
+
+class _LoginTransport(xmlrpc.client.Transport):
+    '''Answers the calls made while logging in, without a server'''
+
+    def __init__(self, url, logins):
+        super().__init__()
+        self.url = url
+        self.logins = logins
+
+    def request(self, host, handler, request_body, verbose=False):
+        params, method = xmlrpc.client.loads(request_body)
+        if method == 'auth.login':
+            self.logins.append((self.url,) + params)
+            return ('key',)
+        if method != 'api.get_api_call_list':
+            self.logins.append((self.url, method))
+        return ({'channel': {'listAllPackages_string': 'int'}},)
+
+
+class TestPassword(unittest.TestCase):
+    '''Tests the password is only kept for persistent sessions'''
+
+    def session(self, persistent):
+        self.logins = []
+        return libhouston.Spacewalk(
+            'spw.example.com', 'admin', 'secret', journal=None,
+            persistent=persistent,
+            replicas=['replica1.example.com', 'replica2.example.com'],
+            transport=lambda url: _LoginTransport(url, self.logins))
+
+    def test_replicas(self):
+        '''Tests replicas are logged into before the password is dropped'''
+        spw = self.session(False)
+        self.assertEqual(len(spw.replicas), 2)
+        self.assertEqual(len(self.logins), 3)
+        self.assertEqual({l[1:] for l in self.logins}, {('admin', 'secret')})
+        self.assertFalse(hasattr(spw, 'password'))
+
+    def test_persistent(self):
+        '''Tests persistent sessions keep the password to log in again'''
+        self.assertEqual(self.session(True).password, 'secret')
+
+
+class TestReplicaReads(unittest.TestCase):
+    '''Tests which calls are sent to replicas'''
+
+    calls = ['configchannel.lookup_file_info', 'errata.applicable_to_channels',
+             'errata.bugzilla_fixes', 'configchannel.channel_exists',
+             'channel.software.list_all_packages',
+             'channel.software.add_packages']
+
+    def session(self, replicas):
+        self.sent = []
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        conf = os.path.join(tmp.name, 'spw_conf')
+        with open(conf, 'w') as fh:
+            fh.write('[auth]\nreplicas = replica.example.com\n')
+        spw = libhouston.Spacewalk(
+            'spw.example.com', 'admin', 'secret', journal=None, conf=conf,
+            replicas=replicas,
+            transport=lambda url: _LoginTransport(url, self.sent))
+        spw._api_calllist = tuple(self.calls)
+        del self.sent[:]
+        return spw
+
+    def hosts(self, spw, *apis):
+        for api in apis:
+            spw.api_call(*api.rsplit('.', 1))
+        return [libhouston.server_host(url) for url, m in self.sent]
+
+    def test_reads(self):
+        '''Tests lookups and other reads go to the replica'''
+        spw = self.session(['replica.example.com'])
+        self.assertEqual(self.hosts(spw, *self.calls[:5]),
+                         ['replica.example.com'] * 5)
+
+    def test_after_write(self):
+        '''Tests reads go to the server once something has been changed'''
+        spw = self.session(['replica.example.com'])
+        self.assertEqual(self.hosts(spw, 'channel.software.add_packages',
+                                    'configchannel.lookup_file_info'),
+                         ['spw.example.com'] * 2)
+
+    def test_read_only(self):
+        '''Tests read only commands keep reading from the replicas'''
+        spw = self.session(True)
+        self.assertEqual(self.hosts(spw, 'channel.software.add_packages',
+                                    'configchannel.lookup_file_info'),
+                         ['spw.example.com', 'replica.example.com'])
+
+
+
+class TestConfigChannel(unittest.TestCase):
+    '''Tests comparing config channels with a local directory'''
+
+    def setUp(self):
+        self.files = {'/etc/motd': b'hello\n', '/etc/app/app.conf': b'x=1\n',
+                      '/etc/new': b'new\n'}
+        self.modified = dict.fromkeys(self.files, '20160101T10:00:00')
+
+        def lookup(label, paths):
+            return [{'path': p, 'revision': 2, 'contents_enc64': True,
+                     'contents': base64.b64encode(
+                         self.files[p]).decode('ascii')} for p in paths]
+
+        self.spw = FakeSpacewalk({
+            'configchannel.get_details': lambda label: {'label': label},
+            'configchannel.list_files': lambda label: [
+                {'path': '/etc/app', 'type': 'directory'}] + [
+                {'path': p, 'type': 'file', 'last_modified': m}
+                for p, m in sorted(self.modified.items())],
+            'configchannel.lookup_file_info': lookup,
+        })
+        self.tmp = tempfile.TemporaryDirectory()
+        self.local = os.path.join(self.tmp.name, 'local')
+        self.write('/etc/motd', b'hello\n')
+        self.write('/etc/app/app.conf', b'x=2\n')
+        self.write('/etc/local', b'mine\n')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, path, contents):
+        full = os.path.join(self.local, path.lstrip('/'))
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        with open(full, 'wb') as fh:
+            fh.write(contents)
+
+    def channel(self):
+        channel = libhouston.ConfigChannel('base-config', self.spw)
+        channel.cache_path = os.path.join(self.tmp.name, 'config.json')
+        return channel
+
+    def test_diff(self):
+        '''Tests files are sorted into changed, added, removed and same'''
+        self.assertEqual(self.channel().diff(self.local), {
+            'changed': ['/etc/app/app.conf'], 'added': ['/etc/local'],
+            'removed': ['/etc/new'], 'same': ['/etc/motd']})
+        self.assertEqual(
+            self.spw.count('configchannel.lookup_file_info'), 1)
+
+    def test_checksums(self):
+        '''Tests only files modified on the server are looked up again'''
+        sums = self.channel().checksums()
+        self.assertEqual(sums['/etc/motd']['checksum'],
+                         hashlib.sha256(b'hello\n').hexdigest())
+        self.assertEqual(sums['/etc/motd']['revision'], 2)
+        self.assertEqual(self.channel().checksums(), sums)
+        self.assertEqual(self.spw.calls[-1][0], 'configchannel.list_files')
+
+        self.modified['/etc/motd'] = '20160102T10:00:00'
+        self.files['/etc/motd'] = b'bye\n'
+        self.channel().checksums()
+        self.assertEqual(self.spw.calls[-1],
+                         ('configchannel.lookup_file_info', 'base-config',
+                          ['/etc/motd']))
+
+    def test_download(self):
+        '''Tests contents fetched for the diff aren't fetched again'''
+        channel = self.channel()
+        delta = channel.diff(self.local)
+        calls = len(self.spw.calls)
+        channel.download(delta['changed'] + delta['removed'], self.local)
+        self.assertEqual(len(self.spw.calls), calls)
+        self.assertEqual(self.channel().diff(self.local)['changed'], [])
+
+    def test_outside(self):
+        '''Tests paths leaving the local directory are refused'''
+        self.files['/etc/../../evil'] = b'evil\n'
+        self.modified['/etc/../../evil'] = '20160101T10:00:00'
+        channel = self.channel()
+        self.assertRaises(libhouston.SpacewalkError, channel.download,
+                          ['/etc/new', '/etc/../../evil'], self.local)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, 'evil')))
+        self.assertFalse(os.path.exists(os.path.join(self.local, 'etc',
+                                                     'new')))
+
+
+class TestActivationKey(unittest.TestCase):
+    '''Tests working out and syncing activation key changes'''
+
+    def key(self, **details):
+        details.setdefault('description', 'web')
+        details.setdefault('base_channel_label', 'prod-base')
+        details.setdefault('child_channel_labels', ['prod-tools'])
+        details.setdefault('packages', [{'name': 'vim'}])
+        return libhouston.ActivationKey('1-web', FakeSpacewalk(), details)
+
+    def test_children(self):
+        '''Tests children are added and removed against the current ones'''
+        delta = self.key().delta({'child_channel_labels': ['prod-extras']})
+        self.assertEqual(delta['add_children'], ['prod-extras'])
+        self.assertEqual(delta['remove_children'], ['prod-tools'])
+        self.assertEqual(delta['details'], {})
+
+    def test_children_new_base(self):
+        '''Tests all children are added again when the base changes'''
+        delta = self.key().delta({'base_channel_label': 'dev-base',
+                                  'child_channel_labels': ['prod-tools']})
+        self.assertEqual(delta['details'],
+                         {'base_channel_label': 'dev-base'})
+        self.assertEqual(delta['add_children'], ['prod-tools'])
+        self.assertEqual(delta['remove_children'], [])
+
+    def test_packages(self):
+        '''Tests packages are compared by name and arch'''
+        delta = self.key().delta({'packages': ['vim.x86_64', 'git']})
+        self.assertEqual(delta['add_packages'],
+                         [{'name': 'git'}, {'name': 'vim', 'arch': 'x86_64'}])
+        self.assertEqual(delta['remove_packages'], [{'name': 'vim'}])
+
+    def test_config_append(self):
+        '''Tests channels added at the end and removed need no reorder'''
+        delta = self.key(config_channels=['a', 'b', 'c']).delta(
+            {'config_channels': ['a', 'c', 'd']})
+        self.assertEqual(delta['add_config'], ['d'])
+        self.assertEqual(delta['remove_config'], ['b'])
+        self.assertIsNone(delta['set_config'])
+
+    def test_config_reorder(self):
+        '''Tests a change of rank sets the whole list'''
+        delta = self.key(config_channels=['a', 'b']).delta(
+            {'config_channels': ['b', 'a', 'c']})
+        self.assertEqual(delta['set_config'], ['b', 'a', 'c'])
+        self.assertEqual(delta['add_config'], [])
+        self.assertEqual(delta['remove_config'], [])
+
+    def test_config_same(self):
+        '''Tests nothing is changed for the same list'''
+        delta = self.key(config_channels=['a', 'b']).delta(
+            {'config_channels': ['a', 'b']})
+        self.assertEqual((delta['add_config'], delta['remove_config'],
+                          delta['set_config']), ([], [], None))
+
+    def test_adopt(self):
+        '''Tests randomly named keys are taken over, not recreated'''
+        listed = [
+            {'key': '1-8f3a', 'description': 'web', 'base_channel_label':
+             'prod-base', 'child_channel_labels': [], 'entitlements': []},
+            {'key': '1-0c1d', 'description': 'old', 'base_channel_label':
+             'prod-base', 'child_channel_labels': [], 'entitlements': []},
+        ]
+        spw = FakeSpacewalk({
+            'activationkey.list_activation_keys': lambda: listed,
+            'activationkey.create': lambda *a: '1-' + a[0],
+            'activationkey.get_details': lambda k: {
+                'description': 'db', 'base_channel_label': 'prod-base'},
+            'activationkey.add_child_channels': lambda k, c: 1,
+            'activationkey.delete': lambda k: 1,
+        })
+        stats = spw.sync_activation_keys(
+            {'web': {'description': 'web', 'base_channel_label': 'prod-base',
+                     'child_channel_labels': ['prod-tools']},
+             'db': {'description': 'db', 'base_channel_label': 'prod-base'}},
+            delete=True, adopt=True)
+        self.assertEqual((stats['adopted'], stats['created'],
+                          stats['deleted']), (1, 1, 1))
+        self.assertIn(('activationkey.add_child_channels', '1-8f3a',
+                       ['prod-tools']), spw.calls)
+        self.assertIn(('activationkey.delete', '1-0c1d'), spw.calls)
+        self.assertNotIn(('activationkey.delete', '1-8f3a'), spw.calls)
+
+
 if __name__ == '__main__':
     unittest.main()